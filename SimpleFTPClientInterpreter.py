@@ -29,14 +29,30 @@
 ################################################################################
 """This module provides the SimpleFTPClientInterpreter type."""
 
+import errno
+import hashlib
+import os
+import random
 import re
+import select
 import socket
+import ssl
+import threading
 
-from os.path import getsize, isdir, isfile
-from utils import debugPrint, isError, recvAll, recvFile, recvLine, sendFile, sendStr
+from datetime import datetime
+from os.path import exists, getsize, isdir, isfile, join
+from utils import dataSocketPath, debugPrint, isError, recvAll, recvFile
+from utils import recvLine, sendFile, sendStr, unixPeerCredentials
 
+from atomicfile import copyData
+from autotune import ChunkTuner
+from clientcache import DownloadCache
 from ClientConnection import ClientConnectionInterpreter
+from multiplex import Multiplexer, MuxChannel
+from sparse import recvSparseIntoFile, sendSparseFile
 from timer import Timer
+from tls import hasApplicationData, wrapDataSocket
+from treestream import recvTree, sendTree, treeSize, TreeStreamError
 
 
 class SimpleFTPClientInterpreter(ClientConnectionInterpreter):
@@ -44,33 +60,134 @@ class SimpleFTPClientInterpreter(ClientConnectionInterpreter):
 	a rudimentary file transfer client. The full protocol specification can be
 	found in the included README file."""
 	
-	__slots__ = ("_dataSock", "_commandHandlers", "_config", "_isFinished")
+	__slots__ = ("_commandThread", "_dataSock", "_commandHandlers", "_config", "_ctrlLock",
+			"_downloads", "_isFinished", "_mux", "_nextChannel", "_pool", "_poolThread",
+			"_poolWakeup", "_quiet", "_result", "_tlsSocket", "_tuner", "_unixPath", "_validated",
+			"_watches")
 	
-	def __init__(self, connSock, remoteAddr):
+	# How often (seconds) idle pooled data connections are checked.
+	POOL_CHECK_INTERVAL = 5
+	
+	# The form of a file's description in STAT, STATM and FIND replies.
+	STAT_DESCRIPTION = (r"(?P<type>FILE|DIRECTORY|LINK|OTHER|NONE) (?P<size>\d+) (?P<mtime>\d+)"
+			r"( (?P<digest>[0-9a-f]+|-))?")
+	
+	# The form of the GETTREE and PUTTREE commands (given the verb).
+	TREE_COMMAND = r"{verb}(?P<options>( (COMPRESS|INCLUDE \S+|EXCLUDE \S+))*) (?P<dirname>.+)"
+	
+	def __init__(self, connSock, remoteAddr, quiet=False):
 		super().__init__(connSock, remoteAddr)
+		# The thread running the current command, and its outcome so far (see
+		# lastResult).
+		self._commandThread = None
 		self._dataSock = None
 		self._commandHandlers = {}
 		self._config = {
 				"chunk_size": 65536,
+				# (Only possible for a server on the same host; see GETFD.)
+				"fd_passing": connSock.family == socket.AF_UNIX and hasattr(socket, "recv_fds"),
 				"passive": False,
-				"persistent": False
+				"persistent": False,
+				"pool_size": 0,
+				"queue_depth": 0,
+				"sparse": False
 				}
+		self._downloads = None
 		self._isFinished = False
+		self._mux = None
+		self._nextChannel = 1
+		# The control connection, if it is over TLS (so the data connections
+		# are too; see _secureDataConnection).
+		self._tlsSocket = connSock if isinstance(connSock, ssl.SSLSocket) else None
+		self._tuner = None
+		# The path of the server's Unix domain socket, if connected by one;
+		# data connections are then made at paths beside it.
+		self._unixPath = None
+		if connSock.family == socket.AF_UNIX:
+			self._unixPath = connSock.getpeername()
+		self._validated = None
+		# The data connections of the active watches (and FOLLOWs), by watch
+		# ID; each is read by a thread of its own (see _printWatchEvents and
+		# _receiveFollowed).
+		self._watches = {}
+
+		# The data connection pool: a list of (ID, socket) tuples, oldest
+		# first; refilled by the _poolThread in the background. Since that
+		# uses the control connection too, every exchange on it must hold the
+		# _ctrlLock.
+		self._ctrlLock = threading.RLock()
+		self._pool = []
+		self._poolThread = None
+		self._poolWakeup = threading.Event()
+		# If set, nothing is printed; the outcome of each command is only
+		# recorded (see lastResult).
+		self._quiet = quiet
+		self._result = None
 		
 		# CHUNK <size>
-		# Set the chunk size for file transfers. 
-		self.registerCommandHandler(r"CHUNK (?P<size>\d+)",
+		# CACHE <dirname>
+		# CACHE OFF
+		# Keep downloaded files in the given local directory, so that GETs of
+		# unchanged files are served from it; or stop doing so.
+		self.registerCommandHandler(r"CACHE (?P<dirname>.+)",
+				self._command_CACHE, needData=False)
+
+		# CHUNK AUTO
+		# Set the chunk size for file transfers, or have it tuned automatically.
+		self.registerCommandHandler(r"CHUNK (?P<size>\d+|AUTO)",
 				self._command_CHUNK, needData=False)
 		
+		# COPY <source> <destination>
+		# Copy a file on the server, without transferring it.
+		self.registerCommandHandler(r"COPY (?P<src>\S+) (?P<dst>\S+)",
+				self._command_COPY, needData=False, verb="COPY")
+		
+		# FDPASS YES
+		# FDPASS NO
+		# Enables or disables receiving downloads as open file descriptors,
+		# when connected to a server on the same host.
+		self.registerCommandHandler(r"FDPASS (?P<option>YES|NO)",
+				self._command_FDPASS, needData=False)
+		
+		# FIND <glob> [MINSIZE <size>] [MAXSIZE <size>] [NEWER <time>] [LIMIT <count>]
+		# Search the whole tree on the server for matching files.
+		self.registerCommandHandler(
+				r"FIND (?P<pattern>\S+)(?P<options>( (MINSIZE \d+|MAXSIZE \d+|NEWER \S+|LIMIT \d+))*)",
+				self._command_FIND, needData=False)
+		
+		# FOLLOW [<offset>] <filename>
+		# Keep the local copy of a remote file up to date as it grows, in the
+		# background, until UNWATCH.
+		self.registerCommandHandler(r"FOLLOW( (?P<offset>\d+))? (?P<filename>.+)",
+				self._command_FOLLOW, needData=True, preflight=self._preflight_WATCH)
+		
 		# GET <filename>
 		# Retrieve the specified file from the server.
 		self.registerCommandHandler(r"GET (?P<filename>.+)",
-				self._command_GET, needData=True, overwriteFlag=False)
+				self._command_GET, needData=self._needsGetDataConnection,
+				preflight=self._preflight_GET, overwriteFlag=False)
 
 		# GETF <filename>
 		# Retrieve the specified file from the server, overwriting it if it already exists.
 		self.registerCommandHandler(r"GETF (?P<filename>.+)",
-				self._command_GET, needData=True, overwriteFlag=True)
+				self._command_GET, needData=self._needsGetDataConnection,
+				preflight=self._preflight_GET, overwriteFlag=True)
+		
+		# GETTREE [COMPRESS] [INCLUDE <glob>]... [EXCLUDE <glob>]... <dirname>
+		# Retrieve the specified directory tree from the server.
+		self.registerCommandHandler(self.TREE_COMMAND.format(verb="GETTREE"),
+				self._command_GETTREE, needData=True, preflight=self._preflight_GETTREE)
+		
+		# HASH <filename>
+		# Print the digest of a remote file, and whether the local file of the
+		# same name matches it.
+		self.registerCommandHandler(r"HASH (?P<filename>.+)",
+				self._command_HASH, needData=False)
+
+		# HASHDIR <dirname>
+		# The same, for all of the files under a directory.
+		self.registerCommandHandler(r"HASHDIR (?P<dirname>.+)",
+				self._command_HASHDIR, needData=False)
 		
 		# LS
 		# Get a file listing from the server.
@@ -82,6 +199,18 @@ class SimpleFTPClientInterpreter(ClientConnectionInterpreter):
 		self.registerCommandHandler(r"HELP( (?P<command>\w+))?",
 				self._command_HELP, needData=False)
 
+		# MUX YES
+		# MUX NO
+		# Enables or disables the multiplexed transport (data channels carried
+		# on the control connection).
+		self.registerCommandHandler(r"MUX (?P<option>YES|NO)",
+				self._command_MUX, needData=False)
+
+		# MOVE <source> <destination>
+		# Move (rename) a file on the server, without transferring it.
+		self.registerCommandHandler(r"MOVE (?P<src>\S+) (?P<dst>\S+)",
+				self._command_COPY, needData=False, verb="MOVE")
+
 		# PASV YES
 		# PASV NO
 		# Enables or disables passive data transfer mode.
@@ -93,37 +222,99 @@ class SimpleFTPClientInterpreter(ClientConnectionInterpreter):
 		self.registerCommandHandler(r"PERSIST (?P<option>YES|NO)",
 				self._command_PERSIST, needData=False)
 		
+		# POOL <count>
+		# Keep the given number of idle data connections ready in a pool.
+		self.registerCommandHandler(r"POOL (?P<size>\d+)",
+				self._command_POOL, needData=False)
+		
 		# PUT <filename>
 		# Send the specified file to the server.
 		self.registerCommandHandler(r"PUT (?P<filename>.+)",
-				self._command_PUT, needData=True)
+				self._command_PUT, needData=self._needsDataConnection,
+				preflight=self._preflight_PUT)
+		
+		# PUTTREE [COMPRESS] [INCLUDE <glob>]... [EXCLUDE <glob>]... <dirname>
+		# Send the specified directory tree to the server.
+		self.registerCommandHandler(self.TREE_COMMAND.format(verb="PUTTREE"),
+				self._command_PUTTREE, needData=True, preflight=self._preflight_PUTTREE)
+		
+		# QUEUE <depth>
+		# Set the number of chunks queued between disk and network I/O in file
+		# transfers (0 to not overlap them).
+		self.registerCommandHandler(r"QUEUE (?P<depth>\d+)",
+				self._command_QUEUE, needData=False)
 		
 		# QUIT
 		# Exit the client.
 		self.registerCommandHandler(r"QUIT",
 				self._command_QUIT, needData=False)
 
+		# RATE <bytes/sec>
+		# Set the maximum transfer rate of this connection (0 for no limit).
+		self.registerCommandHandler(r"RATE (?P<rate>\d+)",
+				self._command_RATE, needData=False)
+
+		# SPARSE YES
+		# SPARSE NO
+		# Enables or disables sparse file transfers (skipping holes).
+		self.registerCommandHandler(r"SPARSE (?P<option>YES|NO)",
+				self._command_SPARSE, needData=False)
+
+		# STAT [HASH] <filename>
+		# Print the type, size and modification time (and digest) of a file.
+		self.registerCommandHandler(r"STAT( (?P<hash>HASH))? (?P<filename>.+)",
+				self._command_STAT, needData=False)
+
+		# STATM [HASH] <filename> [<filename>]...
+		# Print the same for several files at once.
+		self.registerCommandHandler(r"STATM( (?P<hash>HASH))?(?P<filenames>( \S+)+)",
+				self._command_STATM, needData=False)
+
+		# STATS
+		# Print the server-wide state, such as its bandwidth allocation.
+		self.registerCommandHandler(r"STATS",
+				self._command_STATS, needData=False)
+
+		# UNWATCH [<id>]
+		# Stop one watch or FOLLOW (or all of them).
+		self.registerCommandHandler(r"UNWATCH( (?P<id>\d+))?",
+				self._command_UNWATCH, needData=False)
+
+		# WATCH [<glob>]
+		# Print the changes to the matching files on the server as they
+		# happen, in the background, until UNWATCH.
+		self.registerCommandHandler(r"WATCH( (?P<pattern>\S+))?",
+				self._command_WATCH, needData=True, preflight=self._preflight_WATCH)
+
 
 	def handleCommand(self, command):
 		"""The workhorse function of this client implementation. """
 
+		self._commandThread = threading.current_thread()
+		self._result = self._newResult()
 		if not command:
 			return False # Stop 
 		for (regex, handler) in self._commandHandlers.items():
 			matchObj = re.match("^"+regex+"$", command)
 			if matchObj:
-				(handlerFunc, needData, args, kwargs) = handler
-				if needData and not self._dataSock:
-					if not self._openDataConnection():
-						debugPrint("CLIENT FAILURE: Could not establish data connection.")
-						return False
-				handlerFunc(matchObj, *args, **kwargs)
-				if not self._config["persistent"] and self._dataSock:
-					self._dataSock.close()
-					self._dataSock = None
+				(handlerFunc, needData, preflight, args, kwargs) = handler
+				if preflight and not preflight(matchObj, *args, **kwargs):
+					return False
+				with self._ctrlLock:
+					if callable(needData):
+						needData = needData(matchObj)
+					if needData and not self._dataSock:
+						if not self._openDataConnection():
+							self._debugFailure("CLIENT FAILURE: Could not establish data "
+									"connection.", kind="connection")
+							return False
+					handlerFunc(matchObj, *args, **kwargs)
+					if not self._config["persistent"] and self._dataSock:
+						self._dataSock.close()
+						self._dataSock = None
 				return True
 		else:
-			print("Error: Invalid command! Type 'HELP' for a list of commands.")
+			self._printFailure("Error: Invalid command! Type 'HELP' for a list of commands.")
 			return False
 	
 	
@@ -132,6 +323,89 @@ class SimpleFTPClientInterpreter(ClientConnectionInterpreter):
 		otherwise. """
 		
 		return self._isFinished
+	
+	
+	def lastResult(self):
+		"""Returns the outcome of the most recent command, as a dictionary of
+		its "status" ("ok" or "error"); the number of "bytes" of file data it
+		transferred; the "error" message it failed with, and the "kind" of
+		failure ("remote" for an ERR reply, "protocol" for a malformed reply,
+		"connection" for a lost or failed connection, or "local"), or None;
+		and the "value" it retrieved (such as the listing, for LS), if any."""
+		
+		return dict(self._result or self._newResult())
+		
+		
+	def _debugFailure(self, message, kind="protocol"):
+		"""Prints the given failure message in debug mode, unless the client
+		is quiet, and records it as the outcome of the current command."""
+		
+		if not self._quiet:
+			debugPrint(message)
+		self._recordFailure(message, kind)
+	
+	
+	def _isError(self, line):
+		"""Like utils.isError, but also records an ERR reply as the outcome of
+		the current command."""
+		
+		if not isError(line):
+			return False
+		self._recordFailure(line[len("ERR "):], "remote")
+		return True
+	
+	
+	def _newResult(self):
+		"""Returns the outcome of a command which is yet to fail (see
+		lastResult)."""
+		
+		return {"status": "ok", "bytes": 0, "error": None, "kind": None, "value": None}
+	
+	
+	def _print(self, *args, **kwargs):
+		"""Prints the given message, as print does, unless the client is
+		quiet."""
+		
+		if not self._quiet:
+			print(*args, **kwargs)
+	
+	
+	def _printFailure(self, message, kind="local"):
+		"""Prints the given failure message, and records it as the outcome of
+		the current command."""
+		
+		self._print(message)
+		self._recordFailure(message, kind)
+	
+	
+	def _recordFailure(self, message, kind):
+		"""Marks the current command as failed with the given message (without
+		its "FAILURE:" prefix) and kind of failure. Failures in the background
+		threads (the pool's, and the watches') are not the command's, and so
+		are ignored."""
+		
+		if self._result is None or threading.current_thread() is not self._commandThread:
+			return
+		self._result["status"] = "error"
+		if self._result["error"] is None:
+			self._result["error"] = re.sub(r"^((CLIENT )?FAILURE|Error): ", "", message)
+			self._result["kind"] = kind
+	
+	
+	def _recordTransfer(self, numBytes):
+		"""Adds numBytes of file data to the total transferred by the current
+		command."""
+		
+		if self._result is not None and threading.current_thread() is self._commandThread:
+			self._result["bytes"] += numBytes
+	
+	
+	def _recordValue(self, value):
+		"""Records the value retrieved by the current command (see
+		lastResult)."""
+		
+		if self._result is not None and threading.current_thread() is self._commandThread:
+			self._result["value"] = value
 		
 		
 	def _isSocketClosed(self, lastMsg):
@@ -140,88 +414,453 @@ class SimpleFTPClientInterpreter(ClientConnectionInterpreter):
 		finished, and returns True. Returns False otherwise."""
 		
 		if not lastMsg:
-			print("Server unexpectedly disconnected. (Socket EOF reached.)")
+			self._printFailure("Server unexpectedly disconnected. (Socket EOF reached.)",
+					kind="connection")
 			self._isFinished = True
 			return True
 		return False
 		
 	
+	def _cacheDownload(self, fileName, fileSize):
+		"""Adds the just downloaded file (of fileSize bytes) to the download
+		cache, if enabled, using the size and modification time the server
+		gave for it beforehand (see _preflight_GET)."""
+		
+		if not self._downloads or not self._validated or self._validated[0] != fileName:
+			return
+		(remoteName, remoteSize, remoteTime) = self._validated
+		self._validated = None
+		if remoteSize != fileSize:
+			return # Changed in the meantime.
+		try:
+			self._downloads.store("{host}:{port}".format(host=self._remoteAddr[0],
+					port=self._remoteAddr[1]), remoteName, fileName, remoteSize, remoteTime)
+		except OSError as err:
+			debugPrint("CLIENT: Cannot add {name} to the download cache: {err}".format(
+					name=fileName, err=err))
+		
+		
+	def _describeStat(self, fileName, getStat):
+		"""Returns a readable description of the named file, given the match
+		object of its description (see STAT_DESCRIPTION) from the server."""
+		
+		if getStat.group("type") == "NONE":
+			return "{name}: Does not exist.".format(name=fileName)
+		size = int(getStat.group("size"))
+		description = "{name}: {type}, {size} byte{s}, modified {mtime}".format(
+				name=fileName, type=getStat.group("type").lower(), size=size,
+				s=("s" if size != 1 else ""),
+				mtime=datetime.fromtimestamp(int(getStat.group("mtime")) / 1e9))
+		if getStat.group("digest") and getStat.group("digest") != "-":
+			description += ", SHA-256 {digest}".format(digest=getStat.group("digest"))
+		return description + "."
+		
+	
+	def _statValue(self, fileName, getStat):
+		"""Returns the description of the named file, given as for
+		_describeStat, as a dictionary of its "name", "type" ("file",
+		"directory", "link", "other", or "none" if it does not exist), "size"
+		(bytes), "mtime" (nanoseconds since the epoch) and "digest" (hex
+		SHA-256, or None if not asked for or unreadable)."""
+		
+		digest = getStat.group("digest")
+		return {"name": fileName, "type": getStat.group("type").lower(),
+				"size": int(getStat.group("size")), "mtime": int(getStat.group("mtime")),
+				"digest": (digest if digest and digest != "-" else None)}
+		
+	
+	def _compareDigest(self, fileName, digest):
+		"""Compares the named local file with the given (hex SHA-256) digest of
+		the remote file's contents, and returns the result as a string."""
+		
+		if digest == "-":
+			return "unreadable on the server"
+		try:
+			with open(fileName, "rb") as localFile:
+				localDigest = hashlib.file_digest(localFile, "sha256").hexdigest()
+		except FileNotFoundError:
+			return "missing locally"
+		except OSError:
+			return "unreadable locally"
+		return "same" if localDigest == digest else "different"
+		
+	
+	def _connectPassive(self, port):
+		"""Connects to the given (passive mode) data port on the server (or,
+		over a Unix domain socket, the data socket with that ID). Returns the
+		connected socket (secured, if the control connection is over TLS), or
+		None on error."""
+		
+		if self._unixPath:
+			dataSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			dataAddr = dataSocketPath(self._unixPath, port)
+		else:
+			dataSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			dataAddr = (self._remoteAddr[0], port)
+		try:
+			dataSock.connect(dataAddr)
+			dataSock = self._secureDataConnection(dataSock)
+		except socket.error as err:
+			self._debugFailure("CLIENT FAILURE: Socket error: {errmsg}".format(errmsg=err),
+					kind="connection")
+			dataSock.close()
+			return None
+		return dataSock
+		
+		
+	def _secureDataConnection(self, dataSock):
+		"""Returns the given newly-connected data socket wrapped in TLS, after
+		the handshake (resuming the control connection's TLS session, where
+		the server allows), if the control connection is over TLS; otherwise,
+		the socket itself."""
+		
+		if not self._tlsSocket:
+			return dataSock
+		dataSock = wrapDataSocket(self._tlsSocket, dataSock)
+		debugPrint("CLIENT: Data connection secured ({how}).".format(
+				how="resumed session" if dataSock.session_reused else "full handshake"))
+		return dataSock
+		
+		
+	def _copyFromDescriptor(self, fileName, fileFD, fileSize):
+		"""Stores the first fileSize bytes of the file open as fileFD (passed by
+		the server, for GET) as the named local file, then closes fileFD."""
+		
+		try:
+			with Timer() as xferTime:
+				with open(fileName, "wb") as outFile:
+					numBytesWritten = copyData(fileFD, outFile.fileno(), fileSize)
+		except (PermissionError, IOError):
+			self._printFailure("FAILURE: Cannot write to file.")
+		else:
+			if numBytesWritten < fileSize:
+				self._printFailure("FAILURE: Incomplete file data written.", kind="connection")
+			else:
+				self._recordTransfer(fileSize)
+				self._print("SUCCESS: {name} ({size} byte{s}) retrieved in {secs} seconds.".format(
+						name=fileName, size=fileSize, secs=xferTime.elapsedTime(),
+						s=("s" if fileSize > 1 else "")))
+				self._cacheDownload(fileName, fileSize)
+		finally:
+			os.close(fileFD)
+
+
+	def _checkPool(self):
+		"""Health-checks the idle connections in the pool, dropping (at both
+		ends) any which the server has closed or which are otherwise no longer
+		usable. An idle data connection should never be readable, so any which
+		is has either been closed or has stray data on it. (Except that over
+		TLS, it may have been sent session tickets; those are read here.)"""
+		
+		sockets = [dataSock for (dataID, dataSock) in self._pool
+				if not isinstance(dataSock, MuxChannel)]
+		(readable, writable, broken) = select.select(sockets, [], sockets, 0)
+		readable = [dataSock for dataSock in readable
+				if not isinstance(dataSock, ssl.SSLSocket) or hasApplicationData(dataSock)]
+		for (dataID, dataSock) in list(self._pool):
+			if dataSock in readable or dataSock in broken:
+				debugPrint("CLIENT: Dropping broken pooled data connection {id}.".format(id=dataID))
+				self._pool.remove((dataID, dataSock))
+				dataSock.close()
+				sendStr(self._connSock, "DATA DROP {id}\n".format(id=dataID))
+				result = recvLine(self._connSock)
+				if not self._isError(result) and result != "OK DROPPED {id}".format(id=dataID):
+					if not self._isSocketClosed(result):
+						self._debugFailure("CLIENT FAILURE: Malformed DATA DROP reply from server.")
+		
+		
+	def _refillPool(self):
+		"""The body of the _poolThread: Keeps the pool filled with healthy
+		data connections until the client is finished. It is woken early
+		whenever a pooled connection is taken."""
+		
+		while not self._isFinished:
+			self._poolWakeup.clear()
+			with self._ctrlLock:
+				if self._isFinished:
+					break
+				self._checkPool()
+				while len(self._pool) < self._config["pool_size"] and not self._isFinished:
+					dataConn = self._negotiateDataConnection()
+					if not dataConn:
+						break
+					self._pool.append(dataConn)
+			self._poolWakeup.wait(self.POOL_CHECK_INTERVAL)
+		
+		
+	def _printWatchEvents(self, watchID, dataSock):
+		"""The body of a watch's thread: Prints the events received on its
+		data connection, until the server closes it."""
+		
+		dataSock.settimeout(None) # Events may be a long time coming.
+		try:
+			while True:
+				event = recvLine(dataSock)
+				if not event:
+					break
+				# (As one write, so that lines from several watches do not mix.)
+				self._print("WATCH {id}: {event}\n".format(id=watchID, event=event), end="")
+		except OSError:
+			pass
+		dataSock.close()
+		if self._watches.pop(watchID, None) and not self._isFinished:
+			self._print("WATCH {id}: Ended by the server.\n".format(id=watchID), end="")
+		
+		
+	def _receiveFollowed(self, watchID, dataSock, outFD):
+		"""The body of a FOLLOW's thread: Writes the data received on its data
+		connection into the local file (open as outFD), until the server
+		closes it."""
+		
+		dataSock.settimeout(None) # Data may be a long time coming.
+		try:
+			while True:
+				header = recvLine(dataSock)
+				getData = re.match(r"^DATA (?P<offset>\d+) (?P<length>\d+)$", header)
+				if getData:
+					data = recvAll(dataSock, int(getData.group("length")))
+					os.pwrite(outFD, data, int(getData.group("offset")))
+					if len(data) < int(getData.group("length")):
+						break
+				elif header in ("TRUNCATED", "ROTATED"):
+					os.ftruncate(outFD, 0)
+					self._print("WATCH {id}: The file was {what} on the server; starting "
+							"over.\n".format(id=watchID, what=header.lower()), end="")
+				else:
+					if header:
+						self._debugFailure("CLIENT FAILURE: Malformed FOLLOW data from server.")
+					break
+		except OSError as err:
+			debugPrint("CLIENT: FOLLOW {id} failed: {err}".format(id=watchID, err=err))
+		os.close(outFD)
+		dataSock.close()
+		if self._watches.pop(watchID, None) and not self._isFinished:
+			self._print("WATCH {id}: Ended by the server.\n".format(id=watchID), end="")
+
+
+	def _requestDescriptor(self, fileName):
+		"""Sends a GETFD request for the named file, for the server to pass an
+		open file descriptor of it. Returns a tuple of that descriptor and the
+		file's size; or None on error. If the server cannot pass descriptors
+		on this connection, FD passing is disabled and False is returned
+		instead, so that the file can be streamed as usual."""
+		
+		sendStr(self._connSock, "GETFD {name}\n".format(name=fileName))
+		# The descriptor arrives with the first byte of the reply.
+		(data, fds, flags, addr) = socket.recv_fds(self._connSock, 1, 1)
+		result = data.decode() + recvLine(self._connSock) if data else ""
+		getFD = re.match(r"^OK FD (?P<size>\d+)$", result)
+		if getFD and fds:
+			return (fds[0], int(getFD.group("size")))
+		for fileFD in fds:
+			os.close(fileFD)
+		if result in ("ERR FD PASSING UNAVAILABLE", "ERR BAD REQUEST"):
+			debugPrint("CLIENT: The server cannot pass file descriptors; streaming instead.")
+			self._config["fd_passing"] = False
+			return False
+		if not self._isError(result) and not self._isSocketClosed(result):
+			self._debugFailure("CLIENT FAILURE: Malformed GETFD reply from server.")
+		return None
+		
+		
+	def _requestTransfer(self, request):
+		"""Sends a GET or PUT request (given without its newline), then waits
+		until the server is ready to transfer the file. If there is no data
+		connection (see _needsDataConnection), the fast-path form of the
+		request (PGET or PPUT) is sent instead, and the data connection it
+		offers is opened. Returns a tuple of the data socket to use and the
+		file size given by the server; or None on error."""
+		
+		fastPath = not self._dataSock
+		if fastPath:
+			request = "P" + request
+		sendStr(self._connSock, request + "\n")
+		result = recvLine(self._connSock)
+		if self._isError(result):
+			return None
+		
+		if fastPath:
+			getReady = re.match(r"^READY (?P<port>\d+) (?P<size>\d+)$", result)
+		else:
+			getReady = re.match(r"^READY (?P<size>\d+)$", result)
+		if not getReady:
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed {cmd} reply from server.".format(
+						cmd=request.split()[0]))
+			return None
+		
+		fileSize = int(getReady.group("size"))
+		if not fastPath:
+			return (self._dataSock, fileSize)
+		dataSock = self._connectPassive(int(getReady.group("port")))
+		if not dataSock:
+			# The server replies with an error once it gives up waiting.
+			self._isError(recvLine(self._connSock))
+			return None
+		return (dataSock, fileSize)
+		
+		
+	def _needsDataConnection(self, matchObj):
+		"""Decides whether a GET or PUT command needs a data connection set up
+		beforehand. In passive mode, unless there is already a (persistent)
+		data connection, it doesn't: the PGET and PPUT requests set one up
+		within the same exchange."""
+		
+		return not (self._config["passive"] and not self._mux and not self._dataSock
+				and not self._pool)
+		
+		
+	def _needsGetDataConnection(self, matchObj):
+		"""Like _needsDataConnection, for GET and GETF commands; which need no
+		data connection if the file can be passed as a descriptor instead (see
+		_requestDescriptor)."""
+		
+		if self._config["fd_passing"] and not self._mux:
+			return False
+		return self._needsDataConnection(matchObj)
+		
+		
 	def _openDataConnection(self):
-		"""Opens a data connection to the server. The existing data connection
-		(if any) is closed."""
+		"""Opens a data connection to the server, or takes the oldest one from
+		the pool if there are any. The existing data connection (if any) is
+		closed."""
 		
 		if self._dataSock:
 			self._dataSock.close()
 			self._dataSock = None
-			
-		if self._config["passive"]:
+		
+		if self._pool:
+			# The server likewise uses the oldest connection in its pool.
+			(dataID, self._dataSock) = self._pool.pop(0)
+			self._poolWakeup.set()
+			return True
+		
+		dataConn = self._negotiateDataConnection()
+		if not dataConn:
+			return False
+		(dataID, self._dataSock) = dataConn
+		return True
+		
+		
+	def _negotiateDataConnection(self):
+		"""Sets up a new data connection with the server, using the DATA
+		command. Returns a tuple of the connection's ID (its port number, or
+		channel ID if multiplexing) and the connected socket; or None on
+		error."""
+		
+		if self._mux:
+			channelID = self._nextChannel
+			self._nextChannel += 1
+			sendStr(self._connSock, "DATA CHANNEL {id}\n".format(id=channelID))
+			result = recvLine(self._connSock)
+			if self._isError(result):
+				return None
+			elif result != "OK CHANNEL {id}".format(id=channelID):
+				if not self._isSocketClosed(result):
+					self._debugFailure("CLIENT FAILURE: Malformed DATA reply from server. 4")
+				return None
+			return (channelID, self._mux.channel(channelID))
+
+		elif self._config["passive"]:
 			sendStr(self._connSock, "DATA\n")
 			result = recvLine(self._connSock).rstrip()
-			if isError(result):
-				return False
+			if self._isError(result):
+				return None
 			
 			getPort = re.match(r"^READY (?P<port>\d+)$", result)
 			if not getPort:
 				if not self._isSocketClosed(result):
-					debugPrint("CLIENT FAILURE: Malformed DATA reply from server. 2")
-				return False
+					self._debugFailure("CLIENT FAILURE: Malformed DATA reply from server. 2")
+				return None
 			
 			port = int(getPort.group("port"))
-			try:
-				self._dataSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-				self._dataSock.connect((self._remoteAddr[0], port))
-			except socket.error as err:
-				debugPrint("CLIENT FAILURE: Socket error: {errmsg}".format(errmsg=err))
-				self._dataSock = None
-				return False
+			dataSock = self._connectPassive(port)
+			if not dataSock:
+				return None
 			else:
 				result = recvLine(self._connSock).rstrip()
-				if isError(result):
-					self._dataSock = None
-					return False
-				elif result == "OK {port}".format(port=port):
-					return True
-				else:
-					if not self._isSocketClosed(result):
-						debugPrint("CLIENT FAILURE: Malformed DATA reply from server. 3")
-					self._dataSock = None
-					return False
+				if result == "OK {port}".format(port=port):
+					return (port, dataSock)
+				elif not self._isError(result) and not self._isSocketClosed(result):
+					self._debugFailure("CLIENT FAILURE: Malformed DATA reply from server. 3")
+				dataSock.close()
+				return None
 		
 		else: # Not passive
 			dataConn = None
+			dataPath = None
 			try:
-				dataConn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-				dataConn.bind(("", 0))
+				if self._unixPath:
+					# Listen at a free path beside the server's socket, and
+					# accept only the server's user there. (Its process may
+					# be a forked child of the one which listened.)
+					dataConn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+					while True:
+						dataPort = random.randrange(1, 2**31)
+						try:
+							dataConn.bind(dataSocketPath(self._unixPath, dataPort))
+						except OSError as err:
+							if err.errno != errno.EADDRINUSE:
+								raise
+						else:
+							dataPath = dataSocketPath(self._unixPath, dataPort)
+							break
+					serverCreds = unixPeerCredentials(self._connSock)
+				else:
+					dataConn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+					dataConn.bind(("", 0))
+					dataPort = dataConn.getsockname()[1]
 				dataConn.settimeout(60)
 				dataConn.listen(1)
-				dataPort = dataConn.getsockname()[1]
 				sendStr(self._connSock, "DATA {p}\n".format(p=dataPort))
 				while True:	
 					(serverDataSock, serverAddr) = dataConn.accept()
-					if serverAddr[0] == self._remoteAddr[0]:
+					if self._unixPath:
+						dataCreds = unixPeerCredentials(serverDataSock)
+						isServer = not serverCreds or dataCreds[1] == serverCreds[1]
+					else:
+						isServer = serverAddr[0] == self._remoteAddr[0]
+					if isServer:
+						try:
+							serverDataSock = self._secureDataConnection(serverDataSock)
+						except OSError as err:
+							self._debugFailure("CLIENT FAILURE: TLS handshake failed: {err}".format(
+									err=err), kind="connection")
+							serverDataSock.close()
+							self._isError(recvLine(self._connSock))
+							return None
 						result = recvLine(self._connSock).rstrip()
 						if result == "OK {port}".format(port=dataPort):
-							self._dataSock = serverDataSock
-							return True
+							return (dataPort, serverDataSock)
 						else:
 							if not self._isSocketClosed(result):
-								debugPrint("CLIENT FAILURE: Malformed DATA reply from server. 1")
-							self._dataSock = None
+								self._debugFailure(
+										"CLIENT FAILURE: Malformed DATA reply from server. 1")
 							serverDataSock.close()
-							return False
+							return None
 					else:
 						serverDataSock.close()						
 			except socket.timeout as err:
-				return False
+				return None
+			finally:
+				if dataConn:
+					dataConn.close()
+				if dataPath:
+					os.unlink(dataPath)
 			
 		
-	def registerCommandHandler(self, regex, handlerFunc, needData, *args, **kwargs):
+	def registerCommandHandler(self, regex, handlerFunc, needData, *args, preflight=None,
+			**kwargs):
 		"""Register handlerFunc with the connection so that if a client command
 		matches the given regex, that function is called with its appropriate
 		re.match object and any other arguments. The needData flag denotes if
-		the handler function needs a data connection. Attempting to add a regex
-		which is already matched by an existing rule will fail with an error
-		message."""
+		the handler function needs a data connection. (It may instead be a
+		function, which is called with the re.match object to decide.) If a
+		preflight function is given, it is called first with the same
+		arguments as handlerFunc, and the command is abandoned (before any
+		data connection is set up) unless it returns True. Attempting to add
+		a regex which is already matched by an existing rule will fail with an
+		error message."""
 		
 		for handler in self._commandHandlers.keys():
 			if re.match("^"+handler+"$", regex):
@@ -229,72 +868,436 @@ class SimpleFTPClientInterpreter(ClientConnectionInterpreter):
 						rule=regex, old=handler))
 				break
 		else:
-			self._commandHandlers[regex] = (handlerFunc, needData, args, kwargs)
+			self._commandHandlers[regex] = (handlerFunc, needData, preflight, args, kwargs)
+
+			
+	###
+	# Preflight checks...
+	###
+	def _preflight_GET(self, matchObj, overwriteFlag):
+		"""Preflight check for GET command: Checks that the file can be stored
+		locally, and (if a new data connection would be needed for it, or
+		the download cache is enabled) that the remote file exists. If the
+		local file (for GETF), or the cached copy, is known to match the
+		remote file, the command is instead finished here, with no data
+		connection."""
+		
+		fileName = matchObj.group("filename")
+		if isdir(fileName):
+			self._printFailure("FAILURE: A directory with that name already exists.")
+			return False
+		if isfile(fileName) and not overwriteFlag:
+			self._printFailure("FAILURE: That file already exists.")
+			return False
+		
+		server = "{host}:{port}".format(host=self._remoteAddr[0], port=self._remoteAddr[1])
+		self._validated = None
+		cached = self._downloads.lookup(server, fileName) if self._downloads else None
+		digest = None
+		if not cached and isfile(fileName):
+			try:
+				with open(fileName, "rb") as localFile:
+					digest = hashlib.file_digest(localFile, "sha256").hexdigest()
+			except OSError:
+				pass
+		if cached:
+			request = "GETIF {size} {mtime} {name}".format(size=cached[1], mtime=cached[2],
+					name=fileName)
+		elif digest:
+			request = "GETIF HASH {digest} {name}".format(digest=digest, name=fileName)
+		elif self._downloads or (self._needsGetDataConnection(matchObj) and not self._dataSock
+				and not self._pool):
+			# Check the remote file before setting up a data connection for it.
+			request = "STAT {name}".format(name=fileName)
+		else:
+			return True
+		with self._ctrlLock:
+			sendStr(self._connSock, request + "\n")
+			result = recvLine(self._connSock)
+		if self._isError(result):
+			return False
+		
+		if result == "NOT MODIFIED" and cached:
+			try:
+				fileSize = self._downloads.restore(server, fileName, fileName)
+			except (PermissionError, IOError):
+				self._printFailure("FAILURE: Cannot write to file.")
+				return False
+			self._recordTransfer(fileSize)
+			self._print("SUCCESS: {name} ({size} byte{s}) is unchanged; copied from the "
+					"cache.".format(name=fileName, size=fileSize, s=("s" if fileSize != 1 else "")))
+			return False
+		elif result == "NOT MODIFIED" and request.startswith("GETIF"):
+			self._print("SUCCESS: {name} is already up to date.".format(name=fileName))
+			return False
+		getStat = (re.match(r"^MODIFIED (?P<size>\d+) (?P<mtime>\d+)$", result) or
+				re.match("^OK " + self.STAT_DESCRIPTION + "$", result))
+		if not getStat:
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed {cmd} reply from server.".format(
+						cmd=request.split()[0]))
+			return False
+		elif getStat.groupdict().get("type", "FILE") != "FILE":
+			self._printFailure("FAILURE: That is not a file on the server.", kind="remote")
+			return False
+		# Kept for the download cache; from before the transfer, so that a
+		# change during it is caught by the next GETIF.
+		self._validated = (fileName, int(getStat.group("size")), int(getStat.group("mtime")))
+		return True
+		
+		
+	def _preflight_GETTREE(self, matchObj):
+		"""Preflight check for GETTREE command: Checks that the directory tree
+		can be stored locally."""
+		
+		if exists(matchObj.group("dirname")):
+			self._printFailure("FAILURE: A file or directory with that name already exists.")
+			return False
+		return True
+		
+		
+	def _preflight_PUT(self, matchObj):
+		"""Preflight check for PUT command: Checks that the local file can be
+		uploaded."""
+		
+		fileName = matchObj.group("filename")
+		if isdir(fileName):
+			self._printFailure("FAILURE: Cannot upload a directory.")
+			return False
+		elif not isfile(fileName):
+			self._printFailure("FAILURE: The file does not exist.")
+			return False
+		return True
+
+
+	def _preflight_PUTTREE(self, matchObj):
+		"""Preflight check for PUTTREE command: Checks that the local directory
+		tree can be uploaded."""
+		
+		if not isdir(matchObj.group("dirname")):
+			self._printFailure("FAILURE: The directory does not exist.")
+			return False
+		return True
 
 			
 	###
 	# Command handlers...
 	###
+	def _preflight_WATCH(self, matchObj):
+		"""Preflight check for WATCH and FOLLOW commands: Checks that the watch
+		can have a data connection of its own."""
+		
+		if self._mux:
+			# (Its data would have to be read by the same thread as replies.)
+			self._printFailure("FAILURE: WATCH and FOLLOW cannot be used in multiplexed mode; "
+					"use MUX NO first.")
+			return False
+		return True
+
+
+	def _command_CACHE(self, matchObj):
+		"""Handler for the CACHE command: Enables (with the given directory) or
+		disables the download cache."""
+		
+		dirName = matchObj.group("dirname")
+		if dirName == "OFF":
+			self._downloads = None
+			self._print("Download cache disabled.")
+			return
+		try:
+			self._downloads = DownloadCache(dirName)
+		except OSError as err:
+			self._printFailure("FAILURE: Cannot use {name} as the download cache: {err}".format(
+					name=dirName, err=err))
+		else:
+			self._print("Download cache enabled in {name}.".format(name=dirName))
+
+
 	def _command_CHUNK(self, matchObj):
 		"""Handler for CHUNK command: sets the transfer chunk size (bytes)."""
 		
+		if matchObj.group("size") == "AUTO":
+			sendStr(self._connSock, "SETCONFIG CHUNKSIZE AUTO\n")
+			result = recvLine(self._connSock)
+			if result == "OK CHUNKSIZE AUTO":
+				if not self._tuner:
+					self._tuner = ChunkTuner(self._config["chunk_size"])
+				self._print("SUCCESS: Chunk size will now be tuned automatically.")
+			elif not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed CHUNK response from server.")
+			return
+
 		chunkSize = int(matchObj.group("size"))
 		if chunkSize < 1:
-			print("FAILURE: Chunk size must be positive!")
+			self._printFailure("FAILURE: Chunk size must be positive!")
 			return
 		sendStr(self._connSock, "SETCONFIG CHUNKSIZE {size}\n".format(size=chunkSize))
 		result = recvLine(self._connSock)
 		if result == "OK CHUNKSIZE {size}".format(size=chunkSize):
 			self._config["chunk_size"] = chunkSize
-			print("SUCCESS: Chunk size is now {size} byte{s}.".format(
+			self._tuner = None
+			self._print("SUCCESS: Chunk size is now {size} byte{s}.".format(
 					size=chunkSize, s=("s" if chunkSize > 1 else "")))
 		else:
 			if not self._isSocketClosed(result):
-				debugPrint("CLIENT FAILURE: Malformed CHUNK response from server.")
+				self._debugFailure("CLIENT FAILURE: Malformed CHUNK response from server.")
 		
 
-	def _command_GET(self, matchObj, overwriteFlag):
-		"""Handler for GET command: Downloads a file from the server."""
+	def _command_COPY(self, matchObj, verb):
+		"""Handler for COPY and MOVE commands (given as the verb): Copies or
+		moves a file on the server."""
 		
-		fileName = matchObj.group("filename")
+		(srcName, dstName) = matchObj.group("src", "dst")
+		sendStr(self._connSock, "{verb} {src} {dst}\n".format(verb=verb, src=srcName, dst=dstName))
+		result = recvLine(self._connSock)
+		if self._isError(result):
+			return
+		getSize = re.match(r"^OK (?P<size>\d+)$", result)
+		if not getSize:
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed {verb} reply from server.".format(
+						verb=verb))
+			return
+		size = int(getSize.group("size"))
+		self._recordValue(size)
+		self._print("SUCCESS: {src} ({size} byte{s}) {done} to {dst} on the server.".format(
+				src=srcName, dst=dstName, size=size, s=("s" if size != 1 else ""),
+				done=("copied" if verb == "COPY" else "moved")))
 		
-		if isdir(fileName):
-			print("FAILURE: A directory with that name already exists.")
+
+	def _command_FDPASS(self, matchObj):
+		"""Handler for FDPASS command: Enables or disables receiving downloads
+		as open file descriptors."""
+		
+		if matchObj.group("option") == "NO":
+			self._config["fd_passing"] = False
+			self._print("SUCCESS: Downloads will be streamed.")
+		elif self._connSock.family != socket.AF_UNIX or not hasattr(socket, "recv_fds"):
+			self._printFailure("FAILURE: File descriptors can only be passed over a Unix "
+					"domain socket.")
+		else:
+			self._config["fd_passing"] = True
+			self._print("SUCCESS: Downloads will be received as file descriptors, where possible.")
+
+
+	def _command_FIND(self, matchObj):
+		"""Handler for FIND command: Searches the tree on the server."""
+		
+		options = matchObj.group("options")
+		getNewer = re.search(r" NEWER (?P<time>\S+)", options)
+		if getNewer and not getNewer.group("time").isdigit():
+			# Given as a date (and time), rather than in nanoseconds.
+			try:
+				newer = datetime.fromisoformat(getNewer.group("time"))
+			except ValueError:
+				self._printFailure("FAILURE: Invalid time; give it as YYYY-MM-DD[THH:MM[:SS]].")
+				return
+			options = options.replace(getNewer.group(0),
+					" NEWER {ns}".format(ns=int(newer.timestamp() * 10**9)))
+		sendStr(self._connSock, "FIND {pattern}{options}\n".format(
+				pattern=matchObj.group("pattern"), options=options))
+		result = recvLine(self._connSock)
+		if self._isError(result):
 			return
-			
-		if isfile(fileName) and not overwriteFlag:
-			print("FAILURE: That file already exists.")
+		getLines = re.match(r"^OK (?P<lines>\d+)$", result)
+		if not getLines:
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed FIND reply from server.")
 			return
-			
-		sendStr(self._connSock, "GET {name}\n".format(name=fileName))
+		matches = []
+		for lineNum in range(int(getLines.group("lines"))):
+			result = recvLine(self._connSock)
+			getStat = re.match("^" + self.STAT_DESCRIPTION + r" (?P<name>.+)$", result)
+			if not getStat:
+				if not self._isSocketClosed(result):
+					self._debugFailure("CLIENT FAILURE: Malformed FIND reply from server.")
+				return
+			matches.append(self._statValue(getStat.group("name"), getStat))
+			self._print(self._describeStat(getStat.group("name"), getStat))
+		self._recordValue(matches)
+		self._print("{num} match{es}.".format(num=getLines.group("lines"),
+				es=("es" if getLines.group("lines") != "1" else "")))
+		
+
+	def _command_FOLLOW(self, matchObj):
+		"""Handler for FOLLOW command: Starts keeping the local copy of a file
+		up to date as it grows on the server."""
+		
+		fileName = matchObj.group("filename")
+		try:
+			outFD = os.open(fileName, os.O_WRONLY | os.O_CREAT, 0o666)
+			# Unless told otherwise, resume after what is already here.
+			offset = int(matchObj.group("offset") or os.fstat(outFD).st_size)
+		except OSError as err:
+			self._printFailure("FAILURE: Cannot write {name}: {err}".format(
+					name=fileName, err=err.strerror))
+			return
+		sendStr(self._connSock, "FOLLOW {offset} {name}\n".format(offset=offset, name=fileName))
 		result = recvLine(self._connSock)
-		if isError(result):
+		getID = re.match(r"^OK FOLLOWING (?P<id>\d+)$", result)
+		if not getID:
+			os.close(outFD)
+			if not self._isError(result) and not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed FOLLOW reply from server.")
 			return
+		# The data connection now belongs to the watch.
+		watchID = int(getID.group("id"))
+		(dataSock, self._dataSock) = (self._dataSock, None)
+		self._watches[watchID] = dataSock
+		os.ftruncate(outFD, offset)
+		threading.Thread(target=self._receiveFollowed, args=(watchID, dataSock, outFD),
+				daemon=True).start()
+		self._recordValue(watchID)
+		self._print("SUCCESS: Following {name} from byte {offset} (watch {id}); UNWATCH {id} to "
+				"stop.".format(name=fileName, offset=offset, id=watchID))
 
-		getSize = re.match("^READY (?P<size>\d+)$", result)
-		if not getSize:
-			if not self._isSocketClosed(result):
-				debugPrint("CLIENT FAILURE: Malformed GET reply from server.")
+
+	def _command_GET(self, matchObj, overwriteFlag):
+		"""Handler for GET command: Downloads a file from the server."""
+		
+		fileName = matchObj.group("filename")
+		if self._config["fd_passing"] and not self._mux:
+			received = self._requestDescriptor(fileName)
+			if received:
+				self._copyFromDescriptor(fileName, *received)
+				return
+			elif received is None:
+				return
+			elif (self._needsDataConnection(matchObj) and not self._dataSock
+					and not self._openDataConnection()):
+				self._debugFailure("CLIENT FAILURE: Could not establish data connection.",
+						kind="connection")
+				return
+		transfer = self._requestTransfer("GET {name}".format(name=fileName))
+		if not transfer:
 			return
-			
-		fileSize = int(getSize.group("size"))
+		(dataSock, fileSize) = transfer
 		chunkSize = self._config["chunk_size"]
 		try:
 			with Timer() as xferTime:
-				numBytesWritten = recvFile(self._dataSock, fileSize, fileName, "wb", chunkSize)
+				if self._config["sparse"]:
+					with open(fileName, "wb") as outFile:
+						numBytesWritten = recvSparseIntoFile(dataSock, fileSize, outFile,
+								chunkSize, tuner=self._tuner)
+				else:
+					numBytesWritten = recvFile(dataSock, fileSize, fileName, "wb", chunkSize,
+							tuner=self._tuner, queueDepth=self._config["queue_depth"])
 		except (PermissionError, IOError):
-			print("FAILURE: Cannot write to file.")
+			self._printFailure("FAILURE: Cannot write to file.")
 		else:
 			if numBytesWritten < fileSize:
-				print("FAILURE: Incomplete file data written.")
+				self._printFailure("FAILURE: Incomplete file data written.", kind="connection")
 			else:
 				isOK = recvLine(self._connSock)
 				if isOK == "OK {size}".format(size=numBytesWritten):
-					print("SUCCESS: {name} ({size} byte{s}) retrieved in {secs} seconds.".format(
-							name=fileName, size=fileSize, secs=xferTime.elapsedTime(), 
-							s=("s" if fileSize > 1 else "")))
+					self._recordTransfer(fileSize)
+					self._print("SUCCESS: {name} ({size} byte{s}) retrieved in {secs} "
+							"seconds.".format(name=fileName, size=fileSize,
+							secs=xferTime.elapsedTime(), s=("s" if fileSize > 1 else "")))
+					self._cacheDownload(fileName, fileSize)
 				elif not self._isSocketClosed(isOK):
-					print("CLIENT FAILURE: Malformed GET reply from server after transfer.")
+					self._printFailure("CLIENT FAILURE: Malformed GET reply from server after "
+							"transfer.", kind="protocol")
+		finally:
+			if dataSock is not self._dataSock:
+				dataSock.close()
+		
+
+	def _command_GETTREE(self, matchObj):
+		"""Handler for GETTREE command: Downloads a directory tree from the
+		server."""
+		
+		dirName = matchObj.group("dirname")
+		sendStr(self._connSock, "GETTREE{options} {name}\n".format(
+				options=matchObj.group("options"), name=dirName))
+		result = recvLine(self._connSock)
+		if self._isError(result):
+			return
+		elif result != "READY TREE":
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed GETTREE reply from server.")
+			return
+		try:
+			with Timer() as xferTime:
+				(numFiles, numBytes) = recvTree(self._dataSock, dirName)
+		except TreeStreamError as err:
+			# The server's reply says why, if it gave up.
+			if not self._isError(recvLine(self._connSock)):
+				self._printFailure("FAILURE: {reason}".format(reason=err), kind="protocol")
+		except (PermissionError, IOError):
+			self._printFailure("FAILURE: Cannot write to file.")
+			self._isError(recvLine(self._connSock))
+		else:
+			isOK = recvLine(self._connSock)
+			if isOK == "OK {files} {size}".format(files=numFiles, size=numBytes):
+				self._recordTransfer(numBytes)
+				self._recordValue(numFiles)
+				self._print("SUCCESS: {name} ({files} file{s}, {size} bytes) retrieved in {secs} "
+						"seconds.".format(
+						name=dirName, files=numFiles, size=numBytes, secs=xferTime.elapsedTime(),
+						s=("s" if numFiles != 1 else "")))
+			elif not self._isError(isOK) and not self._isSocketClosed(isOK):
+				self._printFailure("CLIENT FAILURE: Malformed GETTREE reply from server after "
+						"transfer.", kind="protocol")
+		
+
+	def _command_HASH(self, matchObj):
+		"""Handler for HASH command: Prints the digest of a file on the server,
+		and compares it with the local file."""
+		
+		fileName = matchObj.group("filename")
+		sendStr(self._connSock, "HASH {name}\n".format(name=fileName))
+		result = recvLine(self._connSock)
+		if self._isError(result):
+			return
+		getDigest = re.match(r"^OK (?P<digest>[0-9a-f]+)$", result)
+		if not getDigest:
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed HASH reply from server.")
+			return
+		digest = getDigest.group("digest")
+		match = self._compareDigest(fileName, digest)
+		self._recordValue({"name": fileName, "digest": digest, "match": match})
+		self._print("{digest}  {name} ({match})".format(digest=digest, name=fileName,
+				match=match))
+		
+
+	def _command_HASHDIR(self, matchObj):
+		"""Handler for HASHDIR command: Prints the digests of all of the files
+		under a directory on the server, and compares them with the local
+		files."""
+		
+		dirName = matchObj.group("dirname")
+		sendStr(self._connSock, "HASHDIR {name}\n".format(name=dirName))
+		result = recvLine(self._connSock)
+		if self._isError(result):
+			return
+		getLines = re.match(r"^OK (?P<lines>\d+)$", result)
+		if not getLines:
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed HASHDIR reply from server.")
+			return
+		counts = {}
+		digests = []
+		for lineNum in range(int(getLines.group("lines"))):
+			result = recvLine(self._connSock)
+			getDigest = re.match(r"^(?P<digest>[0-9a-f]+|-) (?P<name>.+)$", result)
+			if not getDigest:
+				if not self._isSocketClosed(result):
+					self._debugFailure("CLIENT FAILURE: Malformed HASHDIR reply from server.")
+				return
+			(digest, relPath) = getDigest.group("digest", "name")
+			match = self._compareDigest(join(dirName, relPath), digest)
+			counts[match] = counts.get(match, 0) + 1
+			digests.append({"name": relPath, "digest": (digest if digest != "-" else None),
+					"match": match})
+			self._print("{digest}  {name} ({match})".format(digest=digest, name=relPath,
+					match=match))
+		self._print("{total} file{s}: {counts}.".format(total=getLines.group("lines"),
+				s=("s" if getLines.group("lines") != "1" else ""),
+				counts=", ".join("{num} {match}".format(num=num, match=match)
+						for (match, num) in sorted(counts.items()))))
+		self._recordValue(digests)
 		
 
 	def _command_LS(self, matchObj):
@@ -303,34 +1306,38 @@ class SimpleFTPClientInterpreter(ClientConnectionInterpreter):
 		
 		sendStr(self._connSock, "LS\n")
 		result = recvLine(self._connSock)
-		if isError(result):
+		if self._isError(result):
 			return
 		
 		getSize = re.match(r"^OK (?P<size>\d+)$", result)
 		if not getSize:
 			if not self._isSocketClosed(result):
-				debugPrint("CLIENT FAILURE: Malformed LS reply from server.")
+				self._debugFailure("CLIENT FAILURE: Malformed LS reply from server.")
 			return
 		
 		numBytes = int(getSize.group("size"))
 		listing = recvAll(self._dataSock, numBytes).decode()
 		if len(listing) < numBytes:
 			if not self._isSocketClosed(listing):
-				debugPrint("CLIENT FAILURE: Incomplete reply from server.")
+				self._debugFailure("CLIENT FAILURE: Incomplete reply from server.",
+						kind="connection")
 			return
+		self._recordTransfer(numBytes)
 
 		theList = [fileLine.split(maxsplit=1) for fileLine in listing.splitlines()]
 		dirs = [entry[1] for entry in theList if entry[0] == "DIR"]
 		files = [entry for entry in theList if entry[0] != "DIR"]
+		self._recordValue([{"name": name, "type": "directory", "size": None} for name in dirs] +
+				[{"name": name, "type": "file", "size": int(size)} for (size, name) in files])
 
 		# Get the maximum field width of the file sizes, for alignment when printing.
-		maxSizeWidth = len(max(next(zip(*files)), key=len))
-		print("Directories:")
+		maxSizeWidth = max((len(size) for (size, name) in files), default=0)
+		self._print("Directories:")
 		for name in dirs:
-			print(" "*maxSizeWidth, name)
-		print("Files:")
+			self._print(" "*maxSizeWidth, name)
+		self._print("Files:")
 		for (size, name) in files:
-			print("{{fsize: >{width}}} {{fname}}".format(width=maxSizeWidth).format(
+			self._print("{{fsize: >{width}}} {{fname}}".format(width=maxSizeWidth).format(
 					fsize=("" if size == "DIR" else size), fname=name))
 	
 	
@@ -338,47 +1345,179 @@ class SimpleFTPClientInterpreter(ClientConnectionInterpreter):
 		"""Handler for HELP command: Gives brief user documentation."""
 		
 		helpStrings = {
-				"CHUNK": "Usage: CHUNK <integer>\nSets the chunk size for transferring files. A "
-						"reasonably large power of 2, like 65536, is recommended. A smaller chunk "
-						"size will result in less blocking (since the wait for recv() to return is"
-						" shorter) at the expense of smaller and more frequent disk I/O, which "
-						"could cause a decrease in transfer performance.",
+				"CACHE": "Usage: CACHE <dirname> or CACHE OFF\nKeeps a copy of each file "
+						"downloaded with GET in the given local directory (with an index of "
+						"their remote sizes and modification times), or stops doing so. A GET "
+						"of a file which is cached then only asks the server whether it has "
+						"changed, and if not, copies the cached file instead of downloading "
+						"it again.",
+				"CHUNK": "Usage: CHUNK <integer> or CHUNK AUTO\nSets the chunk size for "
+						"transferring files. A reasonably large power of 2, like 65536, is "
+						"recommended. A smaller chunk size will result in less blocking (since the"
+						" wait for recv() to return is shorter) at the expense of smaller and more"
+						" frequent disk I/O, which could cause a decrease in transfer performance."
+						" With AUTO, both sides measure the throughput of each transfer while it "
+						"runs, and grow or shrink the chunk size (and socket buffers) to suit.",
+				"COPY": "Usage: COPY <source> <destination>\nCopies the named file to the "
+						"destination on the remote system, without transferring it over the "
+						"network (so even a large file is copied quickly, and on some file "
+						"systems without using any more disk space). An existing destination is "
+						"treated as for PUT. File names containing spaces are not supported.",
+				"FDPASS": "Usage: FDPASS YES or FDPASS NO\nEnables or disables receiving "
+						"downloaded files as open file descriptors, which the client then copies "
+						"from directly (within the kernel, where possible), instead of having "
+						"their contents sent. This is only possible when connected to the "
+						"server by a Unix domain socket, and is enabled by default then; GET "
+						"falls back to streaming the file if the server cannot pass it (such as "
+						"when MUX is enabled, or a rate limit applies).",
+				"FIND": "Usage: FIND <glob> [MINSIZE <size>] [MAXSIZE <size>] [NEWER <time>] "
+						"[LIMIT <count>]\nSearches the whole tree on the remote system for "
+						"files and directories whose names (or paths, if the glob contains a "
+						"\"/\") match the glob, and optionally are at least or at most the "
+						"given size (in bytes), or were modified after the given time "
+						"(YYYY-MM-DD[THH:MM[:SS]], or nanoseconds since the epoch). At most "
+						"<count> matches (by default, 1000) are printed. The server answers "
+						"from its index of the tree, which may lag behind changes made by "
+						"other programs.",
+				"FOLLOW": "Usage: FOLLOW [<offset>] <filename>\nDownloads the named file "
+						"from the given byte offset (by default, the size of the local copy, "
+						"if any), then keeps downloading whatever is appended to it, in the "
+						"background, until UNWATCH. If the remote file is truncated or "
+						"replaced (as when a log is rotated), the local copy starts over. "
+						"Like WATCH, it uses a data connection of its own.",
 				"GET":	"Usage: GET <filename>\nAttempts to download the named file from the "
 						"remote system and save it locally, under the same file name. An error is "
 						"displayed if this operation does not succeed.",
 				"GETF": "Usage: GETF <filename>\nAttempts to download the named file, exactly like"
 						" GET, except that GETF will forcibly overwrite the file of that name if "
-						"it already exists on the client system.",
+						"it already exists on the client system. (If that file's contents are "
+						"identical to the remote file's, it is left as it is.)",
+				"GETTREE": "Usage: GETTREE [COMPRESS] [INCLUDE <glob>]... [EXCLUDE <glob>]... "
+						"<dirname>\nDownloads the named directory, and everything under it, "
+						"from the remote system as a single tar stream, extracting it as it "
+						"arrives. Entries matching an EXCLUDE glob are skipped; if any INCLUDE "
+						"globs are given, only the files matching one are retrieved. COMPRESS "
+						"has the server compress the stream. The directory must not already "
+						"exist locally.",
+				"HASH": "Usage: HASH <filename>\nPrints the SHA-256 digest of the named file "
+						"on the remote system, without transferring it, and whether the local "
+						"file of the same name has the same contents.",
+				"HASHDIR": "Usage: HASHDIR <dirname>\nLike HASH, but for every file under the "
+						"named directory (compared with the files under the local directory "
+						"of the same name), followed by a summary.",
 				"HELP":	"Usage: HELP or HELP <command>\nShow the list of commands, or help for a "
 						"specific command.",
 				"LS":	"Usage: LS\nPrints a listing of files and directories on the remote "
 						"system. For files, the sizes (in bytes) are also given.",
+				"MOVE": "Usage: MOVE <source> <destination>\nMoves (renames) the named file to "
+						"the destination on the remote system, without transferring it over the "
+						"network. An existing destination is treated as for PUT. File names "
+						"containing spaces are not supported.",
+				"MUX": "Usage: MUX YES or MUX NO\nEnables or disables the multiplexed transport. "
+						"Normally each transfer needs its own data connection on an ephemeral "
+						"port. With this enabled, data is instead sent in frames tagged with a "
+						"channel number over the existing control connection, so no extra "
+						"connections (or firewall holes) are needed.",
 				"PASV": "Usage: PASV YES or PASV NO\nEnables or disables passive data transfer "
 						"mode. Normally when a data transfer is required, the server will attempt "
 						"to connect to the client through an ephemeral port; but this can be "
 						"problematic in client systems behind a NAT or firewall setup. Instead of "
 						"this, passive mode causes the client to initiate connection requests, "
-						"which works around these issues.",
+						"which works around these issues. In passive mode, GET and PUT also set "
+						"up their data connections within the request itself (unless one is "
+						"already open), which saves a round trip or two.",
 				"PERSIST": "Usage: PERSIST YES or PERSIST NO\nEnables or disables a persistent "
 						"data connection. Normally, a separate data connection is established and "
 						"later torn down for each server request which requires it. But with this"
 						" enabled, only one data connection will be made, and reused for any "
 						"subsequent requests.",
+				"POOL": "Usage: POOL <integer>\nKeeps the given number of idle data connections "
+						"open and ready, so that GET, PUT and LS can start right away instead of "
+						"first setting one up. The pool is refilled, and its connections checked,"
+						" in the background. POOL 0 closes them all.",
 				"PUT":	"Usage: PUT <filename>\nAttempts to store the local named file on the "
 						"remote system under the same file name. An error is display if this "
 						"operation does not succeed.",
-				"QUIT": "Usage: EXIT\nExit this client."
+				"PUTTREE": "Usage: PUTTREE [COMPRESS] [INCLUDE <glob>]... [EXCLUDE <glob>]... "
+						"<dirname>\nUploads the local named directory, and everything under "
+						"it, to the remote system as a single tar stream. The globs and "
+						"COMPRESS are as for GETTREE. The directory must not already exist on "
+						"the remote system.",
+				"QUEUE": "Usage: QUEUE <integer>\nOverlaps disk and network I/O in GET and PUT"
+						" transfers, on both the client and the server: one thread reads the "
+						"file (or receives the data) while another sends (or writes) the chunks "
+						"before it, with at most the given number of chunks waiting in between. "
+						"QUEUE 0 turns this off, so that each chunk is read and then sent in turn.",
+				"QUIT": "Usage: EXIT\nExit this client.",
+				"RATE": "Usage: RATE <integer>\nSets the maximum transfer rate (bytes per second) "
+						"of GET and PUT requests on this connection, or 0 for no limit. The server"
+						" may have its own per-connection limit, which this can lower but never "
+						"raise; the limit actually in effect is printed.",
+				"SPARSE": "Usage: SPARSE YES or SPARSE NO\nEnables or disables sparse file "
+						"transfers. With this enabled, GET and PUT send only the parts of a file "
+						"which hold data, skipping its holes (such as the unused space in a "
+						"virtual machine's disk image), and the copy is made sparse in the same "
+						"way. A file which is mostly holes then takes only as long to transfer as "
+						"its data.",
+				"STAT": "Usage: STAT <filename> or STAT HASH <filename>\nPrints the type "
+						"(file, directory or other), size and modification time of the named "
+						"file on the remote system, without transferring it. With HASH, the "
+						"SHA-256 digest of its contents is also given.",
+				"STATM": "Usage: STATM [HASH] <filename> [<filename>]...\nLike STAT, but for "
+						"any number of files at once. (The file names may not contain "
+						"spaces.)",
+				"STATS": "Usage: STATS\nPrints the server-wide state, such as the global and "
+						"per-connection rate limits, the number of active transfers, and the "
+						"bandwidth currently allocated to each of them.",
+				"UNWATCH": "Usage: UNWATCH [<id>]\nStops the given watch (see WATCH and "
+						"FOLLOW), or all of them.",
+				"WATCH": "Usage: WATCH [<glob>]\nPrints a line whenever a file on the remote "
+						"system matching the glob (by default, any file in the current "
+						"directory) is created, modified or deleted, until UNWATCH. A directory "
+						"may be given before the glob, as in incoming/*.csv. Changes made in "
+						"quick succession are reported together, as their net effect. Hidden "
+						"files are only matched by a glob which starts with a dot. Each watch "
+						"uses a data connection of its own, and cannot be used in multiplexed "
+						"mode."
 				}
 		command = matchObj.group("command")
 		if not command:
-			print("Available commands: {cmds}\nType 'HELP <command>' for more details about that "
-					"command.".format(cmds=", ".join(sorted(helpStrings.keys()))))
+			self._print("Available commands: {cmds}\nType 'HELP <command>' for more details "
+					"about that command.".format(cmds=", ".join(sorted(helpStrings.keys()))))
 		elif command in helpStrings:
-			print(helpStrings[command])
+			self._print(helpStrings[command])
 		else:
-			print("No documentation exists for this command. (Perhaps it is not valid?)")
+			self._print("No documentation exists for this command. (Perhaps it is not valid?)")
 	
 		
+	def _command_MUX(self, matchObj):
+		"""Handler for MUX command: Enables or disables the multiplexed
+		transport."""
+		
+		option = matchObj.group("option")
+		if (option == "YES") == bool(self._mux):
+			self._print("Multiplexed transport is already {state}.".format(
+					state="enabled" if self._mux else "disabled"))
+			return
+		sendStr(self._connSock, "SETCONFIG MULTIPLEX {option}\n".format(option=option))
+		result = recvLine(self._connSock)
+		if option == "YES" and result == "OK MULTIPLEX ENABLED":
+			self._mux = Multiplexer(self._connSock)
+			self._connSock = self._mux.channel(0)
+			self._print("Multiplexed transport enabled.")
+		elif option == "NO" and result == "OK MULTIPLEX DISABLED":
+			if isinstance(self._dataSock, MuxChannel):
+				self._dataSock = None
+			# (The server likewise forgets its pooled channels.)
+			self._pool = [(dataID, dataSock) for (dataID, dataSock) in self._pool
+					if not isinstance(dataSock, MuxChannel)]
+			self._connSock = self._mux.rawSocket
+			self._mux = None
+			self._print("Multiplexed transport disabled.")
+		elif not self._isSocketClosed(result):
+			self._debugFailure("CLIENT FAILURE: Malformed MUX reply from server.")
+
+
 	def _command_PASV(self, matchObj):
 		"""Handler for PASV command: Enables or disables passive data transfer
 		mode."""
@@ -389,19 +1528,19 @@ class SimpleFTPClientInterpreter(ClientConnectionInterpreter):
 			result = recvLine(self._connSock)
 			if result != "OK PASSIVE ENABLED":
 				if not self._isSocketClosed(result):
-					debugPrint("CLIENT FAILURE: Malformed PASV reply from server.")
+					self._debugFailure("CLIENT FAILURE: Malformed PASV reply from server.")
 			else:
 				self._config["passive"] = True
-				print("Passive data transfer mode enabled.")
+				self._print("Passive data transfer mode enabled.")
 		else:
 			sendStr(self._connSock, "SETCONFIG PASSIVE NO\n")
 			result = recvLine(self._connSock)
 			if result != "OK PASSIVE DISABLED":
 				if not self._isSocketClosed(result):
-					debugPrint("CLIENT FAILURE: Malformed PASV reply from server.")
+					self._debugFailure("CLIENT FAILURE: Malformed PASV reply from server.")
 			else:
 				self._config["passive"] = False
-				print("Passive data transfer mode disabled.")
+				self._print("Passive data transfer mode disabled.")
 
 
 	def _command_PERSIST(self, matchObj):
@@ -414,59 +1553,141 @@ class SimpleFTPClientInterpreter(ClientConnectionInterpreter):
 			result = recvLine(self._connSock)
 			if result != "OK PERSISTENTDATA ENABLED":
 				if not self._isSocketClosed(result):
-					debugPrint("CLIENT FAILURE: Malformed PERSIST reply from server.")
+					self._debugFailure("CLIENT FAILURE: Malformed PERSIST reply from server.")
 			else:
 				self._config["persistent"] = True
-				print("Persistent data connection enabled.")
+				self._print("Persistent data connection enabled.")
 		else:
 			sendStr(self._connSock, "SETCONFIG PERSISTENTDATA NO\n")
 			result = recvLine(self._connSock)
 			if result != "OK PERSISTENTDATA DISABLED":
 				if not self._isSocketClosed(result):
-					debugPrint("CLIENT FAILURE: Malformed PERSIST reply from server.")
+					self._debugFailure("CLIENT FAILURE: Malformed PERSIST reply from server.")
 			else:
 				self._config["persistent"] = False
-				print("Persistent data connection disabled.")
+				self._print("Persistent data connection disabled.")
 			
 
+	def _command_POOL(self, matchObj):
+		"""Handler for POOL command: Sets the number of idle data connections
+		to keep ready in the pool."""
+		
+		size = int(matchObj.group("size"))
+		sendStr(self._connSock, "SETCONFIG DATAPOOL {size}\n".format(size=size))
+		result = recvLine(self._connSock)
+		if result != "OK DATAPOOL {size}".format(size=size):
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed POOL reply from server.")
+			return
+		
+		self._config["pool_size"] = size
+		# The server closes its newest pooled connections beyond the new size.
+		while len(self._pool) > size:
+			self._pool.pop()[1].close()
+		if size and not self._poolThread:
+			self._poolThread = threading.Thread(target=self._refillPool, daemon=True)
+			self._poolThread.start()
+		self._poolWakeup.set()
+		self._print("SUCCESS: Keeping {size} data connection{s} ready.".format(
+				size=size, s=("" if size == 1 else "s")))
+
+
 	def _command_PUT(self, matchObj):
 		"""Handler for PUT command: Uploads a file to the server."""
 		
 		fileName = matchObj.group("filename")
 		chunkSize = self._config["chunk_size"]
 		
-		if isdir(fileName):
-			print("FAILURE: Cannot upload a directory.")
-		elif not isfile(fileName):
-			print("FAILURE: The file does not exist.")
-		else:
-			fileSize = getsize(fileName)
-			sendStr(self._connSock, "PUT {size} {name}\n".format(size=fileSize, name=fileName))
-			isReady = recvLine(self._connSock)
-			if isError(isReady):
+		fileSize = getsize(fileName)
+		transfer = self._requestTransfer("PUT {size} {name}".format(size=fileSize, name=fileName))
+		if not transfer:
+			return
+		(dataSock, readySize) = transfer
+		try:
+			if readySize != fileSize:
+				self._debugFailure("CLIENT FAILURE: Malformed PUT reply from server.")
 				return
-			
-			if isReady != "READY {size}".format(size=fileSize):
-				if not self._isSocketClosed(isReady):
-					debugPrint("CLIENT FAILURE: Malformed PUT reply from server.")
-					return
-			
-			try:
-				with Timer() as xferTime:
-					sendFile(self._dataSock, fileName, chunkSize)
-			except (PermissionError, IOError):
-				print("CLIENT FAILURE: Cannot read from file.")
-			else:
-				isSent = recvLine(self._connSock)
-				if isSent != "OK {size}".format(size=fileSize):
-					if not self._isSocketClosed(isSent):
-						debugPrint("CLIENT FAILURE: Malformed PUT reply from server.")
+			with Timer() as xferTime:
+				if self._config["sparse"]:
+					sendSparseFile(dataSock, fileName, fileSize, chunkSize, tuner=self._tuner)
 				else:
-					print("SUCCESS: {name} ({size} byte{s}) uploaded in {secs:.4f} seconds.".format(
-							name=fileName, size=fileSize, secs=xferTime.elapsedTime(), 
-							s=("s" if fileSize > 1 else "")))
+					sendFile(dataSock, fileName, chunkSize, tuner=self._tuner,
+							queueDepth=self._config["queue_depth"])
+		except (PermissionError, IOError):
+			self._printFailure("CLIENT FAILURE: Cannot read from file.")
+		else:
+			isSent = recvLine(self._connSock)
+			if isSent != "OK {size}".format(size=fileSize):
+				if not self._isSocketClosed(isSent):
+					self._debugFailure("CLIENT FAILURE: Malformed PUT reply from server.")
+			else:
+				self._recordTransfer(fileSize)
+				self._print("SUCCESS: {name} ({size} byte{s}) uploaded in {secs:.4f} "
+						"seconds.".format(name=fileName, size=fileSize,
+						secs=xferTime.elapsedTime(), s=("s" if fileSize > 1 else "")))
+		finally:
+			if dataSock is not self._dataSock:
+				dataSock.close()
 		
 
+	def _command_PUTTREE(self, matchObj):
+		"""Handler for PUTTREE command: Uploads a directory tree to the
+		server."""
+		
+		dirName = matchObj.group("dirname")
+		options = matchObj.group("options")
+		globs = re.findall(r"(INCLUDE|EXCLUDE) (\S+)", options)
+		includes = [glob for (kind, glob) in globs if kind == "INCLUDE"]
+		excludes = [glob for (kind, glob) in globs if kind == "EXCLUDE"]
+		
+		totalSize = treeSize(dirName, includes, excludes)
+		sendStr(self._connSock, "PUTTREE {size} {name}\n".format(size=totalSize, name=dirName))
+		result = recvLine(self._connSock)
+		if self._isError(result):
+			return
+		elif result != "READY {size}".format(size=totalSize):
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed PUTTREE reply from server.")
+			return
+		try:
+			with Timer() as xferTime:
+				(numFiles, numBytes) = sendTree(self._dataSock, dirName,
+						self._config["chunk_size"], includes=includes, excludes=excludes,
+						compress=(" COMPRESS" in options))
+		except (PermissionError, IOError):
+			self._printFailure("CLIENT FAILURE: Cannot read from directory.")
+			self._isError(recvLine(self._connSock))
+		else:
+			isSent = recvLine(self._connSock)
+			if isSent == "OK {files} {size}".format(files=numFiles, size=numBytes):
+				self._recordTransfer(numBytes)
+				self._recordValue(numFiles)
+				self._print("SUCCESS: {name} ({files} file{s}, {size} bytes) uploaded in "
+						"{secs:.4f} seconds.".format(
+						name=dirName, files=numFiles, size=numBytes, secs=xferTime.elapsedTime(),
+						s=("s" if numFiles != 1 else "")))
+			elif not self._isError(isSent) and not self._isSocketClosed(isSent):
+				self._debugFailure("CLIENT FAILURE: Malformed PUTTREE reply from server.")
+		
+
+	def _command_QUEUE(self, matchObj):
+		"""Handler for QUEUE command: Sets the depth of the transfer pipeline."""
+		
+		depth = int(matchObj.group("depth"))
+		sendStr(self._connSock, "SETCONFIG QUEUEDEPTH {depth}\n".format(depth=depth))
+		result = recvLine(self._connSock)
+		if result != "OK QUEUEDEPTH {depth}".format(depth=depth):
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed QUEUE reply from server.")
+			return
+		self._config["queue_depth"] = depth
+		if depth:
+			self._print("SUCCESS: Up to {depth} chunk{s} will be queued in transfers.".format(
+					depth=depth, s=("" if depth == 1 else "s")))
+		else:
+			self._print("SUCCESS: Transfers will no longer be pipelined.")
+
+
 	def _command_QUIT(self, matchObj):
 		"""Handler for the QUIT command: Signals the termination of the
 		connection."""
@@ -476,6 +1697,153 @@ class SimpleFTPClientInterpreter(ClientConnectionInterpreter):
 		if result == "OK BYE":
 			self._connSock.close()
 			self._isFinished = True
+			self._poolWakeup.set()
+		else:
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed QUIT reply from server.")
+
+
+	def _command_RATE(self, matchObj):
+		"""Handler for the RATE command: Sets the transfer rate limit of this
+		connection."""
+		
+		rate = int(matchObj.group("rate"))
+		sendStr(self._connSock, "SETCONFIG RATELIMIT {rate}\n".format(rate=rate))
+		result = recvLine(self._connSock)
+		getRate = re.match(r"^OK RATELIMIT (?P<rate>\d+)$", result)
+		if not getRate:
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed RATE reply from server.")
+		elif getRate.group("rate") == "0":
+			self._print("SUCCESS: Transfer rate is now unlimited.")
+		else:
+			self._print("SUCCESS: Transfer rate is now limited to {rate} bytes/sec.".format(
+					rate=getRate.group("rate")))
+
+
+	def _command_SPARSE(self, matchObj):
+		"""Handler for SPARSE command: Enables or disables sparse file
+		transfers."""
+		
+		option = matchObj.group("option")
+		sendStr(self._connSock, "SETCONFIG SPARSE {option}\n".format(option=option))
+		result = recvLine(self._connSock)
+		if result != "OK SPARSE {state}".format(state="ENABLED" if option == "YES" else "DISABLED"):
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed SPARSE reply from server.")
 		else:
+			self._config["sparse"] = (option == "YES")
+			self._print("Sparse file transfers {state}.".format(
+					state="enabled" if option == "YES" else "disabled"))
+
+
+	def _command_STAT(self, matchObj):
+		"""Handler for the STAT command: Describes a file on the server."""
+		
+		fileName = matchObj.group("filename")
+		sendStr(self._connSock, "STAT{hash} {name}\n".format(
+				hash=(" HASH" if matchObj.group("hash") else ""), name=fileName))
+		result = recvLine(self._connSock)
+		if self._isError(result):
+			return
+		getStat = re.match("^OK " + self.STAT_DESCRIPTION + "$", result)
+		if not getStat:
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed STAT reply from server.")
+			return
+		self._recordValue(self._statValue(fileName, getStat))
+		self._print(self._describeStat(fileName, getStat))
+		
+
+	def _command_STATM(self, matchObj):
+		"""Handler for the STATM command: Describes several files on the
+		server."""
+		
+		sendStr(self._connSock, "STATM{hash}{names}\n".format(
+				hash=(" HASH" if matchObj.group("hash") else ""),
+				names=matchObj.group("filenames")))
+		result = recvLine(self._connSock)
+		if self._isError(result):
+			return
+		getLines = re.match(r"^OK (?P<lines>\d+)$", result)
+		if not getLines:
 			if not self._isSocketClosed(result):
-				debugPrint("CLIENT FAILURE: Malformed QUIT reply from server.")
+				self._debugFailure("CLIENT FAILURE: Malformed STATM reply from server.")
+			return
+		stats = []
+		for lineNum in range(int(getLines.group("lines"))):
+			result = recvLine(self._connSock)
+			getStat = re.match("^" + self.STAT_DESCRIPTION + r" (?P<name>\S+)$", result)
+			if not getStat:
+				if not self._isSocketClosed(result):
+					self._debugFailure("CLIENT FAILURE: Malformed STATM reply from server.")
+				return
+			stats.append(self._statValue(getStat.group("name"), getStat))
+			self._print(self._describeStat(getStat.group("name"), getStat))
+		self._recordValue(stats)
+		
+
+	def _command_STATS(self, matchObj):
+		"""Handler for the STATS command: Prints the server-wide state."""
+		
+		sendStr(self._connSock, "STATS\n")
+		result = recvLine(self._connSock)
+		getLines = re.match(r"^OK (?P<lines>\d+)$", result)
+		if not getLines:
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed STATS reply from server.")
+			return
+		lines = [recvLine(self._connSock) for lineNum in range(int(getLines.group("lines")))]
+		self._recordValue(lines)
+		for line in lines:
+			self._print(line)
+
+
+	def _command_UNWATCH(self, matchObj):
+		"""Handler for the UNWATCH command: Stops one or all watches."""
+		
+		# (They are forgotten first, since their threads finish as soon as the
+		# server closes their connections.)
+		if matchObj.group("id"):
+			self._watches.pop(int(matchObj.group("id")), None)
+			sendStr(self._connSock, "UNWATCH {id}\n".format(id=matchObj.group("id")))
+		else:
+			self._watches.clear()
+			sendStr(self._connSock, "UNWATCH\n")
+		result = recvLine(self._connSock)
+		if self._isError(result):
+			return
+		getCount = re.match(r"^OK (?P<count>\d+)$", result)
+		if not getCount:
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed UNWATCH reply from server.")
+			return
+		count = int(getCount.group("count"))
+		self._recordValue(count)
+		self._print("SUCCESS: Stopped {count} watch{es}.".format(count=count,
+				es=("es" if count != 1 else "")))
+
+
+	def _command_WATCH(self, matchObj):
+		"""Handler for the WATCH command: Starts printing the changes to the
+		matching files on the server."""
+		
+		pattern = matchObj.group("pattern") or "*"
+		sendStr(self._connSock, "WATCH {glob}\n".format(glob=pattern))
+		result = recvLine(self._connSock)
+		if self._isError(result):
+			return
+		getID = re.match(r"^OK WATCHING (?P<id>\d+)$", result)
+		if not getID:
+			if not self._isSocketClosed(result):
+				self._debugFailure("CLIENT FAILURE: Malformed WATCH reply from server.")
+			return
+		# The data connection now belongs to the watch.
+		watchID = int(getID.group("id"))
+		(dataSock, self._dataSock) = (self._dataSock, None)
+		self._watches[watchID] = dataSock
+		threading.Thread(target=self._printWatchEvents, args=(watchID, dataSock),
+				daemon=True).start()
+		self._recordValue(watchID)
+		self._print("SUCCESS: Watching {glob} (watch {id}); UNWATCH {id} to stop.".format(
+				glob=pattern, id=watchID))
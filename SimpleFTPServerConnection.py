@@ -9,12 +9,35 @@
 ################################################################################
 """This module provides the SimpleFTPServerConnectionHandler type."""
 
+import errno
+import hashlib
+import os
+import random
 import re
 import socket
+import ssl
+import stat
+import threading
 
+from collections import OrderedDict
+from atomicfile import AtomicFile, copyData, DURABILITY_POLICIES, fsyncDirectory, GroupCommitter
+from autotune import ChunkTuner
+from digest import DigestIndex
+from filecache import FileCache, SharedFileCache
+from fileindex import FileIndex
+from filemap import MappingTable
+from iopolicy import IO_POLICIES
+from multiplex import Multiplexer, MuxChannel
 from os.path import getsize, isdir, isfile
+from quota import SpaceManager, SpaceRefused
+from ratelimit import BandwidthManager
 from ServerConnection import ServerConnectionHandler
-from utils import debugPrint, listFiles, recvAll, recvFile, recvLine, sendFile, sendStr
+from sparse import recvSparseIntoFile, sendSparseFile
+from tls import wrapDataSocket
+from treestream import recvTree, sendTree, TreeStreamError, walkTree
+from utils import dataSocketPath, debugPrint, listFiles, recvAll, recvIntoFile, recvLine
+from utils import sendBuffer, sendFile, sendStr, unixPeerAddress
+from watch import WATCH_METHODS, WatchHub
 
 
 class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
@@ -31,27 +54,104 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 	# (which will be passed to that function as-is, AFTER the re.match object).
 	#
 	# NB: _connSock and _clientAddr members are inherited from ServerConnection.
+	#
+	# Server-wide state, shared by all connections, is kept in class attributes
+	# and set up by configure() before the server starts listening (and thus
+	# before any forking).
 	
-	__slots__ = ("_continueHandling", "_dataSock", "_protocolHandlers", "_config")
+	__slots__ = ("_bytesUploaded", "_continueHandling", "_dataPool", "_dataSock", "_protocolHandlers", "_config",
+			"_mux", "_tlsSocket", "_tuner", "_unixPath", "_watchIDs")
+
+	bandwidth = BandwidthManager()
+	durability = "NONE"
+	ioPolicy = "NORMAL"
+	ioThreshold = 64 * 2**20
+	fileCache = None
+	# The digest index is opened when digests are first asked for (see
+	# _digestIndex), unless --digest-db was given.
+	digestDB = os.path.join(os.path.expanduser("~"), ".cache", "ftpdigests.sqlite")
+	digestLock = threading.Lock()
+	digestWorkers = 4
+	digests = None
+	fileIndex = None
+	mappings = None
+	space = SpaceManager()
+	watches = WatchHub()
 
 	def __init__(self, connSock, clientAddr):
 		super().__init__(connSock, clientAddr)
+		self._bytesUploaded = 0
+		self._dataPool = OrderedDict()
 		self._dataSock = None
+		self._mux = None
+		# The control connection, if it is over TLS (so its data connections
+		# are too; see _secureDataConnection).
+		self._tlsSocket = connSock if isinstance(connSock, ssl.SSLSocket) else None
+		self._tuner = None
+		# The path of the Unix domain socket the client connected to, if it
+		# did; its data connections are then made at paths beside it.
+		self._unixPath = None
+		if connSock.family == socket.AF_UNIX:
+			self._unixPath = connSock.getsockname()
+		self._watchIDs = []
 		self._config = {
 				"chunk_size": 65536,
+				"data_pool": 0,
+				"durability": self.durability,
+				"io_policy": self.ioPolicy,
+				"io_threshold": self.ioThreshold,
 				"passive":	False,
 				"persistent": False,
 				"put_behavior": "ERROR",
+				"queue_depth": 0,
+				"rate_limit": self.bandwidth.sessionRate(0),
+				"sparse": False,
 				"timeout": 10
 				}
 		self._continueHandling = True
 		self._protocolHandlers = {}
 
+		# COPY <source> <destination>
+		# Copies a file on the server, without sending it over the network.
+		# The destination is treated as in PUT (according to PUTBEHAVIOR).
+		# (Neither file name may contain spaces.)
+		self.registerProtocolHandler(r"COPY (?P<src>\S+) (?P<dst>\S+)",
+				self._protocol_COPY, needData=False, closeData=False)
+
 		# DATA -- Opens an ephemeral data connection. (Specifying the port and
 		# ID is needed if passive mode is not enabled.)
 		self.registerProtocolHandler(r"DATA( (?P<port>\d+))?",
 				self._protocol_DATA, needData=False, closeData=False)
+
+		# DATA CHANNEL <id>
+		# Opens a data channel with the given ID on the control connection
+		# itself. (Only valid if MULTIPLEX is enabled.)
+		self.registerProtocolHandler(r"DATA CHANNEL (?P<channel>\d+)",
+				self._protocol_DATA_CHANNEL, needData=False, closeData=False)
+
+		# DATA DROP <id>
+		# Closes the pooled data connection with the given ID (that is, the
+		# port number from its OK reply). (See DATAPOOL, under SETCONFIG.)
+		self.registerProtocolHandler(r"DATA DROP (?P<id>\d+)",
+				self._protocol_DATA_DROP, needData=False, closeData=False)
 	
+		# FIND <glob> [MINSIZE <size>] [MAXSIZE <size>] [NEWER <mtime>] [LIMIT <count>]
+		# Searches the whole served tree for entries whose names (or paths
+		# within the tree, if the glob contains a "/") match the glob, using
+		# the server's file index (see the fileindex module). The sizes are
+		# in bytes, and the time in nanoseconds since the epoch (as given by
+		# STAT). At most <count> entries (by default, 1000) are given.
+		self.registerProtocolHandler(
+				r"FIND (?P<pattern>\S+)(?P<options>( (MINSIZE|MAXSIZE|NEWER|LIMIT) \d+)*)",
+				self._protocol_FIND, needData=False, closeData=False)
+
+		# FOLLOW [<offset>] <filename>
+		# Sends the named file's contents from the given offset (by default,
+		# the start) on the data connection, then whatever is appended to it,
+		# until UNWATCH; as for WATCH, the data connection then belongs to it.
+		self.registerProtocolHandler(r"FOLLOW( (?P<offset>\d+))? (?P<filename>.+)",
+				self._protocol_FOLLOW, needData=True, closeData=True)
+
 		# GET <filename>
 		# Sends the contents of the requested file to the client.
 		self.registerProtocolHandler(r"GET (?P<filename>.+)",
@@ -63,6 +163,36 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 		self.registerProtocolHandler(r"GETCONFIG",
 				self._protocol_GETCONFIG, needData=False, closeData=False)		
 		
+		# GETFD <filename>
+		# Opens the requested file (read-only) and passes the open file
+		# descriptor to the client along with the reply, so that it can read
+		# the file itself, without its contents being sent at all. (Only
+		# possible for a client on the same host, connected by a Unix domain
+		# socket without MULTIPLEX, and to which no rate limit applies.)
+		self.registerProtocolHandler(r"GETFD (?P<filename>.+)",
+				self._protocol_GETFD, needData=False, closeData=False)
+		
+		# GETIF <size> <mtime> <filename>
+		# GETIF HASH <digest> <filename>
+		# Checks whether the named file still matches the client's copy: by
+		# its size and modification time (as given by STAT), or by the
+		# SHA-256 digest of its contents. Replies NOT MODIFIED if it does, so
+		# that no data connection is needed; or MODIFIED with the file's
+		# current size and modification time, for the client to then GET it.
+		self.registerProtocolHandler(
+				r"GETIF ((?P<size>\d+) (?P<mtime>\d+)|HASH (?P<digest>[0-9a-fA-F]+)) (?P<filename>.+)",
+				self._protocol_GETIF, needData=False, closeData=False)
+
+		# GETTREE [COMPRESS] [INCLUDE <glob>]... [EXCLUDE <glob>]... <dirname>
+		# Sends the contents of the requested directory to the client, as a
+		# tar stream (gzip-compressed, if COMPRESS is given) split into
+		# frames. (See the treestream module.) Entries matching an EXCLUDE
+		# glob are skipped; if any INCLUDE globs are given, only the files
+		# matching one of them are sent. (The globs may not contain spaces.)
+		self.registerProtocolHandler(
+				r"GETTREE(?P<options>( (COMPRESS|INCLUDE \S+|EXCLUDE \S+))*) (?P<dirname>.+)",
+				self._protocol_GETTREE, needData=True, closeData=True)
+
 		# GO AWAY
 		# Instructs the server to stop processing input from the client socket,
 		# then close the control and data connections.
@@ -70,23 +200,104 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 		self.registerProtocolHandler(r"GO AWAY",
 				self._protocol_GO_AWAY, needData=False, closeData=True)
 
+		# HASH <filename>
+		# Gives the SHA-256 digest of the named file's contents, from the
+		# server's persistent digest index (see the digest module) if the
+		# file is unchanged since it was last hashed.
+		self.registerProtocolHandler(r"HASH (?P<filename>.+)",
+				self._protocol_HASH, needData=False, closeData=False)
+
+		# HASHDIR <dirname>
+		# Gives the digests of all of the files under the named directory, as
+		# for HASH, one per line along with its path within the directory.
+		self.registerProtocolHandler(r"HASHDIR (?P<dirname>.+)",
+				self._protocol_HASHDIR, needData=False, closeData=False)
+
 		# LS
 		# Sends a file listing to the client.
 		self.registerProtocolHandler(r"LS",
 				self._protocol_LS, needData=True, closeData=True)
 
+		# MOVE <source> <destination>
+		# Moves (renames) a file on the server, treating the destination as
+		# COPY does.
+		self.registerProtocolHandler(r"MOVE (?P<src>\S+) (?P<dst>\S+)",
+				self._protocol_MOVE, needData=False, closeData=False)
+
+		# PGET <filename>
+		# Like GET, but needs no data connection beforehand: the server checks
+		# the file, then listens on an ephemeral port and replies with both
+		# the port and the file size. The transfer starts as soon as the
+		# client connects. (This saves the round trips of a separate DATA.)
+		self.registerProtocolHandler(r"PGET (?P<filename>.+)",
+				self._protocol_PGET, needData=False, closeData=False)
+
+		# PPUT <size> <filename>
+		# The PUT counterpart of PGET.
+		self.registerProtocolHandler(r"PPUT (?P<size>\d+) (?P<filename>.+)",
+				self._protocol_PPUT, needData=False, closeData=False)
+
 		# PUT <size> <filename>
 		# Instructs the server to read <size> bytes from the data connection
 		# and store the data locally in the file named <filename>.
 		self.registerProtocolHandler(r"PUT (?P<size>\d+) (?P<filename>.+)",
 				self._protocol_PUT, needData=True, closeData=True)
-		
+
+		# PUTTREE <size> <dirname>
+		# Instructs the server to read a tar stream, as sent for GETTREE
+		# (compressed or not), from the data connection and extract it into
+		# the named directory. <size> is the total size of the regular files
+		# in it, which is checked against the free space and quotas, and may
+		# not be exceeded. If the directory already exists, the stream is
+		# extracted into it (replacing any files of the same names) unless
+		# the PUT behavior is ERROR.
+		self.registerProtocolHandler(r"PUTTREE (?P<size>\d+) (?P<dirname>.+)",
+				self._protocol_PUTTREE, needData=True, closeData=True)
+
 		# SETCONFIG <option> <value>
 		# Invoked by the client to modify transfer settings.
 		# <option> is one of:
-		#	CHUNKSIZE -- (integer, default 65536)
+		#	CHUNKSIZE -- (integer or AUTO, default 65536)
 		#		The chunk size (bytes) used for reading and writing file data
-		#		in GET/PUT requests.
+		#		in GET/PUT requests. If AUTO, the chunk size and data socket
+		#		buffer sizes are tuned during each transfer by measuring its
+		#		throughput; GETCONFIG then reports the values chosen.
+		#
+		#	DATAPOOL -- (integer, default 0)
+		#		The number of idle data connections the client may keep open
+		#		in a pool. If non-zero, each new data connection (from the
+		#		DATA command) is added to the pool instead of replacing the
+		#		current one; and when a command needs a data connection and
+		#		none is current, the oldest pooled one is used. Lowering this
+		#		closes the newest pooled connections beyond the new size.
+		#
+		#	DURABILITY -- (string, default from server start, usually NONE)
+		#		How PUT makes an uploaded file durable, once it has been
+		#		received in full and renamed into place. (See the atomicfile
+		#		module.) This can be one of:
+		#		* FSYNC -- Flush it to disk before replying;
+		#		* GROUP -- Flush it in the background, in a batch with others;
+		#		* NONE -- Leave it to the operating system.
+		#
+		#	IOPOLICY -- (string, default from server start, usually NORMAL)
+		#		How GET/PUT transfers of files of at least IOTHRESHOLD bytes
+		#		use the page cache, so that they do not evict the pages of
+		#		smaller, more popular files. (See the iopolicy module.) This
+		#		can be one of:
+		#		* DIRECT -- Bypass the page cache (O_DIRECT);
+		#		* NORMAL -- Use it as usual;
+		#		* STREAM -- Read ahead, and drop the pages behind the transfer.
+		#
+		#	IOTHRESHOLD -- (integer, default from server start, usually 64 MiB)
+		#		The smallest file size (bytes) to which IOPOLICY applies.
+		#
+		#	MULTIPLEX -- (YES/NO string, default NO)
+		#		If enabled, all further messages on the control connection
+		#		(in both directions) are sent as frames tagged with a channel
+		#		ID, and data channels are opened with DATA CHANNEL <id> on the
+		#		control connection itself instead of on a separate socket.
+		#		(See the multiplex module for the frame format.) The switch
+		#		takes place right after the OK reply.
 		#
 		#	PASSIVE -- (YES/No string, default NO)
 		#		Normally when a data connection is requested, the client
@@ -111,15 +322,50 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 		#		* ERROR -- Return an error to the client; 
 		#		* OVERWRITE -- Forcibly overwrite the file.
 		#
+		#	QUEUEDEPTH -- (integer, default 0)
+		#		If non-zero, GET/PUT transfers from/to disk are pipelined: a
+		#		background thread reads the file (or receives the data) while
+		#		the handler sends (or writes) earlier chunks, with at most
+		#		this many chunks queued in between. If 0, disk and network I/O
+		#		simply alternate.
+		#
+		#	RATELIMIT -- (integer, default from server start, usually 0)
+		#		The maximum transfer rate (bytes per second) for GET/PUT
+		#		requests on this connection, or 0 for no session limit. This
+		#		can lower, but never raise, the per-connection limit given
+		#		when the server was started.
+		#
 		#	SOCKETTIMEOUT -- (integer, default 10)
 		#		Time (seconds) to wait for socket connections when requesting a
 		#		data channel.
 		#
+		#	SPARSE -- (YES/NO string, default NO)
+		#		If enabled, GET/PUT send only the data extents of the file,
+		#		skipping its holes, and the receiver recreates the holes. (See
+		#		the sparse module for the format.)
+		#
 		# (NB: if you add a config option here, you also need to update
 		#		the GETCONFIG handler accordingly.)
-		self.registerProtocolHandler(r"SETCONFIG CHUNKSIZE (?P<value>\d+)",
+		self.registerProtocolHandler(r"SETCONFIG CHUNKSIZE (?P<value>\d+|AUTO)",
 				self._protocol_SETCONFIG_CHUNKSIZE, needData=False, closeData=False)
 
+		self.registerProtocolHandler(r"SETCONFIG DATAPOOL (?P<value>\d+)",
+				self._protocol_SETCONFIG_DATAPOOL, needData=False, closeData=False)
+
+		self.registerProtocolHandler(r"SETCONFIG DURABILITY (?P<value>{policies})".format(
+				policies="|".join(DURABILITY_POLICIES)),
+				self._protocol_SETCONFIG_DURABILITY, needData=False, closeData=False)
+
+		self.registerProtocolHandler(r"SETCONFIG IOPOLICY (?P<value>{policies})".format(
+				policies="|".join(IO_POLICIES)),
+				self._protocol_SETCONFIG_IOPOLICY, needData=False, closeData=False)
+
+		self.registerProtocolHandler(r"SETCONFIG IOTHRESHOLD (?P<value>\d+)",
+				self._protocol_SETCONFIG_IOTHRESHOLD, needData=False, closeData=False)
+
+		self.registerProtocolHandler(r"SETCONFIG MULTIPLEX (?P<value>YES|NO)",
+				self._protocol_SETCONFIG_MULTIPLEX, needData=False, closeData=False)
+
 		self.registerProtocolHandler(r"SETCONFIG PASSIVE (?P<value>YES|NO)",
 				self._protocol_SETCONFIG_PASSIVE, needData=False, closeData=False)
 
@@ -129,9 +375,140 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 		self.registerProtocolHandler(r"SETCONFIG PUTBEHAVIOR (?P<value>APPEND|ERROR|OVERWRITE)",
 				self._protocol_SETCONFIG_PUTBEHAVIOR, needData=False, closeData=False)
 
+		self.registerProtocolHandler(r"SETCONFIG QUEUEDEPTH (?P<value>\d+)",
+				self._protocol_SETCONFIG_QUEUEDEPTH, needData=False, closeData=False)
+
+		self.registerProtocolHandler(r"SETCONFIG RATELIMIT (?P<value>\d+)",
+				self._protocol_SETCONFIG_RATELIMIT, needData=False, closeData=False)
+
 		self.registerProtocolHandler(r"SETCONFIG SOCKETTIMEOUT (?P<value>\d+)",
 				self._protocol_SETCONFIG_SOCKETTIMEOUT, needData=False, closeData=False)
 
+		self.registerProtocolHandler(r"SETCONFIG SPARSE (?P<value>YES|NO)",
+				self._protocol_SETCONFIG_SPARSE, needData=False, closeData=False)
+
+		# STAT [HASH] <filename>
+		# Describes the named file (its type, size and modification time; and
+		# with HASH, its SHA-256 digest) on the control connection, without
+		# needing a data connection.
+		self.registerProtocolHandler(r"STAT( (?P<hash>HASH))? (?P<filename>.+)",
+				self._protocol_STAT, needData=False, closeData=False)
+
+		# STATM [HASH] <filename> [<filename>]...
+		# Like STAT, but describes any number of files at once. (The file
+		# names may not contain spaces.)
+		self.registerProtocolHandler(r"STATM( (?P<hash>HASH))?(?P<filenames>( \S+)+)",
+				self._protocol_STATM, needData=False, closeData=False)
+
+		# STATS
+		# Invoked by the client to get the current server-wide state, such as
+		# the bandwidth allocation.
+		self.registerProtocolHandler(r"STATS",
+				self._protocol_STATS, needData=False, closeData=False)
+
+		# UNWATCH [<id>]
+		# Stops the given watch or FOLLOW (or all of this connection's),
+		# closing its data connection.
+		self.registerProtocolHandler(r"UNWATCH( (?P<id>\d+))?",
+				self._protocol_UNWATCH, needData=False, closeData=False)
+
+		# WATCH [<glob>]
+		# Sends a line on the data connection whenever a file matching the
+		# glob (by default, any file in the current directory) is created,
+		# modified or deleted, until UNWATCH. The data connection is then no
+		# longer available for other commands, and the control connection
+		# may be used as usual.
+		self.registerProtocolHandler(r"WATCH( (?P<pattern>\S+))?",
+				self._protocol_WATCH, needData=True, closeData=True)
+
+	
+	@staticmethod
+	def addArguments(parser):
+		"""Adds the server-wide command-line options to the given
+		argparse.ArgumentParser, for use by the server scripts."""
+		
+		parser.add_argument("--rate-limit", type=int, default=0, metavar="BYTES",
+				help="maximum transfer rate (bytes/sec) of each connection")
+		parser.add_argument("--global-rate-limit", type=int, default=0, metavar="BYTES",
+				help="maximum transfer rate (bytes/sec) of the whole server")
+		parser.add_argument("--fair-share", action="store_true",
+				help="split the global rate limit evenly between active transfers")
+		parser.add_argument("--cache-size", type=int, default=0, metavar="BYTES",
+				help="size of the in-memory cache of popular files for GET (default: none)")
+		parser.add_argument("--cache-max-file", type=int, default=16*2**20, metavar="BYTES",
+				help="size of the largest file to keep in the cache (default: 16 MiB)")
+		parser.add_argument("--quota", type=int, default=0, metavar="BYTES",
+				help="total number of bytes all connections may upload (default: no limit)")
+		parser.add_argument("--session-quota", type=int, default=0, metavar="BYTES",
+				help="number of bytes each connection may upload (default: no limit)")
+		parser.add_argument("--min-free", type=int, default=0, metavar="BYTES",
+				help="disk space which uploads must always leave free (default: 0)")
+		parser.add_argument("--durability", default="NONE", choices=DURABILITY_POLICIES,
+				help="default policy for making uploaded files durable (default: NONE)")
+		parser.add_argument("--io-policy", default="NORMAL", choices=IO_POLICIES,
+				help="default page cache policy for transfers of large files (default: NORMAL)")
+		parser.add_argument("--io-threshold", type=int, default=64*2**20, metavar="BYTES",
+				help="smallest file size to which the I/O policy applies (default: 64 MiB)")
+		parser.add_argument("--mmap", action="store_true",
+				help="serve GET requests from read-only memory maps of the files")
+		parser.add_argument("--mmap-table-size", type=int, default=64, metavar="N",
+				help="number of open memory maps to keep for reuse (default: 64)")
+		parser.add_argument("--digest-db", metavar="PATH",
+				help="database of file digests, for HASH; if given, uploaded files are hashed "
+				"straight away (default: ~/.cache/ftpdigests.sqlite, opened when first needed)")
+		parser.add_argument("--digest-workers", type=int, default=4, metavar="N",
+				help="number of threads which compute file digests (default: 4)")
+		parser.add_argument("--index-db", metavar="PATH",
+				help="database of the served files, for FIND; enables FIND (default, with "
+				"--index-interval: in ~/.cache, named after the served directory)")
+		parser.add_argument("--index-interval", type=int, metavar="SECONDS",
+				help="how often to rescan the served files for FIND, or 0 to only scan them "
+				"at startup; enables FIND (default, with --index-db: 60)")
+		parser.add_argument("--watch-method", default="AUTO", choices=WATCH_METHODS,
+				help="how WATCH detects changes: by inotify, or by polling (default: AUTO, "
+				"which uses inotify if it is available)")
+		parser.add_argument("--watch-delay", type=int, default=200, metavar="MS",
+				help="how long WATCH collects the changes to a directory before sending "
+				"them (default: 200)")
+
+
+	@classmethod
+	def configure(cls, options, multiProcess=False):
+		"""Sets up the server-wide state from the parsed command-line options
+		(see addArguments). The multiProcess flag must be set if connections
+		will be handled in separate (forked) processes, so that the state is
+		shared between them. This must be called before the server starts
+		listening."""
+		
+		cls.bandwidth = BandwidthManager(globalRate=options.global_rate_limit,
+				connRate=options.rate_limit, fairShare=options.fair_share)
+		cls.durability = options.durability
+		cls.ioPolicy = options.io_policy
+		cls.ioThreshold = options.io_threshold
+		cls.space = SpaceManager(globalQuota=options.quota, sessionQuota=options.session_quota,
+				minFree=options.min_free)
+		if options.cache_size > 0:
+			cacheType = SharedFileCache if multiProcess else FileCache
+			cls.fileCache = cacheType(options.cache_size, options.cache_max_file)
+		if options.mmap:
+			cls.mappings = MappingTable(options.mmap_table_size)
+		cls.digestWorkers = options.digest_workers
+		if options.digest_db:
+			cls.digestDB = options.digest_db
+			cls._digestIndex()
+		# The index (and its rescanning process) is only kept if asked for.
+		if options.index_db or options.index_interval is not None:
+			indexDB = options.index_db
+			if not indexDB:
+				indexDB = os.path.join(os.path.expanduser("~"), ".cache",
+						"ftpindex-{tag}.sqlite".format(
+								tag=hashlib.sha256(os.getcwd().encode()).hexdigest()[:16]))
+			os.makedirs(os.path.dirname(os.path.abspath(indexDB)), exist_ok=True)
+			interval = options.index_interval if options.index_interval is not None else 60
+			cls.fileIndex = FileIndex(indexDB, ".", interval)
+			cls.fileIndex.start()
+		cls.watches = WatchHub(options.watch_method, options.watch_delay / 1000)
+
 		
 	def handleClientConnection(self):
 		"""The workhorse function of this server implementation.
@@ -151,6 +528,8 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 				matchObj = re.match("^"+regex+"$", ctrlLine)
 				if matchObj:
 					(handlerFunc, needData, closeData, args, kwargs) = handler
+					if needData and not self._dataSock and self._dataPool:
+						(poolID, self._dataSock) = self._dataPool.popitem(last=False)
 					if needData and not self._dataSock:
 						sendStr(self._connSock, "ERR NO DATA CONNECTION\n")
 						break
@@ -164,6 +543,16 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 		self._connSock.close()
 		if self._dataSock:
 			self._dataSock.close()
+		for pooledSock in self._dataPool.values():
+			pooledSock.close()
+		for watchID in self._watchIDs:
+			self.watches.unsubscribe(watchID)
+		# (The forking server's child process exits after this, so any
+		# uploads still waiting for a group flush must be flushed now, and
+		# their digests computed.)
+		GroupCommitter.flushProcess()
+		if self.digests:
+			self.digests.flush()
 		debugPrint("SERVER: Client disconnected.")
 		
 		
@@ -184,13 +573,366 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 		else:
 			self._protocolHandlers[regex] = (handlerFunc, needData, closeData, args, kwargs)
 
+
+	def _acceptPassiveConnection(self, readyReply):
+		"""Listens for a data connection from the client (see _listenForData),
+		sending readyReply (formatted with the connection's ID, as its port)
+		on the control connection once ready. Returns a tuple of the connected
+		socket (secured, if the control connection is over TLS) and its ID; or
+		None if the client did not connect (and complete the TLS handshake) in
+		time, after replying with an error."""
+		
+		(dataConn, dataID) = self._listenForData()
+		try:
+			with dataConn:
+				dataConn.settimeout(self._config["timeout"])
+				dataConn.listen(1)
+				sendStr(self._connSock, readyReply.format(port=dataID))
+				while True:	
+					(clientDataSock, clientAddr) = dataConn.accept()
+					if self._unixPath:
+						# Unix peers are told apart by process, not host.
+						clientAddr = unixPeerAddress(clientDataSock)
+					else:
+						clientAddr = clientAddr[:1]
+					if clientAddr == self._clientAddr[:len(clientAddr)]:
+						break
+					else:
+						clientDataSock.close()		
+		except socket.timeout as err:
+			sendStr(self._connSock, "ERR DATA SOCKET TIMEOUT\n")
+			return None
+		finally:
+			if self._unixPath:
+				os.unlink(dataSocketPath(self._unixPath, dataID))
+		try:
+			clientDataSock.settimeout(self._config["timeout"])
+			clientDataSock = self._secureDataConnection(clientDataSock)
+			clientDataSock.settimeout(None)
+		except OSError as err:
+			debugPrint("SERVER: TLS handshake on data connection failed: {err}".format(err=err))
+			clientDataSock.close()
+			sendStr(self._connSock, "ERR TLS HANDSHAKE FAILED\n")
+			return None
+		return (clientDataSock, dataID)
+
+
+	def _addDataConnection(self, dataID, dataSock):
+		"""Makes the given newly-opened data connection current (or adds it to
+		the pool, if pooling is enabled), then acknowledges it to the client
+		with the given ID (its port number)."""
+		
+		if self._config["data_pool"]:
+			self._dataPool[dataID] = dataSock
+		else:
+			self._dataSock = dataSock
+		sendStr(self._connSock, "OK {port}\n".format(port=dataID))
+	
+	
+	def _checkCopyFiles(self, srcName, dstName):
+		"""Checks the source and destination of a COPY or MOVE request,
+		replying with an error if they are unsuitable. Returns the source
+		file's os.stat result, and the mode from _checkPutBehavior, as a
+		tuple; or None on error."""
+		
+		srcStat = self._checkGetFile(srcName)
+		if srcStat is None:
+			return None
+		if os.path.exists(dstName) and os.path.samefile(srcName, dstName):
+			sendStr(self._connSock, "ERR SAME FILE\n")
+			return None
+		fileMode = self._checkPutBehavior(dstName)
+		if fileMode is None:
+			return None
+		return (srcStat, fileMode)
+
+
+	def _checkGetFile(self, fileName):
+		"""Checks that the named file can be sent to the client, replying with
+		an error if not. Returns the file's os.stat result, or None on error.
+		(This takes a single stat() call, rather than one each for isdir,
+		isfile and getsize.)"""
+		
+		try:
+			fileStat = os.stat(fileName)
+		except OSError:
+			fileStat = None
+		if fileStat and stat.S_ISDIR(fileStat.st_mode):
+			sendStr(self._connSock, "ERR FILE IS A DIRECTORY\n")
+		elif not fileStat or not stat.S_ISREG(fileStat.st_mode):
+			sendStr(self._connSock, "ERR FILE DOES NOT EXIST\n")
+		else:
+			return fileStat
+		return None
+		
+		
+	def _checkPutBehavior(self, fileName):
+		"""Checks that the named file can be stored according to the PUT
+		behavior, replying with an error if not. Returns the mode to open the
+		file with ("ab" to append to it, or "wb"), or None on error."""
+		
+		behavior = self._config["put_behavior"]
+		if isdir(fileName):
+			sendStr(self._connSock, "ERR FILE IS A DIRECTORY\n")
+			return None
+		elif isfile(fileName):
+			if behavior == "ERROR":
+				sendStr(self._connSock, "ERR FILE EXISTS\n")
+				return None
+			elif behavior == "APPEND":
+				return "ab"
+		return "wb"
+
+
+	def _checkPutFile(self, fileName, fileSize):
+		"""Checks that the named file can be stored according to the PUT
+		behavior, and that there is room for fileSize bytes (see
+		_reserveSpace), replying with an error if not. Returns a tuple of the
+		mode to open the file with and a quota.SpaceReservation for the
+		upload; or None on error."""
+		
+		fileMode = self._checkPutBehavior(fileName)
+		if fileMode is None:
+			return None
+		reservation = self._reserveSpace(fileName, fileSize, fileMode)
+		if reservation is None:
+			return None
+		return (fileMode, reservation)
+
+
+	def _copyFile(self, srcName, srcStat, dstName, fileMode, reservation):
+		"""Copies the named source file (whose os.stat result is srcStat) over,
+		or onto the end of, the named destination file, according to the
+		fileMode and reservation from _checkPutFile. Returns the number of
+		bytes copied, or None after replying with an error."""
+		
+		fileSize = srcStat.st_size
+		try:
+			with reservation, open(srcName, "rb") as srcFile, \
+					AtomicFile(dstName, fileSize, append=(fileMode == "ab"),
+							preallocate=False) as outFile:
+				outFile.file.flush()
+				numBytesCopied = copyData(srcFile.fileno(), outFile.file.fileno(), fileSize,
+						clone=(fileMode == "wb"))
+				if numBytesCopied == fileSize:
+					outFile.commit(self._config["durability"])
+					reservation.commit()
+					self._bytesUploaded += fileSize
+					self._fileChanged(dstName)
+		except (PermissionError, IOError):
+			sendStr(self._connSock, "ERR CANNOT COPY FILE\n")
+			return None
+		if numBytesCopied < fileSize:
+			sendStr(self._connSock, "ERR FILE CHANGED DURING COPY\n")
+			return None
+		return numBytesCopied
+
+
+	def _describeFile(self, fileName, withHash):
+		"""Returns the description of the named file given by STAT and STATM:
+		its type (FILE, DIRECTORY or OTHER), size and modification time (in
+		nanoseconds since the epoch), and if withHash is set, the digest of
+		its contents (or "-" if it has none); or None if it does not exist."""
+		
+		try:
+			fileStat = os.stat(fileName)
+		except OSError:
+			return None
+		if stat.S_ISREG(fileStat.st_mode):
+			fileType = "FILE"
+		elif stat.S_ISDIR(fileStat.st_mode):
+			fileType = "DIRECTORY"
+		else:
+			fileType = "OTHER"
+		description = "{type} {size} {mtime}".format(type=fileType, size=fileStat.st_size,
+				mtime=fileStat.st_mtime_ns)
+		if withHash:
+			digest = None
+			if fileType == "FILE":
+				digest = self._digestIndex().get(fileName, fileStat)
+			description += " {digest}".format(digest=digest or "-")
+		return description
+
+
+	@classmethod
+	def _digestIndex(cls):
+		"""Returns the digest index, opening it if this is the first time
+		digests are asked for (in this process)."""
+		
+		with cls.digestLock:
+			if cls.digests is None:
+				os.makedirs(os.path.dirname(os.path.abspath(cls.digestDB)), exist_ok=True)
+				cls.digests = DigestIndex(cls.digestDB, cls.digestWorkers)
+			return cls.digests
+	
+	
+	def _fileChanged(self, fileName):
+		"""Updates the server's digest and file indexes (those which are open)
+		after the named file or directory was written or removed."""
+		
+		if self.digests and not isdir(fileName):
+			self.digests.update(fileName)
+		if self.fileIndex:
+			self.fileIndex.update(fileName)
+
+
+	def _ioPolicyFor(self, fileSize):
+		"""Returns the I/O policy to use for a transfer of fileSize bytes."""
+		
+		if fileSize >= self._config["io_threshold"]:
+			return self._config["io_policy"]
+		return "NORMAL"
+
+
+	def _listenForData(self):
+		"""Returns a new socket bound (but not yet listening) for a data
+		connection from the client, and the connection's ID: an ephemeral TCP
+		port; or if the client is connected by a Unix domain socket, a random
+		number naming a socket beside that one (see utils.dataSocketPath)."""
+		
+		if not self._unixPath:
+			dataConn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			dataConn.bind(("", 0))
+			return (dataConn, dataConn.getsockname()[1])
+		while True:
+			dataID = random.randrange(1, 2**31)
+			dataConn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				dataConn.bind(dataSocketPath(self._unixPath, dataID))
+			except OSError as err:
+				dataConn.close()
+				if err.errno != errno.EADDRINUSE:
+					raise
+			else:
+				return (dataConn, dataID)
+
+
+	def _recvFileData(self, dataSock, fileName, fileSize, fileMode, reservation):
+		"""Receives the uploaded file data from the given data socket into a
+		temporary file, which replaces the named file only once all of the
+		data has arrived; then replies with the result. (The fileMode and
+		reservation are from _checkPutFile; the mode tells whether to append
+		to the named file.)"""
+		
+		chunkSize = self._config["chunk_size"]
+		sparse = self._config["sparse"]
+		try:
+			with self.bandwidth.transfer(self._config["rate_limit"]) as limiter, \
+					AtomicFile(fileName, fileSize, append=(fileMode == "ab"),
+							preallocate=not sparse) as outFile:
+				# Once the file system has allocated the space, it shows in the
+				# free space; so other uploads need not allow for it twice.
+				if outFile.preallocated:
+					reservation.release()
+				if sparse:
+					numBytesWritten = recvSparseIntoFile(dataSock, fileSize, outFile.file,
+							chunkSize, limiter, self._tuner)
+				else:
+					numBytesWritten = recvIntoFile(dataSock, fileSize, outFile.file,
+							chunkSize, limiter, self._tuner, self._config["queue_depth"],
+							self._ioPolicyFor(fileSize))
+				if numBytesWritten == fileSize:
+					outFile.commit(self._config["durability"])
+					reservation.commit()
+					self._bytesUploaded += fileSize
+					self._fileChanged(fileName)
+		except (PermissionError, IOError):
+			sendStr(self._connSock, "ERR CANNOT WRITE TO FILE\n")
+		else:
+			if numBytesWritten < fileSize:
+				sendStr(self._connSock, "ERR INCOMPLETE DATA\n")
+			else:
+				sendStr(self._connSock, "OK {size}\n".format(size=fileSize))
+
+
+	def _reserveSpace(self, fileName, fileSize, fileMode):
+		"""Reserves room (on the disk and in the quotas) for fileSize bytes to
+		be stored in the named file with the given mode, replying with an
+		error if there is none. Returns a quota.SpaceReservation, or None on
+		error."""
+		
+		# An append copies the old contents into the temporary file, so
+		# needs room for them too.
+		try:
+			copySize = getsize(fileName) if fileMode == "ab" else 0
+			return self.space.reserve(fileName, fileSize, copySize, self._bytesUploaded)
+		except SpaceRefused as err:
+			sendStr(self._connSock, "ERR {reason}\n".format(reason=err))
+			return None
+
+
+	def _secureDataConnection(self, dataSock):
+		"""Returns the given newly-connected data socket wrapped in TLS, after
+		the handshake, if the control connection is over TLS (see the tls
+		module); otherwise, the socket itself."""
+		
+		if not self._tlsSocket:
+			return dataSock
+		dataSock = wrapDataSocket(self._tlsSocket, dataSock)
+		debugPrint("SERVER: Data connection secured ({how}).".format(
+				how="resumed session" if dataSock.session_reused else "full handshake"))
+		return dataSock
+
+
+	def _sendFileData(self, dataSock, fileName, fileStat):
+		"""Sends the named file's contents on the given data socket (from the
+		file cache, if enabled and the file is small enough; otherwise from a
+		memory map of the file, if enabled; unless an I/O policy applies to
+		it, or SPARSE is enabled), then replies with the result. fileStat is
+		the file's os.stat result."""
+		
+		fileSize = fileStat.st_size
+		policy = self._ioPolicyFor(fileSize)
+		debugPrint("SERVER: Sending {fname}".format(fname=fileName))
+		sparse = self._config["sparse"]
+		try:
+			contents = None
+			if policy == "NORMAL" and not sparse and self.fileCache:
+				contents = self.fileCache.get(fileName, fileStat)
+			if policy == "NORMAL" and not sparse and contents is None and self.mappings:
+				contents = self.mappings.get(fileName, fileStat)
+			with self.bandwidth.transfer(self._config["rate_limit"]) as limiter:
+				if sparse:
+					sendSparseFile(dataSock, fileName, fileSize, self._config["chunk_size"],
+							limiter, self._tuner)
+				elif contents is not None:
+					sendBuffer(dataSock, contents, self._config["chunk_size"], limiter, self._tuner)
+				else:
+					sendFile(dataSock, fileName, self._config["chunk_size"], limiter, self._tuner,
+							self._config["queue_depth"], policy)
+		except (PermissionError, IOError):
+			sendStr(self._connSock, "ERR CANNOT READ FILE\n")
+		else:
+			sendStr(self._connSock, "OK {size}\n".format(size=fileSize))
+
+
 	###
 	# The protocol handlers....
 	###
+	def _protocol_COPY(self, matchObj):
+		"""Handler for COPY command: Copies a file on the server."""
+		
+		(srcName, dstName) = matchObj.group("src", "dst")
+		checked = self._checkCopyFiles(srcName, dstName)
+		if checked is None:
+			return
+		(srcStat, fileMode) = checked
+		reservation = self._reserveSpace(dstName, srcStat.st_size, fileMode)
+		if reservation is None:
+			return
+		numBytesCopied = self._copyFile(srcName, srcStat, dstName, fileMode, reservation)
+		if numBytesCopied is not None:
+			sendStr(self._connSock, "OK {size}\n".format(size=numBytesCopied))
+
+
 	def _protocol_DATA(self, matchObj):
 		"""Handler for DATA command: Opens a data connection.  """
 		
-		if self._dataSock:
+		if self._config["data_pool"]:
+			if len(self._dataPool) >= self._config["data_pool"]:
+				sendStr(self._connSock, "ERR DATA POOL FULL\n")
+				return
+		elif self._dataSock:
 			if self._config["persistent"]:
 				sendStr(self._connSock, "ERR DATA ALREADY CONNECTED\n")
 				return
@@ -199,44 +941,201 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 				self._dataSock = None
 			
 		if self._config["passive"]:	
-			dataConn = None
-			try:
-				dataConn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-				dataConn.bind(("", 0))
-				dataConn.settimeout(self._config["timeout"])
-				dataConn.listen(1)
-				dataPort = dataConn.getsockname()[1]
-				sendStr(self._connSock, "READY {p}\n".format(p=dataPort))
-				while True:	
-					(clientDataSock, clientAddr) = dataConn.accept()
-					if clientAddr[0] == self._clientAddr[0]:
-						sendStr(self._connSock, "OK {p}\n".format(p=dataPort))
-						self._dataSock = clientDataSock
-						return
-					else:
-						clientDataSock.close()		
-			except socket.timeout as err:
-				sendStr(self._connSock, "ERR DATA SOCKET TIMEOUT\n")
+			accepted = self._acceptPassiveConnection("READY {port}\n")
+			if accepted:
+				(clientDataSock, dataID) = accepted
+				self._addDataConnection(dataID, clientDataSock)
 		else: # Not passive
 			dataPort = matchObj.group("port")
 			if not dataPort: 
 				sendStr(self._connSock, "ERR NO PORT SPECIFIED\n")
 				return
 			dataPort = int(dataPort)
-			dataSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			if self._unixPath:
+				dataSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				dataAddr = dataSocketPath(self._unixPath, dataPort)
+			else:
+				dataSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+				dataAddr = (self._clientAddr[0], dataPort)
 			dataSock.settimeout(self._config["timeout"])
 			try:
-				dataSock.connect((self._clientAddr[0], dataPort))
+				dataSock.connect(dataAddr)
+				dataSock = self._secureDataConnection(dataSock)
 			except socket.timeout as err:
 				sendStr(self._connSock, "ERR DATA SOCKET TIMEOUT\n")
+			except ssl.SSLError as err:
+				debugPrint("SERVER: TLS handshake on data connection failed: {err}".format(err=err))
+				dataSock.close()
+				sendStr(self._connSock, "ERR TLS HANDSHAKE FAILED\n")
 			except socket.error as err:
 				sendStr(self._connSock, "ERR SOCKET ERROR")
 			else:
-				self._dataSock = dataSock
-				sendStr(self._connSock, "OK {port}\n".format(port=dataPort))
-				return
+				self._addDataConnection(dataPort, dataSock)
 				
 
+	def _protocol_DATA_CHANNEL(self, matchObj):
+		"""Handler for DATA CHANNEL command: Opens a multiplexed data channel
+		on the control connection."""
+		
+		channelID = int(matchObj.group("channel"))
+		if not self._mux:
+			sendStr(self._connSock, "ERR MULTIPLEX NOT ENABLED\n")
+			return
+		elif channelID == 0:
+			sendStr(self._connSock, "ERR CHANNEL 0 IS RESERVED\n")
+			return
+		
+		if self._config["data_pool"]:
+			# Pooled like any other data connection (see _addDataConnection);
+			# keyed apart from them, as a channel ID may equal a port number.
+			if len(self._dataPool) >= self._config["data_pool"]:
+				sendStr(self._connSock, "ERR DATA POOL FULL\n")
+			else:
+				self._dataPool[("CHANNEL", channelID)] = self._mux.channel(channelID)
+				sendStr(self._connSock, "OK CHANNEL {id}\n".format(id=channelID))
+			return
+		if self._dataSock:
+			if self._config["persistent"]:
+				sendStr(self._connSock, "ERR DATA ALREADY CONNECTED\n")
+				return
+			else:
+				self._dataSock.close()
+				self._dataSock = None
+		self._dataSock = self._mux.channel(channelID)
+		sendStr(self._connSock, "OK CHANNEL {id}\n".format(id=channelID))
+		
+
+	def _protocol_DATA_DROP(self, matchObj):
+		"""Handler for DATA DROP command: Closes a pooled data connection."""
+		
+		dataID = int(matchObj.group("id"))
+		if dataID not in self._dataPool:
+			sendStr(self._connSock, "ERR NO SUCH DATA CONNECTION\n")
+		else:
+			self._dataPool.pop(dataID).close()
+			sendStr(self._connSock, "OK DROPPED {id}\n".format(id=dataID))
+
+
+	def _protocol_GETFD(self, matchObj):
+		"""Handler for the GETFD command: Passes an open descriptor of a file
+		to a local client."""
+		
+		if (not self._unixPath or self._mux or not hasattr(socket, "send_fds")
+				or self.bandwidth.allocation(self._config["rate_limit"]) > 0):
+			sendStr(self._connSock, "ERR FD PASSING UNAVAILABLE\n")
+			return
+		fileName = matchObj.group("filename")
+		if self._checkGetFile(fileName) is None:
+			return
+		try:
+			fileFD = os.open(fileName, os.O_RDONLY | os.O_CLOEXEC)
+		except OSError:
+			sendStr(self._connSock, "ERR CANNOT READ FILE\n")
+			return
+		try:
+			# (Checked again, now that it is open, in case it was replaced.)
+			fileStat = os.fstat(fileFD)
+			if not stat.S_ISREG(fileStat.st_mode):
+				sendStr(self._connSock, "ERR FILE DOES NOT EXIST\n")
+				return
+			debugPrint("SERVER: Passing a descriptor of {fname}".format(fname=fileName))
+			reply = "OK FD {size}\n".format(size=fileStat.st_size).encode()
+			socket.send_fds(self._connSock, [reply], [fileFD])
+		finally:
+			os.close(fileFD)
+
+
+	def _protocol_GETIF(self, matchObj):
+		"""Handler for the GETIF command: Checks whether a file has changed
+		since the client's copy was downloaded."""
+		
+		fileName = matchObj.group("filename")
+		fileStat = self._checkGetFile(fileName)
+		if fileStat is None:
+			return
+		if matchObj.group("digest"):
+			digest = self._digestIndex().get(fileName, fileStat)
+			unchanged = digest == matchObj.group("digest").lower()
+		else:
+			unchanged = (int(matchObj.group("size")) == fileStat.st_size and
+					int(matchObj.group("mtime")) == fileStat.st_mtime_ns)
+		if unchanged:
+			sendStr(self._connSock, "NOT MODIFIED\n")
+		else:
+			sendStr(self._connSock, "MODIFIED {size} {mtime}\n".format(size=fileStat.st_size,
+					mtime=fileStat.st_mtime_ns))
+
+
+	def _protocol_GETTREE(self, matchObj):
+		"""Handler for the GETTREE command: Downloads a directory tree from the
+		server."""
+		
+		dirName = matchObj.group("dirname")
+		options = matchObj.group("options")
+		globs = re.findall(r"(INCLUDE|EXCLUDE) (\S+)", options)
+		if not isdir(dirName):
+			sendStr(self._connSock, "ERR DIRECTORY DOES NOT EXIST\n")
+			return
+		sendStr(self._connSock, "READY TREE\n")
+		debugPrint("SERVER: Sending tree {dname}".format(dname=dirName))
+		try:
+			with self.bandwidth.transfer(self._config["rate_limit"]) as limiter:
+				(numFiles, numBytes) = sendTree(self._dataSock, dirName,
+						self._config["chunk_size"], limiter,
+						includes=[glob for (kind, glob) in globs if kind == "INCLUDE"],
+						excludes=[glob for (kind, glob) in globs if kind == "EXCLUDE"],
+						compress=(" COMPRESS" in options))
+		except (PermissionError, IOError):
+			sendStr(self._connSock, "ERR CANNOT READ TREE\n")
+		else:
+			sendStr(self._connSock, "OK {files} {size}\n".format(files=numFiles, size=numBytes))
+
+
+	def _protocol_FIND(self, matchObj):
+		"""Handler for the FIND command: Searches the served tree."""
+		
+		options = dict(re.findall(r"(MINSIZE|MAXSIZE|NEWER|LIMIT) (\d+)",
+				matchObj.group("options")))
+		if not self.fileIndex:
+			sendStr(self._connSock, "ERR NO FILE INDEX\n")
+			return
+		matches = self.fileIndex.find(matchObj.group("pattern"),
+				minSize=(int(options["MINSIZE"]) if "MINSIZE" in options else None),
+				maxSize=(int(options["MAXSIZE"]) if "MAXSIZE" in options else None),
+				newer=(int(options["NEWER"]) if "NEWER" in options else None),
+				limit=int(options.get("LIMIT", 1000)))
+		reply = "OK {lines}\n".format(lines=len(matches))
+		for (entryType, size, mtime, path) in matches:
+			reply += "{type} {size} {mtime} {path}\n".format(type=entryType, size=size,
+					mtime=mtime, path=path)
+		sendStr(self._connSock, reply)
+
+
+	def _protocol_FOLLOW(self, matchObj):
+		"""Handler for the FOLLOW command: Streams a growing file."""
+		
+		fileName = matchObj.group("filename")
+		offset = int(matchObj.group("offset") or 0)
+		fileStat = self._checkGetFile(fileName)
+		if fileStat is None:
+			return
+		elif offset > fileStat.st_size:
+			sendStr(self._connSock, "ERR OFFSET IS PAST END OF FILE\n")
+			return
+		try:
+			watchID = self.watches.follow(self._dataSock, fileName, offset)
+		except OSError as err:
+			debugPrint("SERVER: Cannot follow {fname}: {err}".format(fname=fileName, err=err))
+			sendStr(self._connSock, "ERR CANNOT FOLLOW FILE\n")
+			return
+		# The data connection now belongs to the watch.
+		self._dataSock = None
+		self._watchIDs.append(watchID)
+		debugPrint("SERVER: Following {fname} from {offset} (watch {id})".format(
+				fname=fileName, offset=offset, id=watchID))
+		sendStr(self._connSock, "OK FOLLOWING {id}\n".format(id=watchID))
+
+
 	def _protocol_GO_AWAY(self, matchObj):
 		"""Handler for GO AWAY command: Closes the control connection."""
 		
@@ -252,12 +1151,25 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 	def _protocol_GETCONFIG(self, matchObj):
 		"""Handler for GETCONFIG command: Retrieves some configuration data."""
 		
-		conf = "OK 5\n"
-		conf += "CHUNKSIZE {size}\n".format(size=self._config["chunk_size"])
+		conf = "OK 15\n"
+		conf += "CHUNKSIZE {size}\n".format(
+				size="AUTO" if self._tuner else self._config["chunk_size"])
+		conf += "DATAPOOL {size}\n".format(size=self._config["data_pool"])
+		conf += "DURABILITY {policy}\n".format(policy=self._config["durability"])
+		conf += "IOPOLICY {policy}\n".format(policy=self._config["io_policy"])
+		conf += "IOTHRESHOLD {size}\n".format(size=self._config["io_threshold"])
+		conf += "MULTIPLEX {yn}\n".format(yn="YES" if self._mux else "NO")
 		conf += "PASSIVE {yn}\n".format(yn="YES" if self._config["persistent"] else "NO")
 		conf += "PERSISTENTDATA {yn}\n".format(yn="YES" if self._config["persistent"] else "NO")
 		conf += "PUTBEHAVIOR {put}\n".format(put=self._config["put_behavior"])
+		conf += "QUEUEDEPTH {depth}\n".format(depth=self._config["queue_depth"])
+		conf += "RATELIMIT {rate}\n".format(rate=self._config["rate_limit"])
 		conf += "SOCKETTIMEOUT {timeout}\n".format(timeout=self._config["timeout"])
+		conf += "SPARSE {yn}\n".format(yn="YES" if self._config["sparse"] else "NO")
+		conf += "TUNEDCHUNKSIZE {size}\n".format(
+				size=self._tuner.chunkSize if self._tuner else self._config["chunk_size"])
+		conf += "TUNEDSOCKETBUFFER {size}\n".format(
+				size=self._tuner.bufferSize if self._tuner else 0)
 		sendStr(self._connSock, conf)
 
 
@@ -265,21 +1177,47 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 		"""Handler for the GET command: Downloads a file from the server."""
 		
 		fileName = matchObj.group("filename")
-		if isdir(fileName):
-			sendStr(self._connSock, "ERR FILE IS A DIRECTORY\n")
-		elif not isfile(fileName):
-			sendStr(self._connSock, "ERR FILE DOES NOT EXIST\n")
+		fileStat = self._checkGetFile(fileName)
+		if fileStat is not None:
+			sendStr(self._connSock, "READY {size}\n".format(size=fileStat.st_size))
+			self._sendFileData(self._dataSock, fileName, fileStat)
+
+
+	def _protocol_HASH(self, matchObj):
+		"""Handler for the HASH command: Gives the digest of a file."""
+		
+		fileName = matchObj.group("filename")
+		fileStat = self._checkGetFile(fileName)
+		if fileStat is None:
+			return
+		digest = self._digestIndex().get(fileName, fileStat)
+		if digest is None:
+			sendStr(self._connSock, "ERR CANNOT READ FILE\n")
 		else:
-			fileSize = getsize(fileName)
-			debugPrint("SERVER: Sending {fname}".format(fname=fileName))
-			try:
-				sendStr(self._connSock, "READY {size}\n".format(size=fileSize))
-				sendFile(self._dataSock, fileName, self._config["chunk_size"])
-			except (PermissionError, IOError):
-				sendStr(self._connSock, "ERR CANNOT READ FILE\n")
-			else:
-				sendStr(self._connSock, "OK {size}\n".format(size=fileSize))
+			sendStr(self._connSock, "OK {digest}\n".format(digest=digest))
+
 
+	def _protocol_HASHDIR(self, matchObj):
+		"""Handler for the HASHDIR command: Gives the digests of all of the
+		files in a directory tree."""
+		
+		dirName = matchObj.group("dirname")
+		if not isdir(dirName):
+			sendStr(self._connSock, "ERR DIRECTORY DOES NOT EXIST\n")
+			return
+		files = []
+		for (entry, relPath) in walkTree(dirName):
+			try:
+				if entry.is_file(follow_symlinks=False):
+					files.append((entry.path, entry.stat(follow_symlinks=False), relPath))
+			except OSError:
+				pass
+		digests = self._digestIndex().getMany([(path, fileStat)
+				for (path, fileStat, relPath) in files])
+		reply = "OK {lines}\n".format(lines=len(files))
+		for ((path, fileStat, relPath), digest) in zip(files, digests):
+			reply += "{digest} {name}\n".format(digest=digest or "-", name=relPath)
+		sendStr(self._connSock, reply)
 
 
 	def _protocol_LS(self, matchObj):
@@ -294,49 +1232,207 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 			sendStr(self._dataSock,  listFiles("."))
 
 		
+	def _protocol_MOVE(self, matchObj):
+		"""Handler for MOVE command: Moves (renames) a file on the server."""
+		
+		(srcName, dstName) = matchObj.group("src", "dst")
+		checked = self._checkCopyFiles(srcName, dstName)
+		if checked is None:
+			return
+		(srcStat, fileMode) = checked
+		if fileMode == "wb":
+			try:
+				os.replace(srcName, dstName)
+			except OSError as err:
+				if err.errno != errno.EXDEV:
+					sendStr(self._connSock, "ERR CANNOT MOVE FILE\n")
+					return
+			else:
+				if self._config["durability"] != "NONE":
+					for dirName in {os.path.dirname(os.path.abspath(name))
+							for name in (srcName, dstName)}:
+						fsyncDirectory(dirName)
+				self._fileChanged(srcName)
+				self._fileChanged(dstName)
+				sendStr(self._connSock, "OK {size}\n".format(size=srcStat.st_size))
+				return
+		
+		# Appending, or moving to another file system: copy, then delete.
+		reservation = self._reserveSpace(dstName, srcStat.st_size, fileMode)
+		if reservation is None:
+			return
+		numBytesCopied = self._copyFile(srcName, srcStat, dstName, fileMode, reservation)
+		if numBytesCopied is None:
+			return
+		try:
+			os.unlink(srcName)
+		except OSError:
+			sendStr(self._connSock, "ERR COPIED BUT CANNOT DELETE SOURCE\n")
+		else:
+			self._fileChanged(srcName)
+			sendStr(self._connSock, "OK {size}\n".format(size=numBytesCopied))
+
+
+	def _protocol_PGET(self, matchObj):
+		"""Handler for the PGET command: Downloads a file from the server over
+		a new passive data connection, set up in the same exchange."""
+		
+		fileName = matchObj.group("filename")
+		fileStat = self._checkGetFile(fileName)
+		if fileStat is None:
+			return
+		accepted = self._acceptPassiveConnection("READY {{port}} {size}\n".format(
+				size=fileStat.st_size))
+		if accepted:
+			(dataSock, dataID) = accepted
+			try:
+				self._sendFileData(dataSock, fileName, fileStat)
+			finally:
+				dataSock.close()
+
+
+	def _protocol_PPUT(self, matchObj):
+		"""Handler for the PPUT command: Uploads a file to the server over a
+		new passive data connection, set up in the same exchange."""
+		
+		fileName = matchObj.group("filename")
+		fileSize = int(matchObj.group("size"))
+		admission = self._checkPutFile(fileName, fileSize)
+		if admission is None:
+			return
+		(fileMode, reservation) = admission
+		with reservation:
+			accepted = self._acceptPassiveConnection("READY {{port}} {size}\n".format(
+					size=fileSize))
+			if accepted:
+				(dataSock, dataID) = accepted
+				try:
+					self._recvFileData(dataSock, fileName, fileSize, fileMode, reservation)
+				finally:
+					dataSock.close()
+
+
 	def _protocol_PUT(self, matchObj):
 		"""Handler for the PUT command: Uploads a file to the server."""
 		
-		behavior = self._config["put_behavior"]
 		fileName = matchObj.group("filename")
 		fileSize = int(matchObj.group("size"))
-		fileMode = "wb"
+		admission = self._checkPutFile(fileName, fileSize)
+		if admission is not None:
+			(fileMode, reservation) = admission
+			with reservation:
+				sendStr(self._connSock, "READY {size}\n".format(size=fileSize))
+				self._recvFileData(self._dataSock, fileName, fileSize, fileMode, reservation)
+
+
+	def _protocol_PUTTREE(self, matchObj):
+		"""Handler for the PUTTREE command: Uploads a directory tree to the
+		server."""
 		
-		if isdir(fileName):
-			sendStr(self._connSock, "ERR FILE IS A DIRECTORY\n")
+		dirName = matchObj.group("dirname")
+		treeSize = int(matchObj.group("size"))
+		if os.path.lexists(dirName) and not isdir(dirName):
+			sendStr(self._connSock, "ERR NOT A DIRECTORY\n")
 			return
-		elif isfile(fileName):
-			if behavior == "ERROR":
-				sendStr(self._connSock, "ERR FILE EXISTS\n")
-				return
-			elif behavior == "APPEND":
-				fileMode = "ab"
-		
-		sendStr(self._connSock, "READY {size}\n".format(size=fileSize, name=fileName))
-		chunkSize = self._config["chunk_size"]
-		try:
-			numBytesWritten = recvFile(self._dataSock, fileSize, fileName, fileMode, chunkSize)
-		except (PermissionError, IOError):
-			sendStr(self._connSock, "ERR CANNOT WRITE TO FILE\n")
-		else:
-			if numBytesWritten < fileSize:
-				sendStr(self._connSock, "ERR INCOMPLETE DATA\n")
+		elif isdir(dirName) and self._config["put_behavior"] == "ERROR":
+			sendStr(self._connSock, "ERR DIRECTORY EXISTS\n")
+			return
+		reservation = self._reserveSpace(dirName, treeSize, "wb")
+		if reservation is None:
+			return
+		with reservation:
+			sendStr(self._connSock, "READY {size}\n".format(size=treeSize))
+			try:
+				with self.bandwidth.transfer(self._config["rate_limit"]) as limiter:
+					(numFiles, numBytes) = recvTree(self._dataSock, dirName, treeSize, limiter)
+			except TreeStreamError as err:
+				sendStr(self._connSock, "ERR {reason}\n".format(reason=err))
+			except (PermissionError, IOError):
+				sendStr(self._connSock, "ERR CANNOT WRITE TO FILE\n")
 			else:
-				sendStr(self._connSock, "OK {size}\n".format(size=fileSize))
+				reservation.commit(numBytes)
+				self._bytesUploaded += numBytes
+				self._fileChanged(dirName)
+				sendStr(self._connSock, "OK {files} {size}\n".format(files=numFiles, size=numBytes))
 
 
 	def _protocol_SETCONFIG_CHUNKSIZE(self, matchObj):
 		"""Handler for the SETCONFIG CHUNKSIZE command: Changes the transfer
 		chunk size (bytes)."""
 		
-		value = int(matchObj.group("value"))
-		if value < 1:
+		value = matchObj.group("value")
+		if value == "AUTO":
+			if not self._tuner:
+				self._tuner = ChunkTuner(self._config["chunk_size"])
+			sendStr(self._connSock, "OK CHUNKSIZE AUTO\n")
+		elif int(value) < 1:
 			sendStr(self._connSock, "ERR CHUNKSIZE MUST BE POSITIVE")
 		else:
-			self._config["chunk_size"] = value
+			self._tuner = None
+			self._config["chunk_size"] = int(value)
 			sendStr(self._connSock, "OK CHUNKSIZE {size}\n".format(size=value))
 	
 	
+	def _protocol_SETCONFIG_DATAPOOL(self, matchObj):
+		"""Handler for the SETCONFIG DATAPOOL command: Changes the number of
+		pooled data connections the client may keep open."""
+		
+		value = int(matchObj.group("value"))
+		self._config["data_pool"] = value
+		while len(self._dataPool) > value:
+			self._dataPool.popitem()[1].close()
+		sendStr(self._connSock, "OK DATAPOOL {size}\n".format(size=value))
+		
+		
+	def _protocol_SETCONFIG_DURABILITY(self, matchObj):
+		"""Handler for the SETCONFIG DURABILITY command: Changes how uploaded
+		files are made durable."""
+		
+		value = matchObj.group("value")
+		self._config["durability"] = value
+		sendStr(self._connSock, "OK DURABILITY {policy}\n".format(policy=value))
+		
+		
+	def _protocol_SETCONFIG_IOPOLICY(self, matchObj):
+		"""Handler for the SETCONFIG IOPOLICY command: Changes how transfers of
+		large files use the page cache."""
+		
+		value = matchObj.group("value")
+		self._config["io_policy"] = value
+		sendStr(self._connSock, "OK IOPOLICY {policy}\n".format(policy=value))
+		
+		
+	def _protocol_SETCONFIG_IOTHRESHOLD(self, matchObj):
+		"""Handler for the SETCONFIG IOTHRESHOLD command: Changes the smallest
+		file size to which the I/O policy applies."""
+		
+		value = int(matchObj.group("value"))
+		self._config["io_threshold"] = value
+		sendStr(self._connSock, "OK IOTHRESHOLD {size}\n".format(size=value))
+		
+		
+	def _protocol_SETCONFIG_MULTIPLEX(self, matchObj):
+		"""Handler for the SETCONFIG MULTIPLEX command: Enables/disables the
+		multiplexed transport on the control connection."""
+		
+		value = matchObj.group("value")
+		sendStr(self._connSock, "OK MULTIPLEX {option}\n".format(
+				option="ENABLED" if value == "YES" else "DISABLED"))
+		if value == "YES" and not self._mux:
+			self._mux = Multiplexer(self._connSock)
+			self._connSock = self._mux.channel(0)
+		elif value == "NO" and self._mux:
+			# Any multiplexed data channels (current or pooled) go away with
+			# the multiplexer.
+			if isinstance(self._dataSock, MuxChannel):
+				self._dataSock = None
+			for (dataID, dataSock) in list(self._dataPool.items()):
+				if isinstance(dataSock, MuxChannel):
+					del self._dataPool[dataID]
+			self._connSock = self._mux.rawSocket
+			self._mux = None
+		
+		
 	def _protocol_SETCONFIG_PASSIVE(self, matchObj):
 		"""Handler for the SETCONFIG PASSIVE command: Enables/disables passive
 		data transfer mode."""
@@ -353,6 +1449,11 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 		
 		value = matchObj.group("value")
 		self._config["persistent"] = (value == "YES")
+		if value == "NO" and self._dataSock:
+			# The client closes its end of the current data connection too,
+			# and takes the next pooled one (if any) for its next transfer.
+			self._dataSock.close()
+			self._dataSock = None
 		sendStr(self._connSock, "OK PERSISTENTDATA {option}\n".format(
 				option="ENABLED" if value == "YES" else "DISABLED"))
 		
@@ -366,10 +1467,127 @@ class SimpleFTPServerConnectionHandler(ServerConnectionHandler):
 		sendStr(self._connSock, "OK PUTBEHAVIOR {action}\n".format(action=value))
 		
 		
+	def _protocol_SETCONFIG_QUEUEDEPTH(self, matchObj):
+		"""Handler for the SETCONFIG QUEUEDEPTH command: Changes the number of
+		chunks queued between the disk and network halves of a transfer."""
+		
+		value = int(matchObj.group("value"))
+		self._config["queue_depth"] = value
+		sendStr(self._connSock, "OK QUEUEDEPTH {depth}\n".format(depth=value))
+		
+		
+	def _protocol_SETCONFIG_RATELIMIT(self, matchObj):
+		"""Handler for the SETCONFIG RATELIMIT command: Changes the transfer
+		rate limit (bytes per second) of this connection."""
+		
+		value = self.bandwidth.sessionRate(int(matchObj.group("value")))
+		self._config["rate_limit"] = value
+		sendStr(self._connSock, "OK RATELIMIT {rate}\n".format(rate=value))
+		
+		
 	def _protocol_SETCONFIG_SOCKETTIMEOUT(self, matchObj):
 		"""Handler for the SETCONFIG SOCKETTIMEOUT command: Changes the socket
 		timeout."""
 		
-		value = matchObj.group("value")
+		value = int(matchObj.group("value"))
 		self._config["timeout"] = value
 		sendStr(self._connSock, "OK TIMEOUT {timeout}\n".format(timeout=value))
+
+
+	def _protocol_SETCONFIG_SPARSE(self, matchObj):
+		"""Handler for the SETCONFIG SPARSE command: Enables/disables sparse
+		file transfers."""
+		
+		value = matchObj.group("value")
+		self._config["sparse"] = (value == "YES")
+		sendStr(self._connSock, "OK SPARSE {option}\n".format(
+				option="ENABLED" if value == "YES" else "DISABLED"))
+
+
+	def _protocol_STAT(self, matchObj):
+		"""Handler for STAT command: Describes a file on the server."""
+		
+		description = self._describeFile(matchObj.group("filename"),
+				withHash=bool(matchObj.group("hash")))
+		if description is None:
+			sendStr(self._connSock, "ERR FILE DOES NOT EXIST\n")
+		else:
+			sendStr(self._connSock, "OK {desc}\n".format(desc=description))
+
+
+	def _protocol_STATM(self, matchObj):
+		"""Handler for STATM command: Describes several files on the server."""
+		
+		withHash = bool(matchObj.group("hash"))
+		fileNames = matchObj.group("filenames").split()
+		reply = "OK {lines}\n".format(lines=len(fileNames))
+		for fileName in fileNames:
+			description = self._describeFile(fileName, withHash)
+			if description is None:
+				description = "NONE 0 0" + (" -" if withHash else "")
+			reply += "{desc} {name}\n".format(desc=description, name=fileName)
+		sendStr(self._connSock, reply)
+
+
+	def _protocol_STATS(self, matchObj):
+		"""Handler for STATS command: Retrieves the server-wide state."""
+		
+		stats = self.bandwidth.status() + self.space.status()
+		if self.fileCache:
+			stats += self.fileCache.status()
+		if self.mappings:
+			stats += self.mappings.status()
+		if self.digests:
+			stats += self.digests.status()
+		if self.fileIndex:
+			stats += self.fileIndex.status()
+		stats += self.watches.status()
+		reply = "OK {lines}\n".format(lines=len(stats))
+		for (name, value) in stats:
+			reply += "{name} {value}\n".format(name=name, value=value)
+		sendStr(self._connSock, reply)
+
+
+	def _protocol_UNWATCH(self, matchObj):
+		"""Handler for the UNWATCH command: Stops one or all of the
+		connection's watches."""
+		
+		watchIDs = list(self._watchIDs)
+		if matchObj.group("id"):
+			watchIDs = [int(matchObj.group("id"))]
+			if watchIDs[0] not in self._watchIDs:
+				sendStr(self._connSock, "ERR NO SUCH WATCH\n")
+				return
+		numStopped = 0
+		for watchID in watchIDs:
+			self._watchIDs.remove(watchID)
+			# (It may have ended already, if its directory was removed.)
+			if self.watches.unsubscribe(watchID):
+				numStopped += 1
+		sendStr(self._connSock, "OK {count}\n".format(count=numStopped))
+
+
+	def _protocol_WATCH(self, matchObj):
+		"""Handler for the WATCH command: Streams change events for the
+		matching files on the data connection."""
+		
+		(dirName, sep, pattern) = (matchObj.group("pattern") or "*").rpartition("/")
+		dirName = dirName or ("/" if sep else ".")
+		if re.search(r"[*?[]", dirName) or not pattern:
+			sendStr(self._connSock, "ERR ONLY FILE NAMES MAY BE GLOBS\n")
+			return
+		elif not isdir(dirName):
+			sendStr(self._connSock, "ERR DIRECTORY DOES NOT EXIST\n")
+			return
+		try:
+			watchID = self.watches.subscribe(self._dataSock, dirName, pattern)
+		except OSError as err:
+			debugPrint("SERVER: Cannot watch {dname}: {err}".format(dname=dirName, err=err))
+			sendStr(self._connSock, "ERR CANNOT WATCH DIRECTORY\n")
+			return
+		# The data connection now belongs to the watch.
+		self._dataSock = None
+		self._watchIDs.append(watchID)
+		debugPrint("SERVER: Watching {glob} (watch {id})".format(
+				glob=matchObj.group("pattern") or "*", id=watchID))
+		sendStr(self._connSock, "OK WATCHING {id}\n".format(id=watchID))
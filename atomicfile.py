@@ -0,0 +1,300 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the AtomicFile and GroupCommitter classes, used by the
+server to store uploaded (or copied) files atomically. Data is written to a temporary
+file (preallocated to its final size) in the same directory as the
+destination, which is then renamed over it only once the upload is complete;
+so other clients never see a partly written file, and a failed upload leaves
+the original (if any) untouched.
+
+How durable a committed file is depends on the policy given to commit():
+	NONE -- Just rename it into place; the data reaches the disk whenever the
+		operating system gets around to it.
+	FSYNC -- Flush the file (and then its directory) to the disk before
+		returning.
+	GROUP -- Rename it into place at once, and have a background thread flush
+		it to the disk along with any others committed at about the same time
+		(so that many small uploads share the cost).
+
+It also provides copyData, for copying files within the server as
+efficiently as the file system allows."""
+
+# Example usage:
+# >>> with AtomicFile(fileName, fileSize) as outFile:
+# ...     outFile.file.write(data)
+# ...     outFile.commit("FSYNC")
+
+import os
+import shutil
+import threading
+import time
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+
+DURABILITY_POLICIES = ("NONE", "FSYNC", "GROUP")
+
+# The Linux ioctl which makes one file share (reflink) all of another's data
+# blocks, copy-on-write, on file systems which support it (such as Btrfs and
+# XFS).
+FICLONE = 0x40049409
+
+
+def copyData(srcFD, dstFD, numBytes, clone=False):
+	"""Copies numBytes from the current position of one open file descriptor
+	to that of another, advancing both; returns the number of bytes copied
+	(less than numBytes only if the source ended early). If clone is set (so
+	the whole source file is being copied to an empty file), it is first
+	tried as a reflink, which copies no data at all; otherwise, or if that is
+	not supported, os.copy_file_range copies the data within the kernel
+	(which some file systems also turn into a reflink); and failing that, it
+	is read and written as usual."""
+
+	if clone and fcntl:
+		try:
+			fcntl.ioctl(dstFD, FICLONE, srcFD)
+		except OSError:
+			pass
+		else:
+			os.lseek(srcFD, numBytes, os.SEEK_SET)
+			os.lseek(dstFD, 0, os.SEEK_END)
+			return numBytes
+
+	numCopied = 0
+	if hasattr(os, "copy_file_range"):
+		try:
+			while numCopied < numBytes:
+				copied = os.copy_file_range(srcFD, dstFD, numBytes - numCopied)
+				if not copied:
+					return numCopied
+				numCopied += copied
+		except OSError:
+			pass # (Such as EXDEV, on older kernels, or ENOSYS.)
+	while numCopied < numBytes:
+		data = os.read(srcFD, min(2**20, numBytes - numCopied))
+		if not data:
+			break
+		written = 0
+		while written < len(data):
+			written += os.write(dstFD, data[written:])
+		numCopied += len(data)
+	return numCopied
+
+
+def fsyncDirectory(dirName):
+	"""Flushes a directory's entries (such as a rename) to the disk, where the
+	platform supports it."""
+
+	try:
+		dirFD = os.open(dirName, os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(dirFD)
+	except OSError:
+		pass
+	finally:
+		os.close(dirFD)
+
+
+class AtomicFile:
+	"""A temporary file which replaces the named file when committed, for use
+	in a with statement; if it is not committed by the end of the block, it
+	is deleted instead. Data is written through the file attribute (a binary
+	file object). The temporary file is preallocated with room for fileSize
+	more bytes, which helps avoid fragmentation of large files. If append is
+	set, the named file's current contents are copied into the temporary file
+	first, so that the data is added to their end. (The file keeps the named
+	file's permissions, if it exists.) The preallocated attribute tells
+	whether the space was actually allocated up front; not all file systems
+	support it. (Preallocation can also be turned off, such as for a file
+	which is to have holes.)"""
+
+	__slots__ = ("_committed", "_dirName", "_fileName", "_tmpPath", "file", "preallocated")
+
+	def __init__(self, fileName, fileSize, append=False, preallocate=True):
+		self._committed = False
+		self.preallocated = False
+		self._dirName = os.path.dirname(os.path.abspath(fileName))
+		self._fileName = fileName
+		while True:
+			self._tmpPath = os.path.join(self._dirName, ".{name}.{tag}.part".format(
+					name=os.path.basename(fileName), tag=os.urandom(4).hex()))
+			try:
+				# (Creating it with the usual permissions lets the umask apply.)
+				tmpFD = os.open(self._tmpPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+				break
+			except FileExistsError:
+				pass
+		self.file = os.fdopen(tmpFD, "wb")
+
+		try:
+			if os.path.isfile(fileName):
+				shutil.copymode(fileName, self._tmpPath)
+				if append:
+					with open(fileName, "rb") as oldFile:
+						oldSize = os.fstat(oldFile.fileno()).st_size
+						copyData(oldFile.fileno(), tmpFD, oldSize, clone=True)
+			if preallocate and hasattr(os, "posix_fallocate") and fileSize > 0:
+				try:
+					os.posix_fallocate(tmpFD, os.lseek(tmpFD, 0, os.SEEK_CUR), fileSize)
+					self.preallocated = True
+				except OSError:
+					pass # Not supported by this file system; that's fine.
+		except BaseException:
+			self._discard()
+			raise
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *excInfo):
+		if not self._committed:
+			self._discard()
+
+
+	def commit(self, durability="NONE"):
+		"""Replaces the named file with this one, making the data durable
+		according to the given policy (see DURABILITY_POLICIES)."""
+
+		self.file.flush()
+		if durability == "FSYNC":
+			os.fsync(self.file.fileno())
+		os.replace(self._tmpPath, self._fileName)
+		self._committed = True
+		if durability == "FSYNC":
+			self.file.close()
+			fsyncDirectory(self._dirName)
+		elif durability == "GROUP":
+			GroupCommitter.forProcess().submit(os.dup(self.file.fileno()), self._dirName)
+			self.file.close()
+		else:
+			self.file.close()
+
+
+	def _discard(self):
+		self.file.close()
+		try:
+			os.unlink(self._tmpPath)
+		except OSError:
+			pass
+
+
+class GroupCommitter:
+	"""A background thread which flushes committed files to the disk in
+	batches: it waits a short while (BATCH_INTERVAL) after a file arrives, so
+	that others committed meanwhile can join the batch, then flushes all of
+	the files followed by each of their directories once. There is one per
+	process (see forProcess), since threads do not survive a fork."""
+
+	__slots__ = ("_busy", "_cond", "_pending", "_thread")
+
+	# How long (seconds) to wait for more files before flushing a batch.
+	BATCH_INTERVAL = 0.05
+
+	# The most files (that is, open file descriptors) to hold in a batch.
+	MAX_BATCH = 256
+
+	_instance = None
+	_instancePID = None
+
+	def __init__(self):
+		self._busy = False
+		self._cond = threading.Condition()
+		self._pending = []
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+
+	@classmethod
+	def forProcess(cls):
+		"""Returns the current process's GroupCommitter, starting it if needed."""
+
+		if cls._instancePID != os.getpid():
+			cls._instance = cls()
+			cls._instancePID = os.getpid()
+		return cls._instance
+
+
+	@classmethod
+	def flushProcess(cls):
+		"""Flushes the current process's GroupCommitter (as in flush), if it
+		has one."""
+
+		if cls._instancePID == os.getpid():
+			cls._instance.flush()
+
+
+	def flush(self):
+		"""Blocks until every file submitted so far has been flushed."""
+
+		with self._cond:
+			while self._pending or self._busy:
+				self._cond.wait()
+
+
+	def submit(self, fileFD, dirName):
+		"""Queues the given file descriptor (which the committer then owns, and
+		closes) to be flushed, along with the named directory."""
+
+		with self._cond:
+			while len(self._pending) >= self.MAX_BATCH:
+				self._cond.wait()
+			self._pending.append((fileFD, dirName))
+			self._cond.notify_all()
+
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._pending:
+					self._cond.wait()
+				deadline = time.monotonic() + self.BATCH_INTERVAL
+				while len(self._pending) < self.MAX_BATCH and time.monotonic() < deadline:
+					self._cond.wait(deadline - time.monotonic())
+				(batch, self._pending) = (self._pending, [])
+				self._busy = True
+				self._cond.notify_all()
+			for (fileFD, dirName) in batch:
+				try:
+					os.fsync(fileFD)
+				except OSError:
+					pass
+				finally:
+					os.close(fileFD)
+			for dirName in set(dirName for (fileFD, dirName) in batch):
+				fsyncDirectory(dirName)
+			with self._cond:
+				self._busy = False
+				self._cond.notify_all()
@@ -0,0 +1,135 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the ChunkTuner type, which picks the transfer chunk
+size and socket buffer sizes automatically (the "AUTO" chunk size mode) by
+measuring throughput while a transfer runs."""
+
+# Example usage:
+# >>> tuner = ChunkTuner()
+# >>> sendFile(dataSock, fileName, tuner.chunkSize, tuner=tuner)
+# >>> print("Settled on {} byte chunks".format(tuner.chunkSize))
+
+import socket
+
+from time import monotonic
+
+
+class ChunkTuner:
+	"""Tunes the chunk size by simple hill climbing: throughput is measured
+	over short windows, and after each window the chunk size is doubled or
+	halved, continuing in the same direction while throughput improves and
+	turning around when it drops. The socket send/receive buffers are sized to
+	hold a couple of chunks. One tuner is kept per session, so what it learns
+	carries over from one transfer (and data socket) to the next."""
+
+	__slots__ = ("_bufferSize", "_chunkSize", "_direction", "_lastRate", "_sock",
+			"_windowBytes", "_windowStart")
+
+	MIN_CHUNK_SIZE = 4096
+	MAX_CHUNK_SIZE = 4 * 2**20
+	WINDOW_SECONDS = 0.2
+
+	def __init__(self, chunkSize=65536):
+		self._chunkSize = chunkSize
+		self._bufferSize = 0
+		self._direction = 1
+		self._lastRate = 0
+		self._sock = None
+		self._windowBytes = 0
+		self._windowStart = None
+
+
+	def attach(self, sock):
+		"""Starts tuning a new transfer on the given socket, applying the
+		current buffer sizes to it."""
+
+		self._sock = sock
+		self._windowBytes = 0
+		self._windowStart = None
+		self._lastRate = 0
+		self._applyBufferSize()
+
+
+	def record(self, numBytes):
+		"""Accounts for numBytes just sent or received. At the end of each
+		measurement window, this moves the chunk size one step."""
+
+		now = monotonic()
+		if self._windowStart is None:
+			self._windowStart = now
+		self._windowBytes += numBytes
+		elapsed = now - self._windowStart
+		if elapsed < self.WINDOW_SECONDS:
+			return
+
+		rate = self._windowBytes / elapsed
+		if rate < self._lastRate:
+			self._direction = -self._direction
+		self._lastRate = rate
+		self._windowBytes = 0
+		self._windowStart = now
+
+		if self._direction > 0:
+			newSize = min(self._chunkSize * 2, self.MAX_CHUNK_SIZE)
+		else:
+			newSize = max(self._chunkSize // 2, self.MIN_CHUNK_SIZE)
+		if newSize == self._chunkSize:
+			# Hit one of the bounds; try the other way next time.
+			self._direction = -self._direction
+		else:
+			self._chunkSize = newSize
+			self._applyBufferSize()
+
+
+	def _applyBufferSize(self):
+		"""Sizes the socket's send and receive buffers to hold two chunks, and
+		records the size the kernel actually gave them."""
+
+		if not self._sock:
+			return
+		try:
+			self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2 * self._chunkSize)
+			self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 * self._chunkSize)
+			self._bufferSize = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+		except (AttributeError, OSError):
+			# Not a real socket (or one which doesn't take these options).
+			pass
+
+
+	@property
+	def bufferSize(self):
+		"""The most recently applied socket buffer size (bytes), or 0 if no
+		buffer size has been set yet."""
+
+		return self._bufferSize
+
+
+	@property
+	def chunkSize(self):
+		return self._chunkSize
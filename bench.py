@@ -0,0 +1,534 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+"""This module (bench.py) provides some benchmarks of the server. Each one
+starts the server (as a child process, in a scratch directory) once for each
+of the configurations being compared, runs a workload against it, and prints
+a table of the results. It can be invoked as follows:
+$ python3 bench.py <benchmark> [options]
+(See "python3 bench.py --help" for the available benchmarks and options.)"""
+
+
+import argparse
+import ctypes
+import ctypes.util
+import mmap
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from tls import clientContext, KTLS_OPTION, wrapDataSocket
+from utils import dataSocketPath, recvLine, sendStr
+
+
+def cachedFraction(fileNames):
+	"""Returns the fraction of the pages of the given files which are
+	currently in the page cache (using mincore), or None if that cannot be
+	determined on this platform."""
+
+	libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+	if not hasattr(libc, "mincore"):
+		return None
+	(numPages, numCached) = (0, 0)
+	for fileName in fileNames:
+		size = os.path.getsize(fileName)
+		if not size:
+			continue
+		pages = -(-size // mmap.PAGESIZE)
+		with open(fileName, "rb") as inFile:
+			# (A private mapping, since ctypes needs a writable buffer; it still
+			# shares the file's cached pages until written to.)
+			mapping = mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_COPY)
+		try:
+			address = ctypes.addressof(ctypes.c_char.from_buffer(mapping))
+			residency = (ctypes.c_ubyte * pages)()
+			if libc.mincore(ctypes.c_void_p(address), ctypes.c_size_t(size), residency):
+				return None
+			numPages += pages
+			numCached += sum(page & 1 for page in residency)
+		finally:
+			del address
+			mapping.close()
+	return numCached / numPages if numPages else None
+
+
+def connectControl(port, tlsContext=None):
+	"""Connects to the server on the given local port (or Unix domain socket
+	path), retrying for a few seconds while it starts up; with TLS, if a
+	context is given. Returns the control socket."""
+
+	deadline = time.monotonic() + 10
+	while True:
+		try:
+			if isinstance(port, str):
+				ctrlSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				try:
+					ctrlSock.connect(port)
+				except OSError:
+					ctrlSock.close()
+					raise
+			else:
+				ctrlSock = socket.create_connection(("localhost", port))
+		except (ConnectionRefusedError, FileNotFoundError):
+			if time.monotonic() > deadline:
+				raise
+			time.sleep(0.05)
+		else:
+			if ctrlSock.family != socket.AF_UNIX:
+				ctrlSock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			if tlsContext:
+				ctrlSock = tlsContext.wrap_socket(ctrlSock, server_hostname="localhost")
+			return ctrlSock
+
+
+def freePort():
+	"""Returns a (currently) unused local TCP port number."""
+
+	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+		sock.bind(("", 0))
+		return sock.getsockname()[1]
+
+
+def dropCache(fileNames):
+	"""Asks the kernel to drop the given files' (clean) pages from the page
+	cache, so that a benchmark starts cold."""
+
+	for fileName in fileNames:
+		with open(fileName, "rb") as inFile:
+			os.posix_fadvise(inFile.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def getFile(ctrlSock, fileName, resume=True, setupTimes=None):
+	"""GETs the named file (with PGET) on the given control connection,
+	discarding the data. Over TLS, the data connection resumes the control
+	connection's session, unless resume is False. If a setupTimes list is
+	given, the time taken to set up the data connection (including any TLS
+	handshake) is appended to it. Returns the number of bytes received."""
+
+	sendStr(ctrlSock, "PGET {name}\n".format(name=fileName))
+	(ready, dataPort, size) = recvLine(ctrlSock).split()
+	numBytes = 0
+	startTime = time.perf_counter()
+	if ctrlSock.family == socket.AF_UNIX:
+		dataSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		dataSock.connect(dataSocketPath(ctrlSock.getpeername(), dataPort))
+	else:
+		dataSock = socket.create_connection(("localhost", int(dataPort)))
+	if isinstance(ctrlSock, ssl.SSLSocket):
+		if resume:
+			dataSock = wrapDataSocket(ctrlSock, dataSock)
+		else:
+			dataSock = ctrlSock.context.wrap_socket(dataSock, server_hostname="localhost")
+	if setupTimes is not None:
+		setupTimes.append(time.perf_counter() - startTime)
+	with dataSock:
+		size = int(size)
+		while size > 0:
+			data = dataSock.recv(min(size, 2**20))
+			if not data:
+				break
+			numBytes += len(data)
+			size -= len(data)
+	recvLine(ctrlSock)
+	return numBytes
+
+
+def getFileByDescriptor(ctrlSock, fileName):
+	"""GETs the named file with GETFD (on a Unix domain socket), reading and
+	discarding the data from the passed descriptor. Returns the number of
+	bytes read."""
+
+	sendStr(ctrlSock, "GETFD {name}\n".format(name=fileName))
+	(data, fds, flags, addr) = socket.recv_fds(ctrlSock, 1, 1)
+	(ok, fd, size) = (data.decode() + recvLine(ctrlSock)).split()
+	numBytes = 0
+	try:
+		while numBytes < int(size):
+			data = os.pread(fds[0], min(int(size) - numBytes, 2**20), numBytes)
+			if not data:
+				break
+			numBytes += len(data)
+	finally:
+		os.close(fds[0])
+	return numBytes
+
+
+def makeFile(fileName, size):
+	"""Creates a file of the given size, filled with pseudo-random data (so
+	that it is not sparse, nor trivially compressible)."""
+
+	block = os.urandom(2**20)
+	with open(fileName, "wb") as outFile:
+		while size > 0:
+			size -= outFile.write(block[:size])
+
+
+def memoryUsage(pid):
+	"""Returns the total (PSS, private anonymous) memory usage in bytes of the
+	given process and all of its children. PSS (proportional set size)
+	divides each shared page between the processes sharing it, so file pages
+	mapped by several processes are not counted more than once."""
+
+	pids = [pid]
+	try:
+		with open("/proc/{pid}/task/{pid}/children".format(pid=pid)) as childFile:
+			pids += [int(child) for child in childFile.read().split()]
+	except OSError:
+		pass
+	(pss, anon) = (0, 0)
+	for procID in pids:
+		try:
+			with open("/proc/{pid}/smaps_rollup".format(pid=procID)) as smapsFile:
+				for line in smapsFile:
+					fields = line.split()
+					if fields[0] == "Pss:":
+						pss += int(fields[1]) * 1024
+					elif fields[0] == "Anonymous:":
+						anon += int(fields[1]) * 1024
+		except OSError:
+			pass
+	return (pss, anon)
+
+
+def runGets(port, fileName, rounds, results):
+	"""Workload for one client process: GETs the named file the given number
+	of times (with PGET) from the server on the given port (or Unix domain
+	socket path), discarding the data. Puts the number of bytes received onto
+	the results queue."""
+
+	ctrlSock = connectControl(port)
+	numBytes = 0
+	for round in range(rounds):
+		numBytes += getFile(ctrlSock, fileName)
+	sendStr(ctrlSock, "GO AWAY\n")
+	recvLine(ctrlSock)
+	ctrlSock.close()
+	results.put(numBytes)
+
+
+class ServerProcess:
+	"""Starts the given server script with the given extra options, in the
+	given directory, on a free port; for use in a with statement."""
+
+	__slots__ = ("port", "process")
+
+	def __init__(self, script, options, workDir):
+		self.port = freePort()
+		scriptPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+		self.process = subprocess.Popen(
+				[sys.executable, scriptPath, str(self.port)] + options,
+				cwd=workDir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *excInfo):
+		self.process.terminate()
+		self.process.wait()
+
+
+def bench_get(args, workDir):
+	"""Concurrent GETs of the same large file, with and without --mmap.
+	Reports the throughput, and the server's peak memory usage."""
+
+	fileName = "bench-get.bin"
+	makeFile(os.path.join(workDir, fileName), args.size)
+	configurations = [("read", []), ("mmap", ["--mmap"])]
+	print("{clients} clients x {rounds} GETs of a {size} MiB file ({server}):".format(
+			clients=args.clients, rounds=args.rounds, size=args.size // 2**20,
+			server=args.server))
+	print("{0:<8} {1:>12} {2:>14} {3:>16}".format("MODE", "MiB/s", "PEAK PSS MiB", "PEAK ANON MiB"))
+
+	for (name, options) in configurations:
+		with ServerProcess(args.server, options, workDir) as server:
+			connectControl(server.port).close()
+			peak = [0, 0]
+			done = threading.Event()
+			def record():
+				usage = memoryUsage(server.process.pid)
+				peak[0] = max(peak[0], usage[0])
+				peak[1] = max(peak[1], usage[1])
+			def sample():
+				while not done.wait(0.05):
+					record()
+			sampler = threading.Thread(target=sample)
+			sampler.start()
+
+			results = multiprocessing.Queue()
+			clients = [multiprocessing.Process(target=runGets,
+					args=(server.port, fileName, args.rounds, results))
+					for client in range(args.clients)]
+			startTime = time.perf_counter()
+			for client in clients:
+				client.start()
+			numBytes = sum(results.get() for client in clients)
+			elapsed = time.perf_counter() - startTime
+			for client in clients:
+				client.join()
+			done.set()
+			sampler.join()
+			# (Short runs may end before the first sample; and what the server
+			# has mapped or allocated by now is still part of its usage.)
+			record()
+		print("{0:<8} {1:>12.1f} {2:>14.1f} {3:>16.1f}".format(name,
+				numBytes / elapsed / 2**20, peak[0] / 2**20, peak[1] / 2**20))
+
+
+def bench_iopolicy(args, workDir):
+	"""Small-file GETs while a bulk GET runs alongside them, under each I/O
+	policy. Reports the small GETs' latency (alone, and during the bulk
+	transfer), the bulk throughput, and how much of each set of files is
+	left in the page cache afterwards."""
+
+	smallFiles = ["small-{num}.bin".format(num=num) for num in range(args.small_files)]
+	for fileName in smallFiles:
+		makeFile(os.path.join(workDir, fileName), args.small_size)
+	bulkFile = "bulk.bin"
+	makeFile(os.path.join(workDir, bulkFile), args.bulk_size)
+	allFiles = [os.path.join(workDir, fileName) for fileName in smallFiles + [bulkFile]]
+
+	print("{num} x {small} KiB small files, and a {bulk} MiB bulk file ({server}):".format(
+			num=args.small_files, small=args.small_size // 2**10, bulk=args.bulk_size // 2**20,
+			server=args.server))
+	print("{0:<8} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}".format("POLICY",
+			"ALONE ms", "BULK ms", "BULK p99", "BULK MiB/s", "BULK", "SMALL"))
+	print("{0:<8} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}".format("", "(median)",
+			"(median)", "ms", "", "CACHED %", "CACHED %"))
+
+	for policy in ("NORMAL", "STREAM", "DIRECT"):
+		dropCache(allFiles)
+		options = ["--io-policy", policy, "--io-threshold", str(args.small_size + 1)]
+		with ServerProcess(args.server, options, workDir) as server:
+			ctrlSock = connectControl(server.port)
+			# Warm up the working set of small files, then time GETs of it.
+			for fileName in smallFiles:
+				getFile(ctrlSock, fileName)
+			alone = []
+			for request in range(len(smallFiles)):
+				startTime = time.perf_counter()
+				getFile(ctrlSock, random.choice(smallFiles))
+				alone.append(time.perf_counter() - startTime)
+
+			results = multiprocessing.Queue()
+			bulk = multiprocessing.Process(target=runGets,
+					args=(server.port, bulkFile, 1, results))
+			during = []
+			bulkStart = time.perf_counter()
+			bulk.start()
+			while bulk.is_alive():
+				startTime = time.perf_counter()
+				getFile(ctrlSock, random.choice(smallFiles))
+				during.append(time.perf_counter() - startTime)
+			numBytes = results.get()
+			bulkTime = time.perf_counter() - bulkStart
+			bulk.join()
+			sendStr(ctrlSock, "GO AWAY\n")
+			recvLine(ctrlSock)
+			ctrlSock.close()
+
+		alone.sort()
+		during.sort()
+		bulkCached = cachedFraction(allFiles[-1:])
+		smallCached = cachedFraction(allFiles[:-1])
+		print("{0:<8} {1:>10.3f} {2:>10.3f} {3:>10.3f} {4:>10.1f} {5:>10} {6:>10}".format(policy,
+				alone[len(alone) // 2] * 1e3, during[len(during) // 2] * 1e3,
+				during[int(len(during) * 0.99)] * 1e3, numBytes / bulkTime / 2**20,
+				"?" if bulkCached is None else "{0:.1f}".format(bulkCached * 100),
+				"?" if smallCached is None else "{0:.1f}".format(smallCached * 100)))
+
+
+
+def bench_transport(args, workDir):
+	"""Small-file and large-file GETs over TCP loopback and over a Unix domain
+	socket (streamed, and passed as file descriptors), from the same server.
+	Reports the small GETs' latency, and the large GETs' throughput."""
+
+	smallFile = "small.bin"
+	makeFile(os.path.join(workDir, smallFile), args.small_size)
+	largeFile = "large.bin"
+	makeFile(os.path.join(workDir, largeFile), args.large_size)
+	unixPath = os.path.join(workDir, "ftp.sock")
+
+	print("{num} GETs of a {small} KiB file, and {rounds} of a {large} MiB file ({server}):".format(
+			num=args.requests, small=args.small_size // 2**10, rounds=args.rounds,
+			large=args.large_size // 2**20, server=args.server))
+	print("{0:<10} {1:>10} {2:>10} {3:>12}".format("TRANSPORT", "SMALL ms", "SMALL p99",
+			"LARGE MiB/s"))
+	print("{0:<10} {1:>10} {2:>10} {3:>12}".format("", "(median)", "ms", ""))
+
+	with ServerProcess(args.server, ["--unix-socket", unixPath], workDir) as server:
+		transports = [("TCP", server.port, getFile), ("UNIX", unixPath, getFile)]
+		if hasattr(socket, "recv_fds"):
+			transports.append(("UNIX FD", unixPath, getFileByDescriptor))
+		for (name, address, get) in transports:
+			ctrlSock = connectControl(address)
+			get(ctrlSock, smallFile)
+			latencies = []
+			for request in range(args.requests):
+				startTime = time.perf_counter()
+				get(ctrlSock, smallFile)
+				latencies.append(time.perf_counter() - startTime)
+			numBytes = 0
+			startTime = time.perf_counter()
+			for round in range(args.rounds):
+				numBytes += get(ctrlSock, largeFile)
+			elapsed = time.perf_counter() - startTime
+			sendStr(ctrlSock, "GO AWAY\n")
+			recvLine(ctrlSock)
+			ctrlSock.close()
+
+			latencies.sort()
+			print("{0:<10} {1:>10.3f} {2:>10.3f} {3:>12.1f}".format(name,
+					latencies[len(latencies) // 2] * 1e3,
+					latencies[int(len(latencies) * 0.99)] * 1e3, numBytes / elapsed / 2**20))
+
+
+
+def bench_tls(args, workDir):
+	"""Small-file and large-file GETs over plaintext TCP and over TLS (with
+	full handshakes on the data connections, and resuming the control
+	connection's session). Reports the data connections' setup time, the
+	small GETs' latency, and the large GETs' throughput."""
+
+	certFile = os.path.join(workDir, "cert.pem")
+	keyFile = os.path.join(workDir, "key.pem")
+	try:
+		subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+				"-subj", "/CN=localhost",
+				"-addext", "subjectAltName=DNS:localhost", "-keyout", keyFile, "-out", certFile],
+				check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	except (OSError, subprocess.CalledProcessError):
+		print("This benchmark needs the openssl command, to make a test certificate.")
+		return
+	smallFile = "small.bin"
+	makeFile(os.path.join(workDir, smallFile), args.small_size)
+	largeFile = "large.bin"
+	makeFile(os.path.join(workDir, largeFile), args.large_size)
+	tlsContext = clientContext(certFile)
+
+	print("{num} GETs of a {small} KiB file, and {rounds} of a {large} MiB file ({server}):".format(
+			num=args.requests, small=args.small_size // 2**10, rounds=args.rounds,
+			large=args.large_size // 2**20, server=args.server))
+	print("(Kernel TLS is {ktls} in this Python build.)".format(
+			ktls="available" if KTLS_OPTION else "unavailable"))
+	print("{0:<12} {1:>10} {2:>10} {3:>10} {4:>12}".format("MODE", "SETUP ms", "SMALL ms",
+			"SMALL p99", "LARGE MiB/s"))
+	print("{0:<12} {1:>10} {2:>10} {3:>10} {4:>12}".format("", "(median)", "(median)", "ms", ""))
+
+	configurations = [("PLAIN", [], None, True),
+			("TLS FULL", ["--tls-cert", certFile, "--tls-key", keyFile], tlsContext, False),
+			("TLS RESUMED", ["--tls-cert", certFile, "--tls-key", keyFile], tlsContext, True)]
+	for (name, options, context, resume) in configurations:
+		with ServerProcess(args.server, options, workDir) as server:
+			ctrlSock = connectControl(server.port, context)
+			getFile(ctrlSock, smallFile)
+			(setupTimes, latencies) = ([], [])
+			for request in range(args.requests):
+				startTime = time.perf_counter()
+				getFile(ctrlSock, smallFile, resume, setupTimes)
+				latencies.append(time.perf_counter() - startTime)
+			numBytes = 0
+			startTime = time.perf_counter()
+			for round in range(args.rounds):
+				numBytes += getFile(ctrlSock, largeFile, resume)
+			elapsed = time.perf_counter() - startTime
+			sendStr(ctrlSock, "GO AWAY\n")
+			recvLine(ctrlSock)
+			ctrlSock.close()
+
+		setupTimes.sort()
+		latencies.sort()
+		print("{0:<12} {1:>10.3f} {2:>10.3f} {3:>10.3f} {4:>12.1f}".format(name,
+				setupTimes[len(setupTimes) // 2] * 1e3, latencies[len(latencies) // 2] * 1e3,
+				latencies[int(len(latencies) * 0.99)] * 1e3, numBytes / elapsed / 2**20))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmarks for Peter's Simple File Transfer Server")
+	parser.add_argument("--server", default="forkserv.py", choices=("forkserv.py", "threadserv.py"),
+			help="server script to benchmark (default: forkserv.py)")
+	benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+	getParser = benchmarks.add_parser("get", help=bench_get.__doc__.split(".")[0])
+	getParser.add_argument("--clients", type=int, default=8,
+			help="number of concurrent clients (default: 8)")
+	getParser.add_argument("--rounds", type=int, default=2,
+			help="number of GETs per client (default: 2)")
+	getParser.add_argument("--size", type=int, default=2**30, metavar="BYTES",
+			help="size of the file (default: 1 GiB)")
+	getParser.set_defaults(func=bench_get)
+
+	ioParser = benchmarks.add_parser("iopolicy", help=bench_iopolicy.__doc__.split(".")[0])
+	ioParser.add_argument("--small-files", type=int, default=200,
+			help="number of small files (default: 200)")
+	ioParser.add_argument("--small-size", type=int, default=256*2**10, metavar="BYTES",
+			help="size of each small file (default: 256 KiB)")
+	ioParser.add_argument("--bulk-size", type=int, default=2**30, metavar="BYTES",
+			help="size of the bulk file (default: 1 GiB)")
+	ioParser.set_defaults(func=bench_iopolicy)
+
+	tlsParser = benchmarks.add_parser("tls", help=bench_tls.__doc__.split(".")[0])
+	tlsParser.add_argument("--requests", type=int, default=1000,
+			help="number of small-file GETs (default: 1000)")
+	tlsParser.add_argument("--small-size", type=int, default=4*2**10, metavar="BYTES",
+			help="size of the small file (default: 4 KiB)")
+	tlsParser.add_argument("--rounds", type=int, default=5,
+			help="number of large-file GETs (default: 5)")
+	tlsParser.add_argument("--large-size", type=int, default=2**30, metavar="BYTES",
+			help="size of the large file (default: 1 GiB)")
+	tlsParser.set_defaults(func=bench_tls)
+
+	transportParser = benchmarks.add_parser("transport",
+			help=bench_transport.__doc__.split(".")[0])
+	transportParser.add_argument("--requests", type=int, default=2000,
+			help="number of small-file GETs (default: 2000)")
+	transportParser.add_argument("--small-size", type=int, default=4*2**10, metavar="BYTES",
+			help="size of the small file (default: 4 KiB)")
+	transportParser.add_argument("--rounds", type=int, default=5,
+			help="number of large-file GETs (default: 5)")
+	transportParser.add_argument("--large-size", type=int, default=2**30, metavar="BYTES",
+			help="size of the large file (default: 1 GiB)")
+	transportParser.set_defaults(func=bench_transport)
+
+	args = parser.parse_args()
+	workDir = tempfile.mkdtemp(prefix="sftp-bench-")
+	try:
+		args.func(args, workDir)
+	finally:
+		shutil.rmtree(workDir, ignore_errors=True)
@@ -29,8 +29,17 @@
 ################################################################################
 """This module provides the command-line client for my file transfer protocol.
 It can be invoked with a host and port number as follows:
-$ python3 cli.py <host> <port>
-"""
+$ python3 cli.py [options] <host> <port>
+or, for a server listening on a Unix domain socket, with its path:
+$ python3 cli.py [options] <socket path>
+(See "python3 cli.py --help" for the available options.)
+
+With --batch <file> (or - for standard input), the commands are instead read
+from the file and run one after another, and a JSON object is printed for each
+on a line of its own:
+	{"command": "GET a.txt", "status": "ok", "bytes": 1024, "duration": 0.0012,
+			"error": null}
+The commands' usual messages go to standard error instead."""
 
 # Use GNU Readline library, if available, for more input features like history
 # and editing.
@@ -39,33 +48,118 @@ try:
 except ImportError:
 	pass
 
+import argparse
+import contextlib
+import json
 import socket
+import ssl
 import sys
 
-from SimpleFTPClientInterpreter import SimpleFTPClientInterpreter
-from utils import checkNumArgs, convertToInt, debugPrint
-from utils import recvAll, recvFile, recvLine, sendStr,  sendFile
+from client import ClientError, Connection
+from tls import clientContext
+
+
+def runBatch(connection, commands, keepGoing=False, output=None):
+	"""Runs the given command lines (skipping blank ones and # comments) on
+	the connection, writing a JSON line of the result of each to output (by
+	default, standard output). Stops at the first command to fail, unless
+	keepGoing, or if the server disconnects. Returns True if every command
+	succeeded."""
+	
+	allOK = True
+	for line in commands:
+		command = line.strip()
+		if not command or command.startswith("#"):
+			continue
+		if connection.shell.isFinished():
+			break
+		try:
+			result = connection.run(command)
+		except ClientError as err:
+			result = err.result
+		print(json.dumps({"command": command, "status": result["status"],
+				"bytes": result["bytes"], "duration": round(result["duration"], 6),
+				"error": result["error"]}), file=output or sys.stdout, flush=True)
+		if result["status"] != "ok":
+			allOK = False
+			if not keepGoing:
+				break
+	return allOK
 
 
 if __name__ == "__main__":
-	checkNumArgs(3)
-	hostName = sys.argv[1]
-	port = convertToInt(sys.argv[2])
+	parser = argparse.ArgumentParser(description="Peter's Simple File Transfer Client")
+	parser.add_argument("host",
+			help="host name or IP address of the server; or the path of its Unix domain socket")
+	parser.add_argument("port", type=int, nargs="?", help="port number to connect to")
+	parser.add_argument("--batch", metavar="FILE", type=argparse.FileType("r"),
+			help="run the commands in this file (or - for standard input) and print their "
+			"results as JSON lines, instead of prompting for them")
+	parser.add_argument("--keep-going", action="store_true",
+			help="in batch mode, carry on after a command fails (default: stop)")
+	parser.add_argument("--queue-depth", metavar="N", type=int, default=4,
+			help="in batch mode, the depth of the transfer pipeline (see QUEUE; default: 4)")
+	parser.add_argument("--tls", action="store_true",
+			help="connect using TLS (which the server must have been started with)")
+	parser.add_argument("--tls-ca", metavar="PATH",
+			help="check the server's TLS certificate against these CA certificates "
+			"(default: the system's)")
+	parser.add_argument("--tls-insecure", action="store_true",
+			help="do not check the server's TLS certificate at all")
+	options = parser.parse_args()
+	(hostName, port) = (options.host, options.port)
+	if port is None:
+		# A Unix domain socket path; its "address" is named for the display.
+		(address, hostName, port) = (options.host, "unix", options.host)
+		if options.tls:
+			parser.error("TLS is only used over TCP")
+	else:
+		address = (hostName, port)
+	context = None
+	if options.tls:
+		context = clientContext(options.tls_ca, verify=not options.tls_insecure)
+	# In batch mode, standard output is kept for the results.
+	messages = sys.stderr if options.batch else sys.stdout
 		
 	try:
-		hostIP = socket.gethostbyname(hostName)
-		ctrlSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		ctrlSock.connect((hostIP, port))
+		# A batch is run over a persistent data connection, with transfers
+		# pipelined.
+		with contextlib.redirect_stdout(messages):
+			connection = Connection(address, context, persistent=bool(options.batch),
+					queueDepth=(options.queue_depth if options.batch else 0), quiet=False)
 	except socket.gaierror:
-		print("CLIENT: Cannot resolve hostname \"{host}\"".format(host=hostName))
+		print("CLIENT: Cannot resolve hostname \"{host}\"".format(host=hostName), file=messages)
+		sys.exit(1)
+	except ssl.SSLError as err:
+		print("CLIENT: TLS handshake with {host}:{port} failed: {err}".format(host=hostName,
+				port=port, err=err), file=messages)
+		sys.exit(1)
 	except socket.error:
-		print("CLIENT: Cannot connect to {host}:{port}".format(host=hostName, port=port))
-	else:
-		print("CLIENT: Connected to {host}:{port}.".format(host=hostName, port=port))
-		print("Welcome to Peter's Simple File Transfer Client. Enter commands below, or HELP.")
-		
-		shell = SimpleFTPClientInterpreter(ctrlSock, (hostIP, port))
-		while not shell.isFinished():
-			command = input("ftp> ")	
-			shell.handleCommand(command)		
-		ctrlSock.close()
+		print("CLIENT: Cannot connect to {host}:{port}".format(host=hostName, port=port),
+				file=messages)
+		sys.exit(1)
+	except ClientError as err:
+		print("CLIENT: Cannot set up the connection to {host}:{port}: {err}".format(
+				host=hostName, port=port, err=err), file=messages)
+		sys.exit(1)
+	
+	print("CLIENT: Connected to {host}:{port}{tls}.".format(host=hostName, port=port,
+			tls=" ({version})".format(version=connection.tlsVersion) if options.tls else ""),
+			file=messages)
+	if options.batch:
+		# Everything else the client prints (including WATCH and FOLLOW
+		# events, from their own threads) goes to standard error, for the
+		# whole batch; only the results are written to standard output.
+		results = sys.stdout
+		with contextlib.redirect_stdout(messages):
+			allOK = runBatch(connection, options.batch, options.keep_going, output=results)
+			connection.close()
+		sys.exit(0 if allOK else 1)
+	
+	print("Welcome to Peter's Simple File Transfer Client. Enter commands below, or HELP.")
+	
+	shell = connection.shell
+	while not shell.isFinished():
+		command = input("ftp> ")	
+		shell.handleCommand(command)		
+	connection.close()
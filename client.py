@@ -0,0 +1,499 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the client library: the same file transfers as the
+command-line client, for use from other programs. A Client keeps a pool of
+Connections to one or more servers (which should serve the same files), each
+a control connection with its own persistent data connection; each request
+takes an idle Connection (to the least busy server), opening one if needed,
+and returns it to the pool when done, so that many threads can transfer
+files at once without setting up connections each time. Each method returns
+a structured result, or raises the ClientError subclass for the kind of
+failure. Local files are named as on the server, relative to the current
+directory (as in cli.py)."""
+
+# Example usage:
+# >>> client = Client([("10.0.0.1", 5000), ("10.0.0.2", 5000)], maxConnections=8)
+# >>> client.get("notes.txt")
+# {'name': 'notes.txt', 'bytes': 512, 'duration': 0.0021}
+# >>> client.stat("notes.txt")["size"]
+# 512
+# >>> client.get("missing.txt")
+# Traceback (most recent call last):
+# ...
+# client.RemoteError: FILE DOES NOT EXIST
+# >>> client.close()
+
+import select
+import socket
+import ssl
+import threading
+
+from SimpleFTPClientInterpreter import SimpleFTPClientInterpreter
+from timer import Timer
+from tls import hasApplicationData
+from utils import setDebugOutput
+
+
+class ClientError(Exception):
+	"""Raised when a command fails. Its message is the reason; its result
+	attribute is the command's outcome, as returned by Connection.run (or
+	None, if it was never run)."""
+
+	def __init__(self, message, result=None):
+		super().__init__(message)
+		self.result = result
+
+
+class ConnectionLost(ClientError):
+	"""Raised when the connection to the server is lost or cannot be made
+	(including its data connection)."""
+
+
+class LocalError(ClientError):
+	"""Raised when a command fails on the client's side: a local file cannot
+	be read or written, or would be overwritten; or the command is invalid."""
+
+
+class ProtocolError(ClientError):
+	"""Raised when the server's reply is malformed."""
+
+
+class RemoteError(ClientError):
+	"""Raised when the server refuses a command (with an ERR reply; the
+	reason is its message, such as FILE DOES NOT EXIST)."""
+
+
+# The exception raised for each kind of failure (see
+# SimpleFTPClientInterpreter.lastResult).
+ERRORS = {"connection": ConnectionLost, "local": LocalError, "protocol": ProtocolError,
+		"remote": RemoteError}
+
+
+def connect(address, tlsContext=None):
+	"""Opens a control connection to the server at the given address: a
+	(host, port) tuple, or the path of its Unix domain socket. If a TLS
+	context is given (see tls.clientContext), a TCP connection is made over
+	TLS. Returns a tuple of the connected socket and the server's address as
+	the interpreter takes it. Raises socket.gaierror if the host name cannot
+	be resolved, ssl.SSLError if the TLS handshake fails, or another OSError
+	if the server cannot be reached."""
+
+	if isinstance(address, str):
+		ctrlSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			ctrlSock.connect(address)
+		except OSError:
+			ctrlSock.close()
+			raise
+		return (ctrlSock, ("unix", address))
+	(hostName, port) = address
+	remoteAddr = (socket.gethostbyname(hostName), port)
+	ctrlSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	try:
+		ctrlSock.connect(remoteAddr)
+		ctrlSock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		if tlsContext:
+			ctrlSock = tlsContext.wrap_socket(ctrlSock, server_hostname=hostName)
+	except OSError:
+		ctrlSock.close()
+		raise
+	return (ctrlSock, remoteAddr)
+
+
+class Connection:
+	"""A control connection to a server, and the interpreter which runs
+	commands on it. It is not thread-safe: only one thread may use it at a
+	time (as Client ensures)."""
+
+	__slots__ = ("_broken", "_ctrlSock", "_shell")
+
+	def __init__(self, address, tlsContext=None, passive=False, persistent=True, queueDepth=0,
+			quiet=True):
+		"""Connects to the server at the given address (see connect), and
+		sets up the connection: in passive mode, with a persistent data
+		connection, and with the given transfer queue depth (see the PASV,
+		PERSIST and QUEUE commands), as asked. Unless quiet is False, the
+		commands print nothing, and debugging output is turned off for the
+		whole process (see utils.setDebugOutput)."""
+
+		if quiet:
+			setDebugOutput(False)
+		(self._ctrlSock, remoteAddr) = connect(address, tlsContext)
+		self._broken = False
+		self._shell = SimpleFTPClientInterpreter(self._ctrlSock, remoteAddr, quiet=quiet)
+		try:
+			if passive:
+				self.run("PASV YES")
+			if persistent:
+				self.run("PERSIST YES")
+			if queueDepth:
+				self.run("QUEUE {depth}".format(depth=queueDepth))
+		except ClientError:
+			self.close()
+			raise
+
+
+	@property
+	def shell(self):
+		"""The interpreter running this connection's commands."""
+
+		return self._shell
+
+
+	@property
+	def tlsVersion(self):
+		"""The version of TLS the connection is made over (such as
+		"TLSv1.3"), or None if it is not."""
+
+		if isinstance(self._ctrlSock, ssl.SSLSocket):
+			return self._ctrlSock.version()
+		return None
+
+
+	def close(self):
+		"""Ends the session (with QUIT) and closes the connection."""
+
+		if not self._broken and not self._shell.isFinished():
+			try:
+				self._shell.handleCommand("QUIT")
+			except OSError:
+				pass
+		self._broken = True
+		self._ctrlSock.close()
+
+
+	def isUsable(self):
+		"""Returns True if the connection can still be used: it has not been
+		lost or closed, and the server has not closed it while it was idle.
+		(An idle control connection should never be readable; except that
+		over TLS, it may have been sent session tickets.)"""
+
+		if self._broken or self._shell.isFinished():
+			return False
+		try:
+			(readable, writable, broken) = select.select([self._ctrlSock], [], [self._ctrlSock], 0)
+			if broken or (readable and (not isinstance(self._ctrlSock, ssl.SSLSocket)
+					or hasApplicationData(self._ctrlSock))):
+				self._broken = True
+		except (OSError, ValueError):
+			self._broken = True
+		return not self._broken
+
+
+	def run(self, command):
+		"""Runs the given command, as it would be typed at the cli.py prompt,
+		and returns its result (see SimpleFTPClientInterpreter.lastResult),
+		with the "duration" it took, in seconds. Raises the ClientError
+		subclass for the kind of failure, if it fails."""
+
+		if "\n" in command or "\r" in command:
+			raise LocalError("Commands cannot span several lines.")
+		if self._broken or self._shell.isFinished():
+			raise ConnectionLost("The connection is closed.")
+		try:
+			with Timer() as commandTime:
+				self._shell.handleCommand(command)
+		except OSError as err:
+			# The control or data connection failed part way through; what
+			# state the session is in is unknown, so it is not used again.
+			self._broken = True
+			result = self._shell.lastResult()
+			result.update(status="error", error="Connection lost: {err}".format(err=err),
+					kind="connection")
+		else:
+			result = self._shell.lastResult()
+		result["duration"] = commandTime.elapsedTime()
+		if result["status"] == "ok":
+			return result
+		if result["kind"] == "connection":
+			self._broken = True
+		raise ERRORS.get(result["kind"], ClientError)(result["error"], result)
+
+
+class Client:
+	"""A thread-safe pool of Connections to one or more servers, through
+	which files are transferred. Up to maxConnections Connections are opened
+	to each server, as needed; a request made when all of them are busy waits
+	(up to waitTimeout seconds, if given) for one to be free. A Connection
+	which is lost is dropped, and replaced when next needed."""
+
+	__slots__ = ("_available", "_closed", "_idle", "_inUse", "_maxConnections", "_options",
+			"_servers", "_waitTimeout")
+
+	def __init__(self, servers, maxConnections=4, tlsContext=None, passive=False, queueDepth=4,
+			waitTimeout=None):
+		"""Creates the (initially empty) pool for the given server address,
+		or list of them (each as for connect). The Connections are set up
+		with the given TLS context, passive mode and transfer queue depth (see
+		Connection)."""
+
+		if isinstance(servers, (str, tuple)):
+			servers = [servers]
+		self._servers = list(servers)
+		self._maxConnections = maxConnections
+		self._options = {"tlsContext": tlsContext, "passive": passive, "queueDepth": queueDepth}
+		self._waitTimeout = waitTimeout
+		# Guards the rest, and is notified whenever a Connection is released.
+		self._available = threading.Condition()
+		self._closed = False
+		# The idle Connections to each server (most recently used last), and
+		# the number in use.
+		self._idle = {server: [] for server in self._servers}
+		self._inUse = {server: 0 for server in self._servers}
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *exceptionArgs):
+		self.close()
+		return False
+
+
+	def close(self):
+		"""Closes the idle Connections, and the rest as they are released.
+		No more requests can be made."""
+
+		with self._available:
+			self._closed = True
+			idle = [connection for connections in self._idle.values() for connection in connections]
+			for connections in self._idle.values():
+				connections.clear()
+			self._available.notify_all()
+		for connection in idle:
+			connection.close()
+
+
+	def copy(self, srcName, dstName):
+		"""Copies a file on the server, without transferring it. Returns the
+		number of bytes copied."""
+
+		return self._run("COPY {src} {dst}".format(src=srcName, dst=dstName))["value"]
+
+
+	def find(self, pattern, minSize=None, maxSize=None, newer=None, limit=None):
+		"""Searches the whole tree on the server for the files whose names
+		match the given glob, and (optionally) whose sizes are in the given
+		range, which were modified after the given time (a datetime, or
+		nanoseconds since the epoch), up to the given number of them. Returns
+		a list of their descriptions, as for stat."""
+
+		options = ""
+		if minSize is not None:
+			options += " MINSIZE {size}".format(size=minSize)
+		if maxSize is not None:
+			options += " MAXSIZE {size}".format(size=maxSize)
+		if newer is not None:
+			if not isinstance(newer, int):
+				newer = int(newer.timestamp() * 10**9)
+			options += " NEWER {ns}".format(ns=newer)
+		if limit is not None:
+			options += " LIMIT {count}".format(count=limit)
+		return self._run("FIND {pattern}{options}".format(pattern=pattern,
+				options=options))["value"]
+
+
+	def get(self, fileName, overwrite=False):
+		"""Downloads the named file from the server; replacing the local file,
+		if overwrite is True. Returns a dictionary of the file's "name", the
+		number of "bytes" received, and the "duration" of the transfer."""
+
+		result = self._run("{verb} {name}".format(verb=("GETF" if overwrite else "GET"),
+				name=fileName))
+		return {"name": fileName, "bytes": result["bytes"], "duration": result["duration"]}
+
+
+	def getTree(self, dirName, compress=False, includes=(), excludes=()):
+		"""Downloads the named directory tree from the server; only the files
+		matching any of the include globs (if given) and none of the exclude
+		globs, compressed in transit if asked. Returns a dictionary of the
+		directory's "name", the number of "files" and "bytes" received, and
+		the "duration" of the transfer."""
+
+		return self._treeTransfer("GETTREE", dirName, compress, includes, excludes)
+
+
+	def hash(self, fileName):
+		"""Returns a dictionary of the named remote file's "name", "digest"
+		(hex SHA-256), and whether the local file of the same name "match"es
+		it ("same", "different", "missing locally" or "unreadable locally")."""
+
+		return self._run("HASH {name}".format(name=fileName))["value"]
+
+
+	def hashDir(self, dirName):
+		"""Returns a list of the same for each of the files under the named
+		remote directory (named relative to it; the "digest" is None if the
+		file was unreadable on the server)."""
+
+		return self._run("HASHDIR {name}".format(name=dirName))["value"]
+
+
+	def ls(self):
+		"""Returns a list of the files and directories on the server, each a
+		dictionary of its "name", "type" ("file" or "directory") and "size"
+		(bytes; None for a directory)."""
+
+		return self._run("LS")["value"]
+
+
+	def move(self, srcName, dstName):
+		"""Moves (renames) a file on the server, without transferring it.
+		Returns the number of bytes moved."""
+
+		return self._run("MOVE {src} {dst}".format(src=srcName, dst=dstName))["value"]
+
+
+	def put(self, fileName):
+		"""Uploads the named file to the server. Returns a dictionary of the
+		file's "name", the number of "bytes" sent, and the "duration" of the
+		transfer."""
+
+		result = self._run("PUT {name}".format(name=fileName))
+		return {"name": fileName, "bytes": result["bytes"], "duration": result["duration"]}
+
+
+	def putTree(self, dirName, compress=False, includes=(), excludes=()):
+		"""Uploads the named directory tree to the server, as for getTree."""
+
+		return self._treeTransfer("PUTTREE", dirName, compress, includes, excludes)
+
+
+	def stat(self, fileName, digest=False):
+		"""Returns a dictionary describing the named file on the server: its
+		"name", "type" ("file", "directory", "link", "other", or "none" if it
+		does not exist), "size" (bytes), "mtime" (nanoseconds since the epoch)
+		and "digest" (hex SHA-256, if asked for and readable; or None)."""
+
+		return self._run("STAT{hash} {name}".format(hash=(" HASH" if digest else ""),
+				name=fileName))["value"]
+
+
+	def statMany(self, fileNames, digest=False):
+		"""Returns a list of the same for each of the named files (whose names
+		may not contain spaces), with one request."""
+
+		return self._run("STATM{hash} {names}".format(hash=(" HASH" if digest else ""),
+				names=" ".join(fileNames)))["value"]
+
+
+	def stats(self):
+		"""Returns the lines of the server-wide state (see STATS), from the
+		least busy server."""
+
+		return self._run("STATS")["value"]
+
+
+	def _acquire(self):
+		"""Returns a tuple of a server and a Connection to it, for the caller's
+		use alone until it is released (see _release). Servers are tried in
+		order of how few of their Connections are in use; an idle Connection
+		to one is taken, or a new one opened if there are fewer than
+		maxConnections. If there are none to spare, waits for one to be
+		released. Raises ConnectionLost if none of the servers can be
+		connected to, or ClientError if none was released in time."""
+
+		unreachable = {}
+		while True:
+			with self._available:
+				(server, connection) = self._reserve(unreachable)
+			if connection:
+				return (server, connection)
+			# (Connected to without holding the lock, since it takes a while.)
+			try:
+				return (server, Connection(server, **self._options))
+			except (OSError, ClientError) as err:
+				unreachable[server] = err
+				self._release(server, None)
+
+
+	def _release(self, server, connection):
+		"""Returns the given Connection (or None, if it could not be opened)
+		to the server to the pool, if it is still usable; or closes it."""
+
+		with self._available:
+			self._inUse[server] -= 1
+			keep = connection and not self._closed and connection.isUsable()
+			if keep:
+				self._idle[server].append(connection)
+			self._available.notify()
+		if connection and not keep:
+			connection.close()
+
+
+	def _reserve(self, unreachable):
+		"""The body of _acquire, with the lock held: Returns a tuple of a
+		server and an idle Connection to it; or of a server and None, if a
+		new Connection is to be opened to it. Servers which could not be
+		connected to (in the given dictionary of their errors) are skipped."""
+
+		while True:
+			if self._closed:
+				raise ClientError("The client is closed.")
+			servers = [server for server in self._servers if server not in unreachable]
+			if not servers:
+				raise ConnectionLost("Cannot connect to any server: {err}".format(
+						err=list(unreachable.values())[-1]))
+			for server in sorted(servers, key=self._inUse.get):
+				while self._idle[server]:
+					connection = self._idle[server].pop()
+					if connection.isUsable():
+						self._inUse[server] += 1
+						return (server, connection)
+					connection.close()
+				if self._inUse[server] < self._maxConnections:
+					self._inUse[server] += 1
+					return (server, None)
+			if not self._available.wait(self._waitTimeout):
+				raise ClientError("No connection became free in time.")
+
+
+	def _run(self, command):
+		"""Runs the given command on a Connection from the pool, and returns
+		its result (see Connection.run)."""
+
+		(server, connection) = self._acquire()
+		try:
+			return connection.run(command)
+		finally:
+			self._release(server, connection)
+
+
+	def _treeTransfer(self, verb, dirName, compress, includes, excludes):
+		"""Runs a GETTREE or PUTTREE command (given as the verb) with the
+		given options, and returns its result (see getTree)."""
+
+		options = " COMPRESS" if compress else ""
+		options += "".join(" INCLUDE {glob}".format(glob=glob) for glob in includes)
+		options += "".join(" EXCLUDE {glob}".format(glob=glob) for glob in excludes)
+		result = self._run("{verb}{options} {name}".format(verb=verb, options=options,
+				name=dirName))
+		return {"name": dirName, "files": result["value"], "bytes": result["bytes"],
+				"duration": result["duration"]}
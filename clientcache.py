@@ -0,0 +1,146 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the client's cache of downloaded files, used to make
+repeated GETs of an unchanged remote file cheap: the client only asks the
+server whether the file changed (GETIF), and if not, copies its cached copy.
+Each cached file is stored under a name derived from the server's address
+and the remote file name, and the index (index.json, in the same directory)
+records the size and modification time the server gave for it."""
+
+# Example usage:
+# >>> cache = DownloadCache("/home/me/.ftpcache")
+# >>> cache.store("10.0.0.1:5000", "notes.txt", "notes.txt", 512, 1413921600000000000)
+# >>> cache.lookup("10.0.0.1:5000", "notes.txt")
+# ('/home/me/.ftpcache/4be0...', 512, 1413921600000000000)
+
+import hashlib
+import json
+import os
+import shutil
+
+from utils import debugPrint
+
+
+class DownloadCache:
+	"""A directory of cached downloads, and its index. The index is re-read
+	before each change, so that several clients may share the directory
+	(though concurrent changes to the same entry may be lost)."""
+
+	__slots__ = ("_cacheDir", "_index")
+	
+	INDEX_NAME = "index.json"
+
+	def __init__(self, cacheDir):
+		os.makedirs(cacheDir, exist_ok=True)
+		self._cacheDir = cacheDir
+		self._index = self._loadIndex()
+
+
+	def lookup(self, server, fileName):
+		"""Returns a tuple of the path of the cached copy of the named file
+		from the given server ("<host>:<port>"), and the size and
+		modification time the server gave for it; or None if it is not (or
+		no longer) cached."""
+		
+		key = self._key(server, fileName)
+		entry = self._index.get(key)
+		path = os.path.join(self._cacheDir, key)
+		try:
+			if entry and os.path.getsize(path) == entry["size"]:
+				return (path, entry["size"], entry["mtime"])
+		except OSError:
+			pass
+		return None
+
+
+	def restore(self, server, fileName, outName):
+		"""Copies the cached copy of the named file from the given server to
+		outName, replacing it only once the copy is complete. Returns the
+		number of bytes copied, or None if it is not cached."""
+		
+		cached = self.lookup(server, fileName)
+		if cached is None:
+			return None
+		self._copyFile(cached[0], outName)
+		return cached[1]
+
+
+	def store(self, server, fileName, localName, size, mtime):
+		"""Adds (or replaces) the cached copy of the named file from the given
+		server, copying it from localName; size and mtime are as the server
+		gave them, before the file was downloaded."""
+		
+		key = self._key(server, fileName)
+		self._copyFile(localName, os.path.join(self._cacheDir, key))
+		self._index = self._loadIndex()
+		self._index[key] = {"server": server, "name": fileName, "size": size, "mtime": mtime}
+		self._saveIndex()
+
+
+	def _copyFile(self, srcName, dstName):
+		"""Copies the named file over dstName, by way of a temporary file."""
+		
+		tmpName = "{name}.{pid}.part".format(name=dstName, pid=os.getpid())
+		try:
+			shutil.copyfile(srcName, tmpName)
+			os.replace(tmpName, dstName)
+		except BaseException:
+			if os.path.exists(tmpName):
+				os.unlink(tmpName)
+			raise
+
+
+	def _key(self, server, fileName):
+		"""Returns the name of the cached copy of the named file from the
+		given server, within the cache directory."""
+		
+		return hashlib.sha256("{server}/{name}".format(server=server,
+				name=fileName).encode()).hexdigest()
+
+
+	def _loadIndex(self):
+		"""Reads the index; an empty one if it is missing or unreadable."""
+		
+		try:
+			with open(os.path.join(self._cacheDir, self.INDEX_NAME)) as indexFile:
+				return json.load(indexFile)
+		except (OSError, ValueError) as err:
+			if not isinstance(err, FileNotFoundError):
+				debugPrint("DownloadCache: ignoring unreadable index: {err}".format(err=err))
+			return {}
+
+
+	def _saveIndex(self):
+		"""Writes the index, replacing the old one only once it is complete."""
+		
+		indexName = os.path.join(self._cacheDir, self.INDEX_NAME)
+		tmpName = "{name}.{pid}.part".format(name=indexName, pid=os.getpid())
+		with open(tmpName, "w") as indexFile:
+			json.dump(self._index, indexFile, indent=1, sort_keys=True)
+		os.replace(tmpName, indexName)
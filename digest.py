@@ -0,0 +1,224 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the server's persistent index of file content digests
+(SHA-256), used by HASH, HASHDIR, STAT HASH and GETIF HASH. Hashing a file
+means reading all of it, so each digest is stored in an SQLite database on
+the disk, along with the file's device, inode, size and modification time,
+and is reused (even after the server restarts) for as long as those are
+unchanged. Digests are computed by a pool of background threads, so that
+the files of a bulk request are hashed in parallel, and concurrent requests
+for the same file share one computation; and files stored by PUT are
+re-hashed in the background as soon as they are written."""
+
+# Example usage:
+# >>> digests = DigestIndex("/var/cache/ftp-digests.sqlite", workers=4)
+# >>> digests.get("photo.jpg", os.stat("photo.jpg"))
+# 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+# >>> digests.update("upload.bin")  # After it changed; returns at once.
+
+import hashlib
+import os
+import sqlite3
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from utils import debugPrint
+
+
+DIGEST_ALGORITHM = "sha256"
+
+
+def _statKey(fileStat):
+	"""Returns the parts of an os.stat result which a digest is valid for."""
+	
+	return (fileStat.st_dev, fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns)
+
+
+class DigestIndex:
+	"""An index of file digests, stored in the named SQLite database (which
+	is created if need be), and computed by a pool of the given number of
+	worker threads. It may be used by several threads, and by several
+	processes at once (each gets its own database connections and pool,
+	since neither survives a fork). Each entry is keyed by the file's real
+	path."""
+
+	__slots__ = ("_dbPath", "_local", "_lock", "_pending", "_pool", "_processID", "_stats",
+			"_workers")
+
+	def __init__(self, dbPath, workers=4):
+		self._dbPath = dbPath
+		self._processID = None
+		self._workers = max(1, workers)
+		# This connection is not kept, since it must not be used after a fork.
+		db = sqlite3.connect(dbPath, timeout=30)
+		try:
+			with db:
+				db.execute("CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, "
+						"device INTEGER, inode INTEGER, size INTEGER, mtime INTEGER, digest TEXT)")
+		finally:
+			db.close()
+
+
+	def get(self, fileName, fileStat):
+		"""Returns the hex digest of the named file's contents, from the index
+		if it is there; fileStat is the os.stat result the caller has already
+		taken. Returns None if the file cannot be read, or changed since
+		fileStat was taken."""
+		
+		return self.getMany([(fileName, fileStat)])[0]
+
+
+	def flush(self):
+		"""Waits for the digests being computed by this process to be done."""
+		
+		self._checkProcess()
+		with self._lock:
+			futures = list(self._pending.values())
+		for future in futures:
+			future.result()
+
+
+	def getMany(self, files):
+		"""Like get, for a list of (fileName, fileStat) tuples: returns a list
+		of their digests (or None), in the same order. The files which are
+		not in the index are hashed in parallel."""
+		
+		results = []
+		for (fileName, fileStat) in files:
+			path = os.path.realpath(fileName)
+			row = self._connection().execute("SELECT device, inode, size, mtime, digest "
+					"FROM digests WHERE path = ?", (path,)).fetchone()
+			if row and tuple(row[:4]) == _statKey(fileStat):
+				self._count("hits")
+				results.append(row[4])
+			else:
+				self._count("misses")
+				results.append(self._submit(path, fileName, _statKey(fileStat)))
+		return [result.result() if isinstance(result, Future) else result
+				for result in results]
+
+
+	def status(self):
+		"""Returns a list of (name, value) pairs describing the index."""
+		
+		(numEntries,) = self._connection().execute("SELECT COUNT(*) FROM digests").fetchone()
+		with self._lock:
+			return [
+					("DIGESTENTRIES", numEntries),
+					("DIGESTHITS", self._stats["hits"]),
+					("DIGESTMISSES", self._stats["misses"]),
+					("DIGESTPENDING", len(self._pending))
+					]
+
+
+	def update(self, fileName):
+		"""Has the named file (just written) hashed in the background, so that
+		its digest is ready by the time it is asked for."""
+		
+		try:
+			fileStat = os.stat(fileName)
+		except OSError:
+			return
+		self._submit(os.path.realpath(fileName), fileName, _statKey(fileStat))
+
+
+	def _compute(self, path, fileName, statKey):
+		"""The body of a worker's job: hashes the named file and stores the
+		digest, unless the file no longer matches statKey. Returns the digest,
+		or None."""
+		
+		try:
+			try:
+				with open(fileName, "rb") as inFile:
+					digest = hashlib.file_digest(inFile, DIGEST_ALGORITHM).hexdigest()
+					currentKey = _statKey(os.fstat(inFile.fileno()))
+			except OSError as err:
+				debugPrint("DigestIndex: cannot hash {name}: {err}".format(name=fileName, err=err))
+				return None
+			if currentKey != statKey:
+				return None
+			with self._connection() as db:
+				db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+						(path,) + statKey + (digest,))
+			return digest
+		finally:
+			with self._lock:
+				del self._pending[(path, statKey)]
+
+
+	def _checkProcess(self):
+		"""Sets up the per-process state, if this is a new process (that is,
+		the first use, or the first since a fork)."""
+		
+		if self._processID != os.getpid():
+			self._local = threading.local()
+			self._lock = threading.Lock()
+			self._pending = {}
+			self._pool = None
+			self._stats = {"hits": 0, "misses": 0}
+			self._processID = os.getpid()
+
+
+	def _connection(self):
+		"""Returns the calling thread's connection to the database, opening it
+		if need be."""
+		
+		self._checkProcess()
+		db = getattr(self._local, "db", None)
+		if db is None:
+			db = sqlite3.connect(self._dbPath, timeout=30)
+			db.execute("PRAGMA journal_mode=WAL")
+			db.execute("PRAGMA synchronous=NORMAL")
+			self._local.db = db
+		return db
+
+
+	def _count(self, stat):
+		"""Increments the named statistic."""
+		
+		self._checkProcess()
+		with self._lock:
+			self._stats[stat] += 1
+
+
+	def _submit(self, path, fileName, statKey):
+		"""Queues the named file to be hashed by the pool (unless it already
+		is), and returns the future for its digest."""
+		
+		self._checkProcess()
+		with self._lock:
+			future = self._pending.get((path, statKey))
+			if future is None:
+				if self._pool is None:
+					self._pool = ThreadPoolExecutor(self._workers,
+							thread_name_prefix="DigestIndex")
+				# (The job cannot finish, and remove this, until it is added.)
+				future = self._pool.submit(self._compute, path, fileName, statKey)
+				self._pending[(path, statKey)] = future
+		return future
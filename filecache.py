@@ -0,0 +1,255 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the server's in-memory cache of popular ("hot") file
+contents, used to serve GET requests without going back to the disk. There
+are two implementations with the same interface: FileCache, which keeps its
+entries in the server process's memory and is shared by all of the threading
+server's handler threads; and SharedFileCache, which keeps them in
+memory-mapped files on a RAM-backed file system, so that all of the forking
+server's child processes share one cache."""
+
+# Example usage:
+# >>> cache = FileCache(maxBytes=256*2**20, maxFileSize=16*2**20)
+# >>> fileStat = os.stat(fileName)
+# >>> data = cache.get(fileName, fileStat)
+# >>> if data is None:
+# ...     pass # Not cacheable; read the file as usual.
+
+import atexit
+import hashlib
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+
+def _readIfUnchanged(fileName, fileStat):
+	"""Returns the contents of the named file, provided its size and
+	modification time still match fileStat; otherwise returns None."""
+
+	try:
+		with open(fileName, "rb") as inFile:
+			currentStat = os.fstat(inFile.fileno())
+			if _statKey(currentStat) != _statKey(fileStat):
+				return None
+			data = inFile.read(fileStat.st_size + 1)
+	except OSError:
+		return None
+	return data if len(data) == fileStat.st_size else None
+
+
+def _statKey(fileStat):
+	"""Returns the part of an os.stat result which identifies a version of a
+	file's contents."""
+
+	return (fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns)
+
+
+class FileCache:
+	"""A byte-bounded LRU cache of file contents, for use by threads within
+	a single process. Each entry is keyed by the file's path, and is only
+	valid for as long as the file's inode, size and modification time are
+	unchanged. Files larger than maxFileSize are never cached."""
+
+	__slots__ = ("_entries", "_lock", "_maxBytes", "_maxFileSize", "_numBytes", "_stats")
+
+	def __init__(self, maxBytes, maxFileSize):
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self._maxBytes = maxBytes
+		self._maxFileSize = min(maxFileSize, maxBytes)
+		self._numBytes = 0
+		self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+	def get(self, fileName, fileStat):
+		"""Returns the contents of the named file (as a bytes-like object)
+		from the cache, loading it on a miss; fileStat is the os.stat result
+		the caller has already taken. Returns None if the file is too large
+		to cache, or changed while it was being read."""
+
+		if fileStat.st_size > self._maxFileSize:
+			return None
+		key = os.path.realpath(fileName)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry and entry[0] == _statKey(fileStat):
+				self._entries.move_to_end(key)
+				self._stats["hits"] += 1
+				return entry[1]
+			self._stats["misses"] += 1
+
+		data = _readIfUnchanged(fileName, fileStat)
+		if data is not None:
+			with self._lock:
+				oldEntry = self._entries.pop(key, None)
+				if oldEntry:
+					self._numBytes -= len(oldEntry[1])
+				self._entries[key] = (_statKey(fileStat), data)
+				self._numBytes += len(data)
+				while self._numBytes > self._maxBytes:
+					(oldKey, (oldStat, oldData)) = self._entries.popitem(last=False)
+					self._numBytes -= len(oldData)
+					self._stats["evictions"] += 1
+		return data
+
+
+	def status(self):
+		"""Returns a list of (name, value) pairs describing the cache."""
+
+		with self._lock:
+			return [
+					("CACHEBYTES", self._numBytes),
+					("CACHEENTRIES", len(self._entries)),
+					("CACHEHITS", self._stats["hits"]),
+					("CACHEMISSES", self._stats["misses"]),
+					("CACHEEVICTIONS", self._stats["evictions"])
+					]
+
+
+class SharedFileCache:
+	"""A byte-bounded LRU cache of file contents, shared by forked processes.
+	Each entry is a file in a private directory on a RAM-backed file system
+	(/dev/shm, where available), named after a hash of the source file's
+	path, inode, size and modification time; so any process can find an
+	entry without a shared index, and a changed file simply misses. Entries
+	are read through read-only memory maps, so every process shares the same
+	pages. The time of each entry's last use is kept in its modification
+	time, for LRU eviction. The byte and hit/miss/eviction counts live in
+	shared memory. The cache must be created before forking."""
+
+	__slots__ = ("_cacheDir", "_counters", "_lock", "_maxBytes", "_maxFileSize")
+
+	# Indices into _counters.
+	_BYTES, _ENTRIES, _HITS, _MISSES, _EVICTIONS = range(5)
+
+	def __init__(self, maxBytes, maxFileSize):
+		baseDir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+		self._cacheDir = tempfile.mkdtemp(prefix="sftp-cache-", dir=baseDir)
+		# (Forked children leave with os._exit, so only the parent cleans up.)
+		atexit.register(shutil.rmtree, self._cacheDir, True)
+		self._counters = multiprocessing.Array("q", 5)
+		self._lock = multiprocessing.Lock()
+		self._maxBytes = maxBytes
+		self._maxFileSize = min(maxFileSize, maxBytes)
+
+
+	def get(self, fileName, fileStat):
+		"""Returns the contents of the named file from the cache, as in
+		FileCache.get (but as a read-only mmap)."""
+
+		if fileStat.st_size > self._maxFileSize or not fileStat.st_size:
+			return None
+		key = hashlib.sha1("{path}\0{ino}\0{size}\0{mtime}".format(
+				path=os.path.realpath(fileName), ino=fileStat.st_ino,
+				size=fileStat.st_size, mtime=fileStat.st_mtime_ns).encode()).hexdigest()
+		entryPath = os.path.join(self._cacheDir, key)
+
+		data = self._mapEntry(entryPath)
+		if data is not None:
+			# (Marks the entry recently used. Another process may have evicted
+			# it since it was mapped; the mapping is still good, though.)
+			try:
+				os.utime(entryPath, None)
+			except OSError:
+				pass
+			self._count(self._HITS, 1)
+			return data
+		self._count(self._MISSES, 1)
+
+		contents = _readIfUnchanged(fileName, fileStat)
+		if contents is None:
+			return None
+		with self._lock:
+			if not os.path.exists(entryPath):
+				self._makeRoom(len(contents))
+				(tmpFD, tmpPath) = tempfile.mkstemp(dir=self._cacheDir, prefix=".new-")
+				with os.fdopen(tmpFD, "wb") as tmpFile:
+					tmpFile.write(contents)
+				os.rename(tmpPath, entryPath)
+				self._count(self._BYTES, len(contents))
+				self._count(self._ENTRIES, 1)
+		return contents
+
+
+	def status(self):
+		"""Returns a list of (name, value) pairs describing the cache."""
+
+		with self._counters.get_lock():
+			counters = list(self._counters)
+		return [
+				("CACHEBYTES", counters[self._BYTES]),
+				("CACHEENTRIES", counters[self._ENTRIES]),
+				("CACHEHITS", counters[self._HITS]),
+				("CACHEMISSES", counters[self._MISSES]),
+				("CACHEEVICTIONS", counters[self._EVICTIONS])
+				]
+
+
+	def _count(self, index, amount):
+		with self._counters.get_lock():
+			self._counters[index] += amount
+
+
+	def _makeRoom(self, numBytes):
+		"""Evicts the least recently used entries until numBytes more will
+		fit. The caller must hold the lock."""
+
+		if self._counters[self._BYTES] + numBytes <= self._maxBytes:
+			return
+		entries = []
+		with os.scandir(self._cacheDir) as dirEntries:
+			for entry in dirEntries:
+				if not entry.name.startswith("."):
+					entryStat = entry.stat()
+					entries.append((entryStat.st_mtime, entryStat.st_size, entry.path))
+		entries.sort()
+		for (lastUsed, size, path) in entries:
+			if self._counters[self._BYTES] + numBytes <= self._maxBytes:
+				break
+			os.unlink(path)
+			self._count(self._BYTES, -size)
+			self._count(self._ENTRIES, -1)
+			self._count(self._EVICTIONS, 1)
+
+
+	@staticmethod
+	def _mapEntry(entryPath):
+		"""Returns a read-only memory map of the given cache entry, or None if
+		it does not exist (or was just evicted)."""
+
+		try:
+			with open(entryPath, "rb") as entryFile:
+				return mmap.mmap(entryFile.fileno(), 0, access=mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			return None
@@ -0,0 +1,298 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the server's index of the files it serves, used by
+FIND to search the whole tree without walking it. The index is an SQLite
+database holding each entry's path, name, type, size and modification time.
+It is kept up to date by a background process, which periodically walks the
+tree and applies only the differences (directory by directory); and by the
+server itself, which updates the entries of the files it writes as soon as
+it has written them. Names are also stored reversed, so that patterns which
+end in a literal suffix (such as "*.txt") can be answered from an index just
+as prefix patterns are."""
+
+# Example usage:
+# >>> index = FileIndex("/var/cache/ftpindex.sqlite", ".", interval=60)
+# >>> index.start()
+# >>> index.find("*.iso", minSize=2**30)
+# [('FILE', 4700372992, 1413921600000000000, 'images/debian.iso')]
+# >>> index.update("uploads/new.txt")  # After writing it.
+
+import multiprocessing
+import os
+import sqlite3
+import stat
+import threading
+import time
+
+from utils import debugPrint
+
+
+def _entryType(fileStat):
+	"""Returns the type of an entry (FILE, DIRECTORY, LINK or OTHER) from its
+	os.lstat result."""
+	
+	if stat.S_ISREG(fileStat.st_mode):
+		return "FILE"
+	elif stat.S_ISDIR(fileStat.st_mode):
+		return "DIRECTORY"
+	elif stat.S_ISLNK(fileStat.st_mode):
+		return "LINK"
+	return "OTHER"
+
+
+class FileIndex:
+	"""The index of the tree under rootDir, stored in the named SQLite
+	database (which is created if need be). Every interval seconds (if not
+	0), the background process started by start rescans the tree. It may be
+	used by several threads, and by several processes at once. Paths in the
+	index are relative to rootDir, and always use "/"."""
+
+	__slots__ = ("_dbPath", "_interval", "_local", "_processID", "_rootDir")
+	
+	# The most entries counted when choosing which index to search.
+	PROBE_LIMIT = 10000
+
+	def __init__(self, dbPath, rootDir, interval=60):
+		self._dbPath = dbPath
+		self._interval = interval
+		self._processID = None
+		self._rootDir = os.path.abspath(rootDir)
+		# This connection is not kept, since it must not be used after a fork.
+		db = sqlite3.connect(dbPath, timeout=30)
+		try:
+			with db:
+				db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, "
+						"dir TEXT, name TEXT, rname TEXT, type TEXT, size INTEGER, mtime INTEGER)")
+				for column in ("dir", "name", "rname", "size", "mtime"):
+					db.execute("CREATE INDEX IF NOT EXISTS files_{col} ON files ({col})".format(
+							col=column))
+				db.execute("CREATE TABLE IF NOT EXISTS scans (key TEXT PRIMARY KEY, value)")
+		finally:
+			db.close()
+
+
+	def find(self, pattern, minSize=None, maxSize=None, newer=None, limit=1000):
+		"""Returns a list of (type, size, mtime, path) tuples for the entries
+		matching the given glob pattern (against their paths, if it contains a
+		"/"; otherwise against their names), and at least minSize and at most
+		maxSize bytes in size, and modified after newer (in nanoseconds since
+		the epoch), as given. At most limit entries are returned, sorted by
+		path."""
+		
+		# Each condition, with the index (if any) which can narrow it down.
+		if "/" in pattern:
+			conditions = [("sqlite_autoindex_files_1", "path GLOB ?", [pattern])]
+		else:
+			conditions = [("files_name", "name GLOB ?", [pattern])]
+			if "[" not in pattern:
+				# The same condition, reversed, which can use an index when the
+				# pattern ends (rather than starts) with a literal.
+				conditions.append(("files_rname", "rname GLOB ?", [pattern[::-1]]))
+		sizeRange = [(condition, value) for (condition, value)
+				in (("size >= ?", minSize), ("size <= ?", maxSize)) if value is not None]
+		if sizeRange:
+			conditions.append(("files_size", " AND ".join(cond for (cond, value) in sizeRange),
+					[value for (cond, value) in sizeRange]))
+		if newer is not None:
+			conditions.append(("files_mtime", "mtime > ?", [newer]))
+		
+		db = self._connection()
+		indexName = self._bestIndex(db, conditions)
+		# (Sorted before the limit is applied, so that it is the first entries
+		# which are returned.)
+		query = ("SELECT type, size, mtime, path FROM files {indexed} WHERE {conds} "
+				"ORDER BY path LIMIT ?").format(
+				indexed=("INDEXED BY " + indexName if indexName else "NOT INDEXED"),
+				conds=" AND ".join(cond for (index, cond, params) in conditions))
+		params = [param for (index, cond, params) in conditions for param in params]
+		return db.execute(query, params + [limit]).fetchall()
+
+
+	def refresh(self, relDir=""):
+		"""Rescans the tree under the given directory (relative to rootDir; by
+		default, the whole tree), updating only the entries which changed."""
+		
+		db = self._connection()
+		pending = [relDir]
+		while pending:
+			relDir = pending.pop()
+			try:
+				with os.scandir(os.path.join(self._rootDir, relDir)) as entries:
+					current = {}
+					for entry in entries:
+						try:
+							fileStat = entry.stat(follow_symlinks=False)
+						except OSError:
+							continue
+						entryType = _entryType(fileStat)
+						current[entry.name] = (entryType, fileStat.st_size, fileStat.st_mtime_ns)
+						if entryType == "DIRECTORY":
+							pending.append(self._joinPath(relDir, entry.name))
+			except OSError as err:
+				debugPrint("FileIndex: cannot scan {name}: {err}".format(name=relDir, err=err))
+				continue
+			old = {row[0]: tuple(row[1:]) for row in db.execute(
+					"SELECT name, type, size, mtime FROM files WHERE dir = ?", (relDir,))}
+			with db:
+				for name in old.keys() - current.keys():
+					self._delete(db, self._joinPath(relDir, name))
+				for (name, description) in current.items():
+					if old.get(name) != description:
+						self._store(db, relDir, name, description)
+
+
+	def start(self):
+		"""Starts the background process, which scans the tree at once, then
+		again every interval seconds (if not 0). It is stopped along with the
+		server. (A process, rather than a thread, so that it may be started
+		before the forking server starts forking.)"""
+		
+		with self._connection() as db:
+			db.execute("DELETE FROM scans")
+		scanner = multiprocessing.Process(target=self._scanForever, name="FileIndex",
+				daemon=True)
+		scanner.start()
+
+
+	def status(self):
+		"""Returns a list of (name, value) pairs describing the index."""
+		
+		db = self._connection()
+		(numEntries,) = db.execute("SELECT COUNT(*) FROM files").fetchone()
+		scans = dict(db.execute("SELECT key, value FROM scans").fetchall())
+		return [
+				("INDEXENTRIES", numEntries),
+				("INDEXSCANS", scans.get("count", 0)),
+				("INDEXSCANSECONDS", scans.get("seconds", 0))
+				]
+
+
+	def update(self, fileName):
+		"""Updates the entry of the named file (and if it is a directory, the
+		entries under it), after it was written or removed. Files outside of
+		rootDir are ignored."""
+		
+		relPath = os.path.relpath(os.path.abspath(fileName), self._rootDir)
+		if relPath == "." or relPath.startswith(".." + os.sep) or relPath == "..":
+			return
+		relPath = relPath.replace(os.sep, "/")
+		(relDir, sep, name) = relPath.rpartition("/")
+		db = self._connection()
+		try:
+			fileStat = os.lstat(fileName)
+		except OSError:
+			with db:
+				self._delete(db, relPath)
+			return
+		with db:
+			self._store(db, relDir, name, (_entryType(fileStat), fileStat.st_size,
+					fileStat.st_mtime_ns))
+		if stat.S_ISDIR(fileStat.st_mode):
+			self.refresh(relPath)
+
+
+	def _bestIndex(self, db, conditions):
+		"""Returns the name of the index which narrows down the search the
+		most, given a list of (index name, condition, parameters) tuples; or
+		None if none of them can narrow it down. (SQLite cannot tell how many
+		rows a GLOB or range will match, so this counts, up to PROBE_LIMIT,
+		the entries each index gives.)"""
+		
+		bestIndex = None
+		bestCount = None
+		for (indexName, condition, params) in conditions:
+			if condition.endswith("GLOB ?") and params[0][:1] in ("*", "?", "["):
+				continue # The index would have to be read in full.
+			(count,) = db.execute("SELECT COUNT(*) FROM (SELECT 1 FROM files INDEXED BY {index} "
+					"WHERE {cond} LIMIT ?)".format(index=indexName, cond=condition),
+					params + [self.PROBE_LIMIT]).fetchone()
+			if bestCount is None or count < bestCount:
+				(bestIndex, bestCount) = (indexName, count)
+		return bestIndex
+
+
+	def _connection(self):
+		"""Returns the calling thread's connection to the database, opening it
+		if need be (or if this is a new process, since the last fork)."""
+		
+		if self._processID != os.getpid():
+			self._local = threading.local()
+			self._processID = os.getpid()
+		db = getattr(self._local, "db", None)
+		if db is None:
+			db = sqlite3.connect(self._dbPath, timeout=30)
+			db.execute("PRAGMA journal_mode=WAL")
+			db.execute("PRAGMA synchronous=NORMAL")
+			self._local.db = db
+		return db
+
+
+	def _delete(self, db, relPath):
+		"""Deletes the entry with the given path, and any under it."""
+		
+		# ("0" is the character after "/".)
+		db.execute("DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)",
+				(relPath, relPath + "/", relPath + "0"))
+
+
+	def _joinPath(self, relDir, name):
+		"""Returns the path of the named entry in the given directory."""
+		
+		return relDir + "/" + name if relDir else name
+
+
+	def _scanForever(self):
+		"""The body of the background process: Rescans the tree every interval
+		seconds, until the server (its parent process) is gone."""
+		
+		serverPID = os.getppid()
+		while os.getppid() == serverPID:
+			started = time.monotonic()
+			self.refresh()
+			elapsed = time.monotonic() - started
+			with self._connection() as db:
+				db.execute("INSERT INTO scans VALUES ('count', 1) ON CONFLICT (key) "
+						"DO UPDATE SET value = value + 1")
+				db.execute("INSERT OR REPLACE INTO scans VALUES ('seconds', ?)",
+						(round(elapsed, 3),))
+			if not self._interval:
+				break
+			time.sleep(self._interval)
+
+
+	def _store(self, db, relDir, name, description):
+		"""Adds or replaces the entry of the named file in the given directory,
+		given its (type, size, mtime)."""
+		
+		relPath = self._joinPath(relDir, name)
+		if description[0] != "DIRECTORY":
+			db.execute("DELETE FROM files WHERE path >= ? AND path < ?",
+					(relPath + "/", relPath + "0"))
+		db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+				(relPath, relDir, name, name[::-1]) + description)
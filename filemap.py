@@ -0,0 +1,116 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the server's table of memory-mapped files, used to
+serve GET requests directly from the page cache. Each file is mapped
+read-only, so every connection (and every forked child process) which maps
+the same file shares the same physical pages, rather than each reading the
+file into its own private buffers."""
+
+# Example usage:
+# >>> table = MappingTable(maxMappings=64)
+# >>> fileStat = os.stat(fileName)
+# >>> mapping = table.get(fileName, fileStat)
+# >>> if mapping is None:
+# ...     pass # Not mappable; read the file as usual.
+
+import mmap
+import os
+import threading
+
+from collections import OrderedDict
+
+
+class MappingTable:
+	"""A bounded LRU table of read-only memory maps of files, for use by
+	threads within a single process. Each entry is keyed by the file's path,
+	and is only used for as long as the file's inode, size and modification
+	time are unchanged. Evicting an entry only drops the table's reference to
+	its mapping, so transfers still sending from it are unaffected; it is
+	unmapped once the last of them finishes. (A forked child inherits the
+	table as it was at the time of the fork; either way, the pages are shared
+	through the page cache.)"""
+
+	__slots__ = ("_entries", "_lock", "_maxMappings", "_stats")
+
+	def __init__(self, maxMappings):
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self._maxMappings = maxMappings
+		self._stats = {"hits": 0, "misses": 0}
+
+
+	def get(self, fileName, fileStat):
+		"""Returns a read-only mmap of the named file, from the table if it is
+		already mapped; fileStat is the os.stat result the caller has already
+		taken. Returns None if the file cannot be mapped (for instance, if it
+		is empty, or changed since fileStat was taken)."""
+
+		if not fileStat.st_size or self._maxMappings < 1:
+			return None
+		key = os.path.realpath(fileName)
+		statKey = (fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry and entry[0] == statKey:
+				self._entries.move_to_end(key)
+				self._stats["hits"] += 1
+				return entry[1]
+			self._stats["misses"] += 1
+
+		try:
+			with open(fileName, "rb") as inFile:
+				currentStat = os.fstat(inFile.fileno())
+				if (currentStat.st_ino, currentStat.st_size, currentStat.st_mtime_ns) != statKey:
+					return None
+				mapping = mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			return None
+		if hasattr(mapping, "madvise"):
+			# Ask the kernel to read ahead aggressively, and to drop pages
+			# behind the reader sooner.
+			mapping.madvise(mmap.MADV_SEQUENTIAL)
+
+		with self._lock:
+			self._entries[key] = (statKey, mapping)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self._maxMappings:
+				self._entries.popitem(last=False)
+		return mapping
+
+
+	def status(self):
+		"""Returns a list of (name, value) pairs describing the table."""
+
+		with self._lock:
+			return [
+					("MMAPENTRIES", len(self._entries)),
+					("MMAPBYTES", sum(len(mapping) for (statKey, mapping) in self._entries.values())),
+					("MMAPHITS", self._stats["hits"]),
+					("MMAPMISSES", self._stats["misses"])
+					]
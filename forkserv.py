@@ -29,16 +29,33 @@
 ################################################################################
 """This module (forkserv.py) provides the forking server. It can be invoked with
 a desired port number as follows:
-$ python3 forkserv.py <port>"""
+$ python3 forkserv.py <port> [options]
+(See "python3 forkserv.py --help" for the available options.)"""
 
 
-import sys
+import argparse
 from libserver import forkingServer_listenForever
-from utils import checkNumArgs, convertToInt
+from tls import serverContext
 from SimpleFTPServerConnection import SimpleFTPServerConnectionHandler 
 
 
 if __name__ == "__main__":
-	checkNumArgs(2)
-	servPort = convertToInt(sys.argv[1])
-	forkingServer_listenForever(servPort, SimpleFTPServerConnectionHandler)
+	parser = argparse.ArgumentParser(description="Peter's Simple File Transfer Server (forking)")
+	parser.add_argument("port", type=int, help="port number to listen on")
+	parser.add_argument("--unix-socket", metavar="PATH",
+			help="also listen on this Unix domain socket, for clients on the same host")
+	parser.add_argument("--tls-cert", metavar="PATH",
+			help="require TLS on TCP connections, with this certificate (chain) file")
+	parser.add_argument("--tls-key", metavar="PATH",
+			help="the private key file for --tls-cert (default: in the certificate file)")
+	SimpleFTPServerConnectionHandler.addArguments(parser)
+	options = parser.parse_args()
+	tlsContext = None
+	if options.tls_cert:
+		try:
+			tlsContext = serverContext(options.tls_cert, options.tls_key)
+		except (OSError, ValueError) as err:
+			parser.error("cannot load the TLS certificate: {err}".format(err=err))
+	SimpleFTPServerConnectionHandler.configure(options, multiProcess=True)
+	forkingServer_listenForever(options.port, SimpleFTPServerConnectionHandler,
+			unixPath=options.unix_socket, tlsContext=tlsContext)
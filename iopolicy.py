@@ -0,0 +1,282 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the server's page-cache-aware I/O policies for bulk
+transfers. Reading or writing a large file normally leaves all of it in the
+page cache, evicting the pages of smaller, more popular files; these
+policies avoid that, for files at or above a size threshold:
+	NORMAL -- No special handling.
+	STREAM -- Advise the kernel that the file is read sequentially, ask it to
+		read ahead of the transfer (POSIX_FADV_WILLNEED), and drop the pages
+		behind it (POSIX_FADV_DONTNEED) as it goes. (Written pages are
+		flushed with fdatasync first, since dirty pages cannot be dropped.)
+	DIRECT -- Bypass the page cache entirely (O_DIRECT), using page-aligned
+		buffers. Where the file system does not support this, STREAM is used
+		instead.
+Where posix_fadvise is not available, STREAM does nothing special."""
+
+# Example usage:
+# >>> with openReader(fileName, "STREAM") as inFile:
+# ...     data = inFile.read(65536)
+# >>> with openWriter(outFile, "DIRECT") as writer:
+# ...     writer.write(data)
+
+import mmap
+import os
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+
+IO_POLICIES = ("NORMAL", "STREAM", "DIRECT")
+
+# Reads and writes with O_DIRECT must be aligned (in memory, in the file, and
+# in length) to the file system's block size; a page is a safe multiple.
+ALIGNMENT = mmap.PAGESIZE
+
+# How much to read ahead of, and drop behind, a STREAM transfer at a time.
+STREAM_WINDOW = 8 * 2**20
+
+
+def _advise(fd, offset, length, advice):
+	if hasattr(os, "posix_fadvise"):
+		try:
+			os.posix_fadvise(fd, offset, length, advice)
+		except OSError:
+			pass
+
+
+def _alignUp(numBytes):
+	return -(-numBytes // ALIGNMENT) * ALIGNMENT
+
+
+def openReader(fileName, policy):
+	"""Opens the named file for reading in binary mode, under the given
+	policy (see IO_POLICIES). Returns a file-like object with read and close
+	methods, which can be used in a with statement."""
+
+	if policy == "DIRECT" and hasattr(os, "O_DIRECT"):
+		try:
+			return DirectReader(fileName)
+		except OSError:
+			pass # (Usually EINVAL: not supported on this file system.)
+	inFile = open(fileName, "rb")
+	if policy == "NORMAL":
+		return inFile
+	return StreamReader(inFile)
+
+
+def openWriter(outFile, policy):
+	"""Returns a file-like object (with write and close methods, which can be
+	used in a with statement) which writes to the given open binary file
+	under the given policy, from its current position. Closing it leaves
+	outFile open."""
+
+	if policy == "DIRECT" and fcntl and hasattr(os, "O_DIRECT"):
+		try:
+			return DirectWriter(outFile)
+		except OSError:
+			pass
+	if policy == "NORMAL":
+		return _PlainWriter(outFile)
+	return StreamWriter(outFile)
+
+
+class _PolicyFile:
+	"""The common parts of the reader and writer types."""
+
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *excInfo):
+		self.close()
+		return False
+
+
+class DirectReader(_PolicyFile):
+	"""Reads a file with O_DIRECT, into a page-aligned buffer. Each read
+	returns up to the requested size, rounded up to the alignment."""
+
+	__slots__ = ("_buffer", "_fd")
+
+	def __init__(self, fileName):
+		self._buffer = None
+		self._fd = os.open(fileName, os.O_RDONLY | os.O_DIRECT)
+
+
+	def close(self):
+		if self._buffer:
+			self._buffer.close()
+		os.close(self._fd)
+
+
+	def read(self, numBytes):
+		numBytes = _alignUp(numBytes)
+		if not self._buffer or len(self._buffer) < numBytes:
+			if self._buffer:
+				self._buffer.close()
+			# (Anonymous maps are always page-aligned.)
+			self._buffer = mmap.mmap(-1, numBytes)
+		with memoryview(self._buffer) as view:
+			numRead = os.readv(self._fd, [view[:numBytes]])
+			return bytes(view[:numRead])
+
+
+class StreamReader(_PolicyFile):
+	"""Reads an open file, reading ahead of the current position and
+	dropping the pages behind it from the page cache, a window at a time."""
+
+	__slots__ = ("_dropped", "_file", "_nextWindow", "_position")
+
+	def __init__(self, inFile):
+		self._file = inFile
+		self._dropped = 0
+		self._position = 0
+		self._nextWindow = STREAM_WINDOW
+		_advise(inFile.fileno(), 0, 0, getattr(os, "POSIX_FADV_SEQUENTIAL", 0))
+		_advise(inFile.fileno(), 0, STREAM_WINDOW, getattr(os, "POSIX_FADV_WILLNEED", 0))
+
+
+	def close(self):
+		_advise(self._file.fileno(), self._dropped, 0, getattr(os, "POSIX_FADV_DONTNEED", 0))
+		self._file.close()
+
+
+	def read(self, numBytes):
+		data = self._file.read(numBytes)
+		self._position += len(data)
+		if self._position >= self._nextWindow:
+			fd = self._file.fileno()
+			_advise(fd, self._nextWindow, STREAM_WINDOW, getattr(os, "POSIX_FADV_WILLNEED", 0))
+			_advise(fd, self._dropped, self._position - self._dropped,
+					getattr(os, "POSIX_FADV_DONTNEED", 0))
+			self._dropped = self._position
+			self._nextWindow = self._position + STREAM_WINDOW
+		return data
+
+
+class _PlainWriter(_PolicyFile):
+	"""Writes to an open file with no special handling."""
+
+	__slots__ = ("write",)
+
+	def __init__(self, outFile):
+		self.write = outFile.write
+
+
+	def close(self):
+		pass
+
+
+class StreamWriter(_PolicyFile):
+	"""Writes to an open file, flushing each window of data to the disk and
+	then dropping it from the page cache."""
+
+	__slots__ = ("_dropped", "_file", "_position")
+
+	def __init__(self, outFile):
+		self._file = outFile
+		self._dropped = self._position = outFile.tell()
+
+
+	def close(self):
+		self._drop()
+
+
+	def write(self, data):
+		numBytes = self._file.write(data)
+		self._position += numBytes
+		if self._position - self._dropped >= STREAM_WINDOW:
+			self._drop()
+		return numBytes
+
+
+	def _drop(self):
+		if self._position > self._dropped:
+			self._file.flush()
+			os.fdatasync(self._file.fileno())
+			_advise(self._file.fileno(), self._dropped, self._position - self._dropped,
+					getattr(os, "POSIX_FADV_DONTNEED", 0))
+			self._dropped = self._position
+
+
+class DirectWriter(_PolicyFile):
+	"""Writes to an open file with O_DIRECT, gathering the data into a
+	page-aligned buffer and writing it out a whole buffer at a time. The
+	final partial block is written without O_DIRECT when closed. The file's
+	position must be aligned to begin with."""
+
+	__slots__ = ("_buffer", "_fd", "_flags", "_used")
+
+	# The size of the buffer (a multiple of ALIGNMENT).
+	BUFFER_SIZE = 2**20
+
+	def __init__(self, outFile):
+		outFile.flush()
+		self._fd = outFile.fileno()
+		if os.lseek(self._fd, 0, os.SEEK_CUR) % ALIGNMENT:
+			raise OSError("unaligned file position")
+		self._flags = fcntl.fcntl(self._fd, fcntl.F_GETFL)
+		fcntl.fcntl(self._fd, fcntl.F_SETFL, self._flags | os.O_DIRECT)
+		self._buffer = mmap.mmap(-1, self.BUFFER_SIZE)
+		self._used = 0
+
+
+	def close(self):
+		fcntl.fcntl(self._fd, fcntl.F_SETFL, self._flags)
+		try:
+			if self._used:
+				with memoryview(self._buffer) as view:
+					self._writeAll(view[:self._used])
+		finally:
+			self._buffer.close()
+
+
+	def write(self, data):
+		with memoryview(data) as dataView, memoryview(self._buffer) as view:
+			offset = 0
+			while offset < len(dataView):
+				numBytes = min(len(dataView) - offset, self.BUFFER_SIZE - self._used)
+				view[self._used:self._used + numBytes] = dataView[offset:offset + numBytes]
+				self._used += numBytes
+				offset += numBytes
+				if self._used == self.BUFFER_SIZE:
+					self._writeAll(view)
+					self._used = 0
+		return len(data)
+
+
+	def _writeAll(self, view):
+		offset = 0
+		while offset < len(view):
+			offset += os.write(self._fd, view[offset:])
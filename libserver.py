@@ -33,99 +33,182 @@ connected client, an instance of this type is created with the connected
 client's socket and a tuple of its (IP, port), then its handleClientConnection
 function is called in the child thread or process (depending on which
 listenForever function is used) to process the client, while the main loop
-continues to listen for more client connections. The server can be stopped with
-a keyboard break (such as Ctrl+C on Linux/Unix systems)."""
+continues to listen for more client connections. Besides its TCP port, the
+server may also listen on a Unix domain socket, for clients on the same host;
+the address given for those clients is ("unix", <the client's process ID>).
+If a TLS context (see the tls module) is given, the TCP clients' sockets are
+wrapped in TLS, the handshake being done by the child thread or process.
+The server can be stopped with a keyboard break (such as Ctrl+C on Linux/Unix
+systems)."""
 
 
+import os
 import re
+import select
 import socket
+import stat
 import threading
 
 from os import _exit, fork, waitpid
-from utils import debugPrint
+from utils import debugPrint, unixPeerAddress
 from ServerConnection import ServerConnectionHandler
 from sys import exit
+
+
+def _acceptClient(listeners, tlsContext):
+	"""Waits for a client to connect on any of the given listening sockets.
+	Returns a tuple of the connected socket (wrapped in TLS, if a TCP client
+	and tlsContext is given; the handshake is done on its first use) and the
+	client's address."""
+	
+	(readable, writable, errored) = select.select(listeners, [], [])
+	(clientSock, clientAddr) = readable[0].accept()
+	if clientSock.family == socket.AF_UNIX:
+		clientAddr = unixPeerAddress(clientSock)
+	else:
+		# Control messages are short request/reply exchanges, so don't
+		# let Nagle's algorithm hold them back.
+		clientSock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		if tlsContext:
+			clientSock = tlsContext.wrap_socket(clientSock, server_side=True,
+					do_handshake_on_connect=False)
+	return (clientSock, clientAddr)
+
+
+def _closeListeners(listeners):
+	"""Closes the given listening sockets, removing those in the file system."""
 	
+	for servSock in listeners:
+		if servSock.family == socket.AF_UNIX:
+			try:
+				os.unlink(servSock.getsockname())
+			except OSError:
+				pass
+		servSock.close()
+
+
+def _openListeners(servPort, unixPath):
+	"""Returns a list of sockets listening on the given TCP port, and on the
+	Unix domain socket at unixPath (if given). A socket left at that path by
+	a server which is no longer running is replaced."""
+	
+	listeners = []
+	try:
+		servSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listeners.append(servSock)
+		servSock.bind(("", servPort))
+		debugPrint("SERVER ({addr}) : Listening for incoming connections on port {p}.".format(
+				addr=servSock.getsockname()[0], p=servPort))
+		if unixPath:
+			_removeStaleSocket(unixPath)
+			servSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			listeners.append(servSock)
+			servSock.bind(unixPath)
+			debugPrint("SERVER: Listening for incoming connections on {path}.".format(
+					path=unixPath))
+		for servSock in listeners:
+			servSock.listen(2)
+	except socket.error:
+		for servSock in listeners:
+			servSock.close()
+		raise
+	return listeners
 
-def threadingServer_listenForever(servPort, connHandlerType):
+
+def _removeStaleSocket(unixPath):
+	"""Removes the Unix domain socket at the given path, if there is one and
+	nothing is listening on it any more."""
+	
+	try:
+		if not stat.S_ISSOCK(os.lstat(unixPath).st_mode):
+			return
+	except FileNotFoundError:
+		return
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probeSock:
+		try:
+			probeSock.connect(unixPath)
+		except ConnectionRefusedError:
+			os.unlink(unixPath)
+		# (Otherwise, it is in use; so binding it fails.)
+
+
+def threadingServer_listenForever(servPort, connHandlerType, unixPath=None, tlsContext=None):
 	"""Given a ServerConnectionHandler type, uses threading to implement a
 	parallel server which listens for (possibly concurrent) client connections
-	and process them in child threads."""
+	(on the given TCP port, with TLS if a context is given, and Unix domain
+	socket path if any) and process them in child threads."""
 	
 	assert issubclass(connHandlerType, ServerConnectionHandler)
 	
 	workerThreads = []
+	listeners = []
 	try:
-		with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as servSock:
-			servSock.bind(("", servPort))
-			debugPrint("SERVER ({addr}) : Listening for incoming connections on port {p}.".format(
-					addr=servSock.getsockname()[0], p=servPort))
-			debugPrint("SERVER: Press Ctrl+C to quit.")
-			servSock.listen(2)
-			while True:		
-				(clientSock, clientAddr) = servSock.accept()
-				handler = connHandlerType(clientSock, clientAddr)
-				clientThread = threading.Thread(target=handler.handleClientConnection)
-				workerThreads.append(clientThread)
-				debugPrint("SERVER: Client ({addr}) connected -- handler thread {tid}...".format(
-						addr=clientAddr, tid=clientThread.name))
-				clientThread.start()
-				debugPrint("SERVER: Main loop running, accepting more connections...")
+		listeners = _openListeners(servPort, unixPath)
+		debugPrint("SERVER: Press Ctrl+C to quit.")
+		while True:		
+			(clientSock, clientAddr) = _acceptClient(listeners, tlsContext)
+			handler = connHandlerType(clientSock, clientAddr)
+			clientThread = threading.Thread(target=handler.handleClientConnection)
+			workerThreads.append(clientThread)
+			debugPrint("SERVER: Client ({addr}) connected -- handler thread {tid}...".format(
+					addr=clientAddr, tid=clientThread.name))
+			clientThread.start()
+			debugPrint("SERVER: Main loop running, accepting more connections...")
 	except socket.error as socketError:
 		debugPrint("SERVER: Could not creating listening socket. Reason: {err}".format(
 				err=socketError))
+		_closeListeners(listeners)
 		exit(1)
 	except (KeyboardInterrupt, SystemExit):
 		debugPrint("SERVER: Received exit signal. Waiting for workers to finish...")
 		for childThread in workerThreads:
 			childThread.join()
 		debugPrint("SERVER: Shutting down.")
-		servSock.close()
+		_closeListeners(listeners)
 		exit(0)
 
 
-def forkingServer_listenForever(servPort, connHandlerType):
+def forkingServer_listenForever(servPort, connHandlerType, unixPath=None, tlsContext=None):
 	"""Given a ServerConnectionHandler type, uses forking to implement a
 	parallel server which listens for (possibly concurrent) client connections
-	and handle them in child processes."""
+	(on the given TCP port, with TLS if a context is given, and Unix domain
+	socket path if any) and handle them in child processes."""
 
 	assert issubclass(connHandlerType, ServerConnectionHandler)
 	
 	workerProcs = []
+	listeners = []
 	try:
-		with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as servSock:
-			servSock.bind(("", servPort))
-			debugPrint("SERVER ({addr}) : Listening for incoming connections on port {p}.".format(
-					addr=servSock.getsockname()[0], p=servPort))
-			debugPrint("SERVER: Press Ctrl+C to quit.")
-			servSock.listen(2)
-			while True:		
+		listeners = _openListeners(servPort, unixPath)
+		debugPrint("SERVER: Press Ctrl+C to quit.")
+		while True:		
+			try:
+				(clientSock, clientAddr) = _acceptClient(listeners, tlsContext)
+			except KeyboardInterrupt:
+				debugPrint("SERVER: Received exit signal. Waiting for workers to finish...")
+				for workerPID in workerProcs:
+					waitpid(workerPID, 0)
+				debugPrint("SERVER: Shutting down.")
+				_closeListeners(listeners)
+				exit(0)
+			childPID = fork()
+			# NB: fork() returns 0 to child; and the child PID to the parent.
+			if childPID == 0:
 				try:
-					(clientSock, clientAddr) = servSock.accept()
+					handler = connHandlerType(clientSock, clientAddr)
+					handler.handleClientConnection()
 				except KeyboardInterrupt:
-					debugPrint("SERVER: Received exit signal. Waiting for workers to finish...")
-					for workerPID in workerProcs:
-						waitpid(workerPID, 0)
-					debugPrint("SERVER: Shutting down.")
-					servSock.close()
-					exit(0)
-				childPID = fork()
-				# NB: fork() returns 0 to child; and the child PID to the parent.
-				if childPID == 0:
-					try:
-						handler = connHandlerType(clientSock, clientAddr)
-						handler.handleClientConnection()
-					except KeyboardInterrupt:
-						# The break will be handled by the main server process.
-						pass
-					finally:
-						_exit(0)
-				else:
-					debugPrint("SERVER: Client ({addr}) connected -- handler PID {pid}...".format(
-						addr=clientAddr, pid=childPID))
-					workerProcs.append(childPID)
-					debugPrint("SERVER: Main loop running, accepting more connections...")
+					# The break will be handled by the main server process.
+					pass
+				finally:
+					_exit(0)
+			else:
+				debugPrint("SERVER: Client ({addr}) connected -- handler PID {pid}...".format(
+					addr=clientAddr, pid=childPID))
+				workerProcs.append(childPID)
+				debugPrint("SERVER: Main loop running, accepting more connections...")
 	except socket.error as socketError:
 		debugPrint("SERVER: Could not creating listening socket. Reason: {err}".format(
 				err=socketError))
+		_closeListeners(listeners)
 		exit(1)
@@ -0,0 +1,308 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the Multiplexer and MuxChannel types, used by the
+MULTIPLEX transport mode to carry the control channel and any number of data
+channels over the one control connection.
+
+Every message is sent as a frame: a header holding the channel ID and the
+payload length (each an unsigned 32-bit integer, in network byte order),
+followed by the payload. Channel 0 is the control channel. A frame with an
+empty payload marks the end of its channel (like a socket EOF).
+
+Each channel is flow controlled: at most CHANNEL_WINDOW bytes may be sent on
+it before the receiver grants more credit, with a credit frame (whose channel
+ID has CREDIT_FLAG set, and whose length is the number of bytes granted,
+with no payload), so that no more than that is ever buffered for a channel
+which is not being read."""
+
+# Example usage:
+# >>> mux = Multiplexer(ctrlSock)
+# >>> ctrlChannel = mux.channel(0)
+# >>> dataChannel = mux.channel(1)
+# >>> sendStr(dataChannel, "Hello, World!")
+
+import struct
+import threading
+
+
+FRAME_HEADER = struct.Struct("!II")
+
+# Set in the channel ID of a credit frame.
+CREDIT_FLAG = 0x80000000
+
+# Large writes are split into frames of at most this many bytes, so that
+# transfers on other channels can be interleaved with them.
+MAX_FRAME_SIZE = 256 * 1024
+
+# The credit each channel starts with, at both ends. The receiver grants it
+# again as the data is read, half a window at a time.
+CHANNEL_WINDOW = 4 * MAX_FRAME_SIZE
+
+
+class Multiplexer:
+	"""Splits one stream socket into numbered channels. Sends from any thread
+	are serialized by a lock. Whichever thread is first to need a frame (to
+	receive data, or to wait for credit to send it) reads frames for every
+	channel, buffering those that are not its own, while any others wait for
+	it; no more than CHANNEL_WINDOW bytes are ever buffered for a channel."""
+
+	__slots__ = ("_buffers", "_closedLocal", "_closedRemote", "_cond", "_consumed", "_credits",
+			"_eof", "_reading", "_sendLock", "_sock")
+
+	def __init__(self, sock):
+		self._sock = sock
+		self._buffers = {}
+		self._closedLocal = set()
+		self._closedRemote = set()
+		self._cond = threading.Condition()
+		self._consumed = {}
+		self._credits = {}
+		self._eof = False
+		self._reading = False
+		self._sendLock = threading.Lock()
+
+
+	def channel(self, channelID):
+		"""Returns a socket-like object for the given channel."""
+
+		with self._cond:
+			self._buffers.setdefault(channelID, bytearray())
+			self._closedLocal.discard(channelID)
+			self._closedRemote.discard(channelID)
+		return MuxChannel(self, channelID)
+
+
+	def closeChannel(self, channelID):
+		"""Sends the end-of-channel marker for the given channel. Closing
+		channel 0 (the control channel) closes the underlying socket."""
+
+		with self._cond:
+			if channelID in self._closedLocal:
+				return
+			self._closedLocal.add(channelID)
+			# (Anything still buffered for it will never be read.)
+			self._buffers.pop(channelID, None)
+		try:
+			self._sendFrame(channelID, b"")
+		except OSError:
+			pass
+		if channelID == 0:
+			self._sock.close()
+		else:
+			with self._cond:
+				if channelID in self._closedRemote:
+					self._forget(channelID)
+
+
+	def recv(self, channelID, numBytes):
+		"""Returns at most numBytes of data received on the given channel,
+		blocking until some is available. Returns an empty bytes object once
+		the remote end has closed the channel."""
+
+		with self._cond:
+			buff = self._buffers.setdefault(channelID, bytearray())
+			while not buff and channelID not in self._closedRemote:
+				self._awaitFrame()
+			data = bytes(buff[:numBytes])
+			del buff[:numBytes]
+			consumed = self._consumed.get(channelID, 0) + len(data)
+			grant = consumed >= CHANNEL_WINDOW // 2 and channelID not in self._closedRemote
+			self._consumed[channelID] = 0 if grant else consumed
+		if grant:
+			try:
+				self._sendFrame(channelID | CREDIT_FLAG, b"", consumed)
+			except OSError:
+				# (The next recv will find the connection closed.)
+				pass
+		return data
+
+
+	def send(self, channelID, data):
+		"""Sends all of the given data on the given channel, split into as
+		many frames as needed, waiting for credit as need be. Returns the
+		number of bytes sent."""
+
+		data = memoryview(data)
+		offset = 0
+		while offset < len(data):
+			size = self._takeCredit(channelID, min(len(data) - offset, MAX_FRAME_SIZE))
+			self._sendFrame(channelID, data[offset:offset+size])
+			offset += size
+		return len(data)
+
+
+	@property
+	def rawSocket(self):
+		return self._sock
+
+
+	def _awaitFrame(self):
+		"""Waits until another frame has been read, by reading it (unless
+		another thread already is) and handling it. Must be called with the
+		condition held, which is released while waiting."""
+
+		if self._reading:
+			self._cond.wait()
+			return
+		self._reading = True
+		self._cond.release()
+		try:
+			frame = self._readFrame()
+		finally:
+			self._cond.acquire()
+			self._reading = False
+			self._cond.notify_all()
+		if frame:
+			self._handleFrame(*frame)
+		else:
+			# The connection itself was closed; so are all channels.
+			self._eof = True
+			self._closedRemote.update(self._buffers.keys())
+
+
+	def _forget(self, channelID):
+		"""Drops all state for a channel closed at both ends."""
+
+		self._buffers.pop(channelID, None)
+		self._closedLocal.discard(channelID)
+		self._closedRemote.discard(channelID)
+		self._consumed.pop(channelID, None)
+		self._credits.pop(channelID, None)
+
+
+	def _handleFrame(self, channelID, length, payload):
+		"""Applies a frame read by _readFrame. Must be called with the
+		condition held."""
+
+		if channelID & CREDIT_FLAG:
+			channelID &= ~CREDIT_FLAG
+			self._credits[channelID] = self._credits.get(channelID, CHANNEL_WINDOW) + length
+		elif not length:
+			self._closedRemote.add(channelID)
+			if channelID in self._closedLocal:
+				self._forget(channelID)
+		elif channelID not in self._closedLocal:
+			self._buffers.setdefault(channelID, bytearray()).extend(payload)
+		# (Data for a channel we have already closed is dropped.)
+
+
+	def _readFrame(self):
+		"""Reads one frame from the socket, returning its channel ID (with
+		CREDIT_FLAG, if set), length and payload; or None if the socket was
+		closed."""
+
+		header = self._recvExact(FRAME_HEADER.size)
+		if not header:
+			return None
+		(channelID, length) = FRAME_HEADER.unpack(header)
+		if channelID & CREDIT_FLAG or not length:
+			return (channelID, length, b"")
+		payload = self._recvExact(length)
+		if not payload:
+			return None
+		return (channelID, length, payload)
+
+
+	def _recvExact(self, numBytes):
+		"""Reads exactly numBytes from the socket, or returns None if it is
+		closed first."""
+
+		buff = bytearray()
+		while len(buff) < numBytes:
+			data = self._sock.recv(numBytes - len(buff))
+			if not data:
+				return None
+			buff.extend(data)
+		return buff
+
+
+	def _sendFrame(self, channelID, payload, length=None):
+		"""Sends one frame. Its length is that of the payload, unless given
+		(for credit frames, which have none)."""
+
+		if length is None:
+			length = len(payload)
+		with self._sendLock:
+			self._sock.sendall(FRAME_HEADER.pack(channelID, length) + bytes(payload))
+
+
+	def _takeCredit(self, channelID, numBytes):
+		"""Waits for credit to send on the given channel, and takes as much of
+		it as is available, up to numBytes; returning the amount taken. Once
+		the remote end has closed the channel (and so drops anything sent on
+		it), or the connection, no credit is needed."""
+
+		with self._cond:
+			while (self._credits.get(channelID, CHANNEL_WINDOW) <= 0
+					and channelID not in self._closedRemote and not self._eof):
+				self._awaitFrame()
+			credit = self._credits.get(channelID, CHANNEL_WINDOW)
+			if credit <= 0:
+				return numBytes
+			numBytes = min(numBytes, credit)
+			self._credits[channelID] = credit - numBytes
+			return numBytes
+
+
+class MuxChannel:
+	"""A socket-like view of one channel of a Multiplexer, providing just
+	enough of the socket interface (send, sendall, recv and close) for the
+	functions in utils to use it in place of a real socket."""
+
+	__slots__ = ("_channelID", "_mux")
+
+	def __init__(self, mux, channelID):
+		self._mux = mux
+		self._channelID = channelID
+
+
+	def close(self):
+		self._mux.closeChannel(self._channelID)
+
+
+	def recv(self, numBytes):
+		return self._mux.recv(self._channelID, numBytes)
+
+
+	def send(self, data):
+		return self._mux.send(self._channelID, data)
+
+
+	def sendall(self, data):
+		self._mux.send(self._channelID, data)
+
+
+	@property
+	def channelID(self):
+		return self._channelID
+
+
+	@property
+	def multiplexer(self):
+		return self._mux
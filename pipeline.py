@@ -0,0 +1,124 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the BufferPipeline class, used to overlap disk and
+network I/O during file transfers. A producer function (such as one reading
+chunks of a file) runs in a background thread, filling a bounded queue of
+buffers, while the calling thread drains it (such as by sending them on a
+socket). Since the queue is bounded, a slow consumer blocks the producer
+instead of letting it buffer the whole file in memory."""
+
+# Example usage:
+# >>> def readChunks():
+# ...     while True:
+# ...         data = inFile.read(65536)
+# ...         if not data:
+# ...             return
+# ...         yield data
+# >>> with BufferPipeline(readChunks, depth=4) as pipeline:
+# ...     for data in pipeline:
+# ...         sendStr(sock, data)
+
+import queue
+import threading
+
+
+class BufferPipeline:
+	"""Runs a producer (a function returning an iterator of buffers) in a
+	background thread, for use in a with statement; iterating over the
+	pipeline yields the buffers in order. At most depth buffers are queued at
+	a time. If the producer raises an exception, iteration re-raises it in
+	the consuming thread. Leaving the with block early (for instance, due to
+	an error while consuming) stops the producer after its current buffer."""
+
+	__slots__ = ("_depth", "_error", "_producer", "_queue", "_stopped", "_thread")
+
+	# Marks the end of the queued buffers.
+	_END = object()
+
+	# How often (seconds) a producer blocked on a full queue checks whether
+	# it has been stopped.
+	_POLL_INTERVAL = 0.1
+
+	def __init__(self, producer, depth):
+		self._depth = max(depth, 1)
+		self._error = None
+		self._producer = producer
+		self._queue = queue.Queue(maxsize=self._depth)
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+
+
+	def __enter__(self):
+		self._thread.start()
+		return self
+
+
+	def __exit__(self, *excInfo):
+		self._stopped.set()
+		# Make room for a producer blocked on the full queue, so that it sees
+		# the stop flag promptly.
+		while self._thread.is_alive():
+			try:
+				self._queue.get(timeout=self._POLL_INTERVAL)
+			except queue.Empty:
+				pass
+		self._thread.join()
+
+
+	def __iter__(self):
+		while True:
+			data = self._queue.get()
+			if data is self._END:
+				if self._error:
+					raise self._error
+				return
+			yield data
+
+
+	def _put(self, item):
+		"""Queues the given item, blocking while the queue is full. Returns
+		False (without queueing it) if the pipeline was stopped meanwhile."""
+
+		while not self._stopped.is_set():
+			try:
+				self._queue.put(item, timeout=self._POLL_INTERVAL)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+
+	def _run(self):
+		try:
+			for data in self._producer():
+				if not self._put(data):
+					return
+		except Exception as err:
+			self._error = err
+		self._put(self._END)
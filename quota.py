@@ -0,0 +1,157 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the SpaceManager type, used by the server to admit or
+refuse uploads before any data is sent: it checks the declared size of each
+upload against the free disk space (less the space already promised to other
+uploads in progress) and against the upload quotas. Shared state is kept in
+multiprocessing shared memory, so the same SpaceManager works in both the
+threading and forking servers as long as it is created before forking."""
+
+# Example usage:
+# >>> space = SpaceManager(globalQuota=10*2**30, sessionQuota=2**30)
+# >>> try:
+# ...     reservation = space.reserve(fileName, fileSize, extraBytes, sessionUsed)
+# ... except SpaceRefused as err:
+# ...     sendStr(sock, "ERR {reason}\n".format(reason=err))
+# >>> with reservation:
+# ...     pass # Receive the file, then call reservation.commit().
+
+import multiprocessing
+import os
+
+
+class SpaceRefused(Exception):
+	"""Raised by SpaceManager.reserve when an upload cannot be admitted. Its
+	message is the reason, as given in the ERR reply."""
+
+
+class SpaceManager:
+	"""Keeps the server-wide disk space settings and state: the space reserved
+	for uploads in progress, the global quota (the total number of bytes that
+	all connections together may upload) and how much of it is used, the
+	per-connection quota, and the amount of disk space to always leave free.
+	A quota of 0 means no limit."""
+
+	__slots__ = ("_globalQuota", "_minFree", "_reserved", "_sessionQuota", "_used")
+
+	def __init__(self, globalQuota=0, sessionQuota=0, minFree=0):
+		self._globalQuota = globalQuota
+		self._minFree = minFree
+		self._reserved = multiprocessing.Value("q", 0)
+		self._sessionQuota = sessionQuota
+		self._used = multiprocessing.Value("q", 0)
+
+
+	def reserve(self, fileName, fileSize, extraBytes=0, sessionUsed=0):
+		"""Admits an upload of fileSize bytes to the named file, reserving disk
+		space for it (plus extraBytes more, for any temporary copy), or raises
+		SpaceRefused. sessionUsed is how much the connection has uploaded so
+		far. Returns a SpaceReservation, to be used in a with statement."""
+
+		if self._sessionQuota and sessionUsed + fileSize > self._sessionQuota:
+			raise SpaceRefused("SESSION QUOTA EXCEEDED")
+		numBytes = fileSize + extraBytes
+		try:
+			fsStat = os.statvfs(os.path.dirname(os.path.abspath(fileName)))
+			freeBytes = fsStat.f_bavail * fsStat.f_frsize
+		except (AttributeError, OSError):
+			freeBytes = None # Unknown; only the quotas can be checked.
+
+		with self._reserved.get_lock(), self._used.get_lock():
+			if self._globalQuota and self._used.value + fileSize > self._globalQuota:
+				raise SpaceRefused("QUOTA EXCEEDED")
+			if freeBytes is not None and \
+					freeBytes - self._reserved.value - self._minFree < numBytes:
+				raise SpaceRefused("NO SPACE LEFT")
+			self._reserved.value += numBytes
+			# Count the upload against the global quota while it is in
+			# progress, so that concurrent uploads cannot exceed it either.
+			self._used.value += fileSize
+		return SpaceReservation(self, numBytes, fileSize)
+
+
+	def status(self):
+		"""Returns a list of (name, value) pairs describing the current disk
+		space settings and reservations."""
+
+		return [
+				("SPACERESERVED", self._reserved.value),
+				("MINFREESPACE", self._minFree),
+				("GLOBALQUOTA", self._globalQuota),
+				("GLOBALQUOTAUSED", self._used.value),
+				("SESSIONQUOTA", self._sessionQuota)
+				]
+
+
+class SpaceReservation:
+	"""The disk space reserved for a single upload. It is given back when the
+	with block ends, or earlier by release (for instance, once the space has
+	actually been allocated on the disk). Unless commit is called first, the
+	upload is not counted against the global quota either."""
+
+	__slots__ = ("_committed", "_fileSize", "_manager", "_numBytes")
+
+	def __init__(self, manager, numBytes, fileSize):
+		self._committed = False
+		self._fileSize = fileSize
+		self._manager = manager
+		self._numBytes = numBytes
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *exceptionArgs):
+		self.release()
+		if not self._committed:
+			with self._manager._used.get_lock():
+				self._manager._used.value -= self._fileSize
+			self._committed = True
+		return False
+
+
+	def commit(self, numBytesStored=None):
+		"""Marks the upload as complete, so that it stays counted against the
+		global quota. If it stored fewer bytes than were reserved (given as
+		numBytesStored), only those stay counted."""
+
+		if numBytesStored is not None and numBytesStored < self._fileSize:
+			with self._manager._used.get_lock():
+				self._manager._used.value -= self._fileSize - numBytesStored
+			self._fileSize = numBytesStored
+		self._committed = True
+
+
+	def release(self):
+		"""Gives back the reserved disk space (if not already done)."""
+
+		with self._manager._reserved.get_lock():
+			self._manager._reserved.value -= self._numBytes
+		self._numBytes = 0
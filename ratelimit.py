@@ -0,0 +1,195 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the bandwidth shaping types used by the server: the
+TokenBucket type, a simple token bucket rate limiter; and the BandwidthManager
+type, which applies the global and per-connection rate limits (and optionally
+a fair share of the global limit) to each transfer. Shared state is kept in
+multiprocessing shared memory, so the same BandwidthManager works in both the
+threading and forking servers as long as it is created before forking."""
+
+# Example usage:
+# >>> bandwidth = BandwidthManager(globalRate=10*2**20, fairShare=True)
+# >>> with bandwidth.transfer(sessionRate) as limiter:
+# ...     sendFile(sock, fileName, chunkSize, limiter)
+
+import multiprocessing
+import threading
+
+from time import monotonic, sleep
+
+
+class TokenBucket:
+	"""A token bucket rate limiter. Tokens (bytes) accumulate at <rate> bytes
+	per second, up to <burst> bytes (by default, one second's worth). Taking
+	more tokens than are available puts the bucket into debt, and the caller
+	sleeps until it is paid off; this lets a single chunk be larger than the
+	burst size. A rate of 0 disables limiting entirely. If shared is set, the
+	bucket state lives in shared memory so that forked processes can use it."""
+
+	__slots__ = ("_lock", "_state")
+
+	def __init__(self, rate, burst=None, shared=False):
+		# _state holds: [rate, burst, tokens, time of last refill]
+		if shared:
+			self._lock = multiprocessing.Lock()
+			self._state = multiprocessing.RawArray("d", 4)
+		else:
+			self._lock = threading.Lock()
+			self._state = [0.0] * 4
+		self.setRate(rate, burst)
+
+
+	def consume(self, numBytes):
+		"""Takes numBytes tokens from the bucket, sleeping as long as needed to
+		keep the transfer at or below the bucket's rate."""
+
+		with self._lock:
+			(rate, burst, tokens, lastTime) = self._state
+			if rate <= 0:
+				return
+			now = monotonic()
+			tokens = min(burst, tokens + (now - lastTime) * rate) - numBytes
+			self._state[2] = tokens
+			self._state[3] = now
+		if tokens < 0:
+			sleep(-tokens / rate)
+
+
+	def setRate(self, rate, burst=None):
+		"""Changes the rate (bytes per second) and burst size of the bucket.
+		Tokens already accumulated are kept, up to the new burst size."""
+
+		with self._lock:
+			burst = burst if burst else max(rate, 1)
+			self._state[0] = rate
+			self._state[1] = burst
+			self._state[2] = min(self._state[2], burst)
+			self._state[3] = monotonic()
+
+
+	@property
+	def rate(self):
+		return self._state[0]
+
+
+class BandwidthManager:
+	"""Keeps the server-wide bandwidth settings and state: a global token
+	bucket, the default (maximum) per-connection rate, and the number of
+	active transfers. If fair sharing is enabled, each active transfer is
+	limited to an even share of the global rate."""
+
+	__slots__ = ("_activeTransfers", "_connRate", "_fairShare", "_globalBucket")
+
+	def __init__(self, globalRate=0, connRate=0, fairShare=False):
+		self._globalBucket = TokenBucket(globalRate, shared=True)
+		self._connRate = connRate
+		self._fairShare = fairShare
+		self._activeTransfers = multiprocessing.Value("i", 0)
+
+
+	def allocation(self, sessionRate=0):
+		"""Returns the rate (bytes per second) currently allotted to a single
+		transfer with the given session rate limit; 0 means unlimited."""
+
+		limits = [rate for rate in (sessionRate, self._connRate) if rate > 0]
+		globalRate = self._globalBucket.rate
+		if globalRate > 0:
+			if self._fairShare:
+				limits.append(globalRate / max(1, self._activeTransfers.value))
+			else:
+				limits.append(globalRate)
+		return int(min(limits)) if limits else 0
+
+
+	def sessionRate(self, requestedRate):
+		"""Returns the effective per-connection rate for a session which asks
+		for requestedRate (0 for no preference). Sessions may lower, but never
+		raise, the per-connection limit set when the server was started."""
+
+		if self._connRate <= 0:
+			return requestedRate
+		if requestedRate <= 0:
+			return self._connRate
+		return min(requestedRate, self._connRate)
+
+
+	def status(self):
+		"""Returns a list of (name, value) pairs describing the current
+		bandwidth settings and allocation."""
+
+		return [
+				("GLOBALRATELIMIT", int(self._globalBucket.rate)),
+				("CONNRATELIMIT", self._connRate),
+				("FAIRSHARE", "YES" if self._fairShare else "NO"),
+				("ACTIVETRANSFERS", self._activeTransfers.value),
+				("TRANSFERALLOCATION", self.allocation())
+				]
+
+
+	def transfer(self, sessionRate=0):
+		"""Returns a TransferLimiter for a single transfer, for use as a
+		context manager around the call to sendFile or recvFile."""
+
+		return TransferLimiter(self, sessionRate)
+
+
+class TransferLimiter:
+	"""The limiter for a single transfer, passed as the limiter argument to
+	sendFile and recvFile. While active (that is, inside the with block), it
+	counts as one transfer against the manager's fair share."""
+
+	__slots__ = ("_bucket", "_manager", "_sessionRate")
+
+	def __init__(self, manager, sessionRate):
+		self._manager = manager
+		self._sessionRate = sessionRate
+		self._bucket = TokenBucket(0)
+
+
+	def __enter__(self):
+		with self._manager._activeTransfers.get_lock():
+			self._manager._activeTransfers.value += 1
+		return self
+
+
+	def __exit__(self, *exceptionArgs):
+		with self._manager._activeTransfers.get_lock():
+			self._manager._activeTransfers.value -= 1
+		return False
+
+
+	def consume(self, numBytes):
+		"""Accounts for numBytes sent or received, sleeping as needed to keep
+		within both this transfer's allocation and the global limit."""
+
+		rate = self._manager.allocation(self._sessionRate)
+		if rate != self._bucket.rate:
+			self._bucket.setRate(rate)
+		self._bucket.consume(numBytes)
+		self._manager._globalBucket.consume(numBytes)
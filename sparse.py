@@ -0,0 +1,143 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the functions used by the SPARSE transfer mode, which
+sends only the data extents of a file, skipping its holes. The data is sent
+as a series of extents, each an EXTENT_HEADER (the extent's offset within
+the file and its length, as unsigned 64-bit integers in network byte order)
+followed by that many bytes of data; in order, and not overlapping. A final
+header with a length of 0 gives the file's total size as its offset, and ends
+the transfer. The receiver seeks past the holes, so that its copy of the file
+is sparse too."""
+
+# Example usage:
+# >>> sendSparseFile(sock, "disk.img", 65536)
+# >>> with open("disk.img", "wb") as outFile:
+# ...     recvSparseIntoFile(sock, fileSize, outFile, 65536)
+
+import errno
+import os
+import struct
+
+from utils import debugPrint, recvAll, sendStr
+
+
+EXTENT_HEADER = struct.Struct("!QQ")
+
+
+def dataExtents(fd, fileSize):
+	"""Yields (offset, length) tuples for each extent of data in the open
+	file, up to fileSize, skipping holes (using SEEK_DATA and SEEK_HOLE).
+	Where those are not supported, the whole file is one extent."""
+
+	if not hasattr(os, "SEEK_DATA"):
+		if fileSize:
+			yield (0, fileSize)
+		return
+	offset = 0
+	while offset < fileSize:
+		try:
+			dataStart = os.lseek(fd, offset, os.SEEK_DATA)
+		except OSError as err:
+			if err.errno != errno.ENXIO and offset == 0:
+				yield (0, fileSize) # Not supported by this file system.
+			return # (ENXIO: there is no more data.)
+		if dataStart >= fileSize:
+			return
+		dataEnd = min(os.lseek(fd, dataStart, os.SEEK_HOLE), fileSize)
+		yield (dataStart, dataEnd - dataStart)
+		offset = dataEnd
+
+
+def recvSparseIntoFile(sock, fileSize, outFile, chunkSize, limiter=None, tuner=None):
+	"""Receives a file of fileSize bytes sent by sendSparseFile into the
+	given (open, binary, seekable) file object, starting at its current
+	position. Returns fileSize; or -1 if the data ended early, or its extents
+	were malformed."""
+
+	base = outFile.tell()
+	end = 0
+	if tuner:
+		tuner.attach(sock)
+	while True:
+		header = recvAll(sock, EXTENT_HEADER.size)
+		if len(header) < EXTENT_HEADER.size:
+			return -1
+		(offset, length) = EXTENT_HEADER.unpack(header)
+		if offset < end or offset + length > fileSize or (not length and offset != fileSize):
+			debugPrint("recvSparseIntoFile: bad extent {ext}".format(ext=(offset, length)))
+			return -1
+		if not length:
+			break
+		outFile.seek(base + offset)
+		numBytesRecvd = 0
+		while numBytesRecvd < length:
+			nextChunkSize = min(tuner.chunkSize if tuner else chunkSize, length - numBytesRecvd)
+			recvBuff = recvAll(sock, nextChunkSize)
+			if not recvBuff:
+				return -1
+			outFile.write(recvBuff)
+			numBytesRecvd += len(recvBuff)
+			if limiter:
+				limiter.consume(len(recvBuff))
+			if tuner:
+				tuner.record(len(recvBuff))
+		end = offset + length
+	# Any hole at the end is made by extending the file, without writing.
+	outFile.truncate(base + fileSize)
+	outFile.seek(base + fileSize)
+	return fileSize
+
+
+def sendSparseFile(sock, fileName, fileSize, chunkSize, limiter=None, tuner=None):
+	"""Sends the data extents (see the module description) of the first
+	fileSize bytes of the named file on the given socket. (If the file is
+	shorter than that by now, the rest is sent as a hole.) Returns the number
+	of data bytes sent, excluding the holes and headers."""
+
+	numBytesSent = 0
+	if tuner:
+		tuner.attach(sock)
+	with open(fileName, "rb") as dataFile:
+		for (offset, length) in dataExtents(dataFile.fileno(), fileSize):
+			debugPrint("sendSparseFile: extent {ext}".format(ext=(offset, length)))
+			sendStr(sock, EXTENT_HEADER.pack(offset, length))
+			dataFile.seek(offset)
+			remaining = length
+			while remaining > 0:
+				nextChunkSize = min(tuner.chunkSize if tuner else chunkSize, remaining)
+				data = dataFile.read(nextChunkSize) or bytes(nextChunkSize)
+				sendStr(sock, data)
+				remaining -= len(data)
+				numBytesSent += len(data)
+				if limiter:
+					limiter.consume(len(data))
+				if tuner:
+					tuner.record(len(data))
+		sendStr(sock, EXTENT_HEADER.pack(fileSize, 0))
+	return numBytesSent
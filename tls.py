@@ -0,0 +1,134 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the TLS support shared by the server and the client.
+When the server is given a certificate, its TCP control connections are made
+over TLS, and so are the data connections belonging to them; the server keeps
+the role of TLS server on those even when it makes them itself (in active
+mode), so that the client can offer the control connection's TLS session on
+each one and skip the full handshake (session resumption; in TLS 1.3, by the
+session ticket the server sent on the control connection). Where Python and
+OpenSSL support kernel TLS (ssl.OP_ENABLE_KTLS, and an OpenSSL built with it),
+the record encryption is handed to the kernel after the handshake, so file
+data can be sent with os.sendfile, without copying it through the process."""
+
+# Example usage:
+# >>> serverCtx = serverContext("cert.pem", "key.pem")
+# >>> ctrlSock = serverCtx.wrap_socket(clientSock, server_side=True)
+# ...and, for each of its data connections:
+# >>> dataSock = wrapDataSocket(ctrlSock, rawDataSock)
+# >>> kernelSendEnabled(dataSock)
+# True
+
+import socket
+import ssl
+
+
+# The option which enables kernel TLS, in the Python versions which have it
+# (3.12 and later); 0 elsewhere.
+KTLS_OPTION = getattr(ssl, "OP_ENABLE_KTLS", 0)
+
+# The Linux socket option level and name through which a socket's kernel TLS
+# transmit state can be read. (Reading it fails unless that is set up.)
+SOL_TLS = getattr(socket, "SOL_TLS", 282)
+TLS_TX = getattr(socket, "TLS_TX", 1)
+
+
+def clientContext(caFile=None, verify=True):
+	"""Returns a TLS context for the client, which checks the server's
+	certificate against the given CA certificates (by default, the system's)
+	and host name, unless verify is False."""
+
+	context = ssl.create_default_context(cafile=caFile)
+	context.minimum_version = ssl.TLSVersion.TLSv1_2
+	if not verify:
+		context.check_hostname = False
+		context.verify_mode = ssl.CERT_NONE
+	context.options |= KTLS_OPTION
+	return context
+
+
+def hasApplicationData(sock):
+	"""Given a TLS socket which select reports as readable, reads (without
+	blocking) whatever TLS messages other than data it has received, such as
+	the session tickets a TLS 1.3 server sends after the handshake. Returns
+	True if there is more than that (data, or the end of the connection)."""
+
+	timeout = sock.gettimeout()
+	sock.setblocking(False)
+	try:
+		sock.recv(1)
+	except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+		return False
+	except OSError:
+		pass
+	finally:
+		sock.settimeout(timeout)
+	return True
+
+
+def kernelSendEnabled(sock):
+	"""Returns True if the given socket is a TLS socket whose records are
+	sent by the kernel (kernel TLS), so that os.sendfile may be used on it."""
+
+	if not isinstance(sock, ssl.SSLSocket) or not KTLS_OPTION:
+		return False
+	try:
+		sock.getsockopt(SOL_TLS, TLS_TX, 64)
+	except OSError:
+		return False
+	return True
+
+
+def serverContext(certFile, keyFile=None):
+	"""Returns a TLS context for the server, using the given certificate
+	chain and private key files (the key may be in the certificate file).
+	NB: the forking server must create it before forking, so that all of the
+	child processes share its session ticket key."""
+
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+	context.minimum_version = ssl.TLSVersion.TLSv1_2
+	context.load_cert_chain(certFile, keyFile)
+	context.options |= KTLS_OPTION
+	return context
+
+
+def wrapDataSocket(ctrlSock, dataSock):
+	"""Wraps the given newly-connected data socket in TLS, in the same role
+	as the given TLS control socket: as the server; or as the client,
+	offering the control connection's session for resumption. Performs the
+	handshake (within dataSock's timeout), and returns the TLS socket."""
+
+	if dataSock.family != socket.AF_UNIX:
+		# The handshake is a few small messages each way, which Nagle's
+		# algorithm would otherwise hold back.
+		dataSock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	if ctrlSock.server_side:
+		return ctrlSock.context.wrap_socket(dataSock, server_side=True)
+	return ctrlSock.context.wrap_socket(dataSock, server_hostname=ctrlSock.server_hostname,
+			session=ctrlSock.session)
@@ -0,0 +1,332 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the functions used by the GETTREE and PUTTREE
+commands, which transfer a whole directory tree as a tar stream (optionally
+gzip-compressed) on one data connection. The archive is generated as it is
+sent, and extracted as it arrives, with no temporary files; and since only
+the current member is kept in memory, memory use does not grow with the size
+of the tree. As its length is not known beforehand, the stream is sent as a
+series of frames, each a FRAME_HEADER (the frame's length, as an unsigned
+32-bit integer in network byte order) followed by that many bytes. A frame
+of length 0 ends the stream; a header of ABORTED instead means the sender
+gave up part way through."""
+
+# Example usage:
+# >>> sendTree(sock, "photos", 65536, excludes=["*.tmp"], compress=True)
+# (120, 58329104)
+# >>> recvTree(sock, "photos")
+# (120, 58329104)
+
+import os
+import stat
+import struct
+import tarfile
+
+from fnmatch import fnmatchcase
+from utils import debugPrint, recvAll, sendStr
+
+
+FRAME_HEADER = struct.Struct("!I")
+END_OF_STREAM = 0
+ABORTED = 0xFFFFFFFF
+MAX_FRAME = 1 << 24
+
+
+class TreeStreamError(Exception):
+	"""Raised when a tree transfer fails: the stream was aborted, cut short
+	or malformed, or held a member which may not be extracted. Its message is
+	the reason, suitable for an ERR reply."""
+
+
+class FrameWriter:
+	"""A write-only file object (for tarfile to write to) which sends the
+	data written to it on a socket, in frames of up to chunkSize bytes."""
+	
+	__slots__ = ("_buffer", "_chunkSize", "_limiter", "_sock")
+	
+	def __init__(self, sock, chunkSize, limiter=None):
+		self._buffer = bytearray()
+		self._chunkSize = max(1, min(chunkSize, MAX_FRAME))
+		self._limiter = limiter
+		self._sock = sock
+		
+	
+	def abort(self):
+		"""Ends the stream, telling the receiver that it is incomplete. (If
+		the socket has failed, there is nobody left to tell.)"""
+		
+		try:
+			sendStr(self._sock, FRAME_HEADER.pack(ABORTED))
+		except OSError:
+			pass
+		
+		
+	def finish(self):
+		"""Sends whatever is left in the buffer, then ends the stream."""
+		
+		if self._buffer:
+			self._sendFrame(self._buffer)
+			self._buffer.clear()
+		sendStr(self._sock, FRAME_HEADER.pack(END_OF_STREAM))
+		
+	
+	def write(self, data):
+		"""Buffers the given data, sending each full frame."""
+		
+		self._buffer += data
+		while len(self._buffer) >= self._chunkSize:
+			self._sendFrame(self._buffer[:self._chunkSize])
+			del self._buffer[:self._chunkSize]
+		return len(data)
+		
+		
+	def _sendFrame(self, data):
+		"""Sends the given data as one frame."""
+		
+		sendStr(self._sock, FRAME_HEADER.pack(len(data)) + data)
+		if self._limiter:
+			self._limiter.consume(len(data))
+
+
+class FrameReader:
+	"""A read-only file object (for tarfile to read from) which returns the
+	data of the frames received on a socket, until the end of the stream."""
+	
+	__slots__ = ("_finished", "_limiter", "_remaining", "_sock")
+	
+	def __init__(self, sock, limiter=None):
+		self._finished = False
+		self._limiter = limiter
+		self._remaining = 0
+		self._sock = sock
+		
+		
+	def drain(self):
+		"""Reads and discards the rest of the stream (if it can), so that the
+		data connection may be used again."""
+		
+		try:
+			while self.read(MAX_FRAME):
+				pass
+		except TreeStreamError:
+			pass
+			
+	
+	def read(self, size=-1):
+		"""Returns up to size bytes (or the rest of the current frame, if size
+		is negative) of the stream; or an empty bytes object at its end.
+		Raises TreeStreamError if the stream was aborted or cut short."""
+		
+		while not self._remaining:
+			if self._finished:
+				return b""
+			self._nextFrame()
+		if size < 0 or size > self._remaining:
+			size = self._remaining
+		data = recvAll(self._sock, size)
+		if len(data) < size:
+			self._finished = True
+			raise TreeStreamError("INCOMPLETE DATA")
+		self._remaining -= size
+		if self._limiter:
+			self._limiter.consume(size)
+		return bytes(data)
+		
+		
+	def _nextFrame(self):
+		"""Receives the next frame's header."""
+		
+		header = recvAll(self._sock, FRAME_HEADER.size)
+		if len(header) < FRAME_HEADER.size:
+			self._finished = True
+			raise TreeStreamError("INCOMPLETE DATA")
+		(length,) = FRAME_HEADER.unpack(header)
+		if length == ABORTED:
+			self._finished = True
+			raise TreeStreamError("TRANSFER ABORTED")
+		elif length > MAX_FRAME:
+			# The stream cannot be followed any further.
+			self._finished = True
+			raise TreeStreamError("MALFORMED STREAM")
+		elif length == END_OF_STREAM:
+			self._finished = True
+		self._remaining = length
+
+
+def _matchesAny(relPath, patterns):
+	"""Returns True if the given relative path (or just its last component)
+	matches any of the given glob patterns."""
+	
+	baseName = relPath.rpartition("/")[2]
+	return any(fnmatchcase(relPath, pattern) or fnmatchcase(baseName, pattern)
+			for pattern in patterns)
+
+
+def walkTree(rootDir, includes=(), excludes=()):
+	"""Yields an (os.DirEntry, relative path) tuple for each entry under the
+	named directory, parents before their contents. (The relative paths
+	always use "/".) Entries matching any of the excludes globs are skipped,
+	along with everything under them. If there are any includes globs, only
+	the files matching one of them are given, and no directories (since they
+	are created as needed when the files are extracted)."""
+	
+	pending = [("", rootDir)]
+	while pending:
+		(relDir, dirName) = pending.pop()
+		try:
+			entries = os.scandir(dirName)
+		except OSError as err:
+			debugPrint("walkTree: skipping {name}: {err}".format(name=dirName, err=err))
+			continue
+		with entries:
+			for entry in entries:
+				relPath = relDir + entry.name
+				if _matchesAny(relPath, excludes):
+					continue
+				if entry.is_dir(follow_symlinks=False):
+					pending.append((relPath + "/", entry.path))
+					if includes:
+						continue
+				elif includes and not _matchesAny(relPath, includes):
+					continue
+				yield (entry, relPath)
+
+
+def treeSize(rootDir, includes=(), excludes=()):
+	"""Returns the total size of the regular files which sendTree would send
+	from the named directory with the given globs."""
+	
+	totalSize = 0
+	for (entry, relPath) in walkTree(rootDir, includes, excludes):
+		try:
+			if entry.is_file(follow_symlinks=False):
+				totalSize += entry.stat(follow_symlinks=False).st_size
+		except OSError:
+			pass
+	return totalSize
+
+
+def sendTree(sock, rootDir, chunkSize, limiter=None, includes=(), excludes=(),
+		compress=False):
+	"""Sends the named directory's contents (see walkTree) on the given
+	socket as a framed tar stream, gzip-compressed if compress is True.
+	Entries which cannot be read (or vanish) before they are started are
+	skipped; any other error aborts the stream, then is raised. Returns the
+	number of regular files sent and their total size, as a tuple."""
+	
+	numFiles = 0
+	numBytes = 0
+	writer = FrameWriter(sock, chunkSize, limiter)
+	try:
+		with tarfile.open(fileobj=writer, mode="w|gz" if compress else "w|",
+				format=tarfile.GNU_FORMAT) as tar:
+			for (entry, relPath) in walkTree(rootDir, includes, excludes):
+				dataFile = None
+				try:
+					if entry.is_file(follow_symlinks=False):
+						# O_NONBLOCK in case it was replaced by a FIFO since.
+						dataFile = os.fdopen(os.open(entry.path, os.O_RDONLY | os.O_NONBLOCK),
+								"rb")
+						fileStat = os.fstat(dataFile.fileno())
+						if not stat.S_ISREG(fileStat.st_mode):
+							dataFile.close()
+							continue
+						tarInfo = tar.gettarinfo(arcname=relPath, fileobj=dataFile)
+					else:
+						tarInfo = tar.gettarinfo(entry.path, relPath)
+				except OSError as err:
+					debugPrint("sendTree: skipping {name}: {err}".format(name=relPath, err=err))
+					if dataFile:
+						dataFile.close()
+					continue
+				if tarInfo is None: # A socket, which tar cannot store.
+					continue
+				if dataFile:
+					with dataFile:
+						tar.addfile(tarInfo, dataFile)
+					if tarInfo.isreg():
+						numFiles += 1
+						numBytes += tarInfo.size
+					# Only hard-linked files need remembering, to be sent as
+					# links the next time they are seen.
+					if fileStat.st_nlink == 1:
+						tar.inodes.pop((fileStat.st_ino, fileStat.st_dev), None)
+				else:
+					tar.addfile(tarInfo)
+				tar.members.clear()
+	except BaseException:
+		writer.abort()
+		raise
+	writer.finish()
+	return (numFiles, numBytes)
+
+
+def recvTree(sock, destDir, maxBytes=None, limiter=None):
+	"""Receives a framed tar stream (as sent by sendTree, compressed or not)
+	on the given socket, and extracts it into the named directory, creating
+	it if need be. Members are checked with tarfile's "data" filter, so none
+	may be written outside of the directory (nor be device files, etc.), and
+	the directories' own permissions are not kept. If maxBytes is given, the
+	regular files may total no more than that. Returns the number of regular
+	files received and their total size, as a tuple. Raises TreeStreamError
+	(once the rest of the stream has been read) if the transfer failed, or
+	OSError if a member could not be written; either way, any members
+	already extracted are left in place."""
+	
+	numFiles = 0
+	numBytes = 0
+	reader = FrameReader(sock, limiter)
+	try:
+		os.makedirs(destDir, exist_ok=True)
+		with tarfile.open(fileobj=reader, mode="r|*") as tar:
+			while True:
+				member = tar.next()
+				if member is None:
+					break
+				member = tarfile.data_filter(member, destDir)
+				if member.isreg():
+					if maxBytes is not None and numBytes + member.size > maxBytes:
+						raise TreeStreamError("TREE LARGER THAN DECLARED")
+					numFiles += 1
+					numBytes += member.size
+				tar.extract(member, destDir, filter="fully_trusted")
+				tar.members.clear()
+	except tarfile.FilterError as err:
+		reader.drain()
+		debugPrint("recvTree: {err}".format(err=err))
+		raise TreeStreamError("UNSAFE ARCHIVE MEMBER") from err
+	except tarfile.TarError as err:
+		reader.drain()
+		debugPrint("recvTree: {err}".format(err=err))
+		raise TreeStreamError("MALFORMED STREAM") from err
+	except BaseException:
+		reader.drain()
+		raise
+	reader.drain()
+	return (numFiles, numBytes)
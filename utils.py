@@ -32,12 +32,28 @@ the server and client."""
 
 
 import re
+import socket
+import struct
 import sys
 import threading
 
+from contextlib import nullcontext
 from datetime import datetime
 from os import listdir, getpid
+from iopolicy import openReader, openWriter
 from os.path import isdir, isfile, getsize
+from pipeline import BufferPipeline
+from tls import kernelSendEnabled
+
+
+def _chunkSource(producer, queueDepth):
+	"""Returns a context manager giving an iterator over the chunks yielded by
+	producer: through a BufferPipeline of the given depth, if positive; or
+	otherwise by calling it directly, in the current thread."""
+
+	if queueDepth > 0:
+		return BufferPipeline(producer, queueDepth)
+	return nullcontext(producer())
 
 
 def checkNumArgs(num):
@@ -58,12 +74,25 @@ def convertToInt(arg):
 		sys.exit(1)
 
 
+def dataSocketPath(ctrlPath, dataID):
+	"""Returns the path of the Unix domain socket for the data connection with
+	the given ID, when the control connection is made to the Unix domain
+	socket at ctrlPath. (Over Unix domain sockets, data connections are made
+	at paths beside the server's socket, and identified by number just as TCP
+	ones are identified by their port.)"""
+	
+	return "{path}.{id}".format(path=ctrlPath, id=dataID)
+
+
+# Whether debugPrint writes anything (see setDebugOutput).
+debugOutput = True
+
+
 def debugPrint(debugStr):
 	"""A simple function to output the given string with some verbosity
-	(timestamp, thread, and process IDs)."""
+	(timestamp, thread, and process IDs), unless debugging output is off."""
 	
-	# Change this conditional to False to remove all debugging output.
-	if True:
+	if debugOutput:
 		print("[{ts}] (TID {tid}) (PID {pid}) {output}".format(
 				tid=threading.current_thread().name, pid=getpid(),
 				ts=datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S"),
@@ -106,7 +135,7 @@ def recvAll(sock, numBytes):
 	recvBuff = bytearray()
 	tmpBuff = bytearray()
 	while len(recvBuff) < numBytes:
-		tmpBuff = sock.recv(numBytes)
+		tmpBuff = sock.recv(numBytes - len(recvBuff))
 		if not tmpBuff:
 			break
 		recvBuff.extend(tmpBuff)
@@ -129,32 +158,92 @@ def recvLine(sock):
 	return recvBuff[:-1].decode()
 	
 	
-def recvFile(sock, fileSize, fileName, fileMode, chunkSize):
+def recvFile(sock, fileSize, fileName, fileMode, chunkSize, limiter=None, tuner=None,
+		queueDepth=0):
 	"""Assuming the given socket is ready for reading, and the given file name
 	is ready to be written, reads <fileSize> bytes from the given socket and
-	stores them into <fileName>, using the given fileMode."""
+	stores them into <fileName>, using the given fileMode. If a limiter (such
+	as a ratelimit.TransferLimiter) is given, its consume method is called
+	after each chunk to throttle the transfer. If a tuner (an
+	autotune.ChunkTuner) is given, it picks the chunk size instead. If
+	queueDepth is positive, the data is received in a background thread
+	while earlier chunks (up to queueDepth of them) are written."""
 	
-	numBytesWritten = 0
 	with open(fileName, fileMode) as outFile:
-		while numBytesWritten < fileSize:
-			nextChunkSize = min(chunkSize, fileSize - numBytesWritten)
+		return recvIntoFile(sock, fileSize, outFile, chunkSize, limiter, tuner, queueDepth)
+
+
+def recvIntoFile(sock, fileSize, outFile, chunkSize, limiter=None, tuner=None, queueDepth=0,
+		policy="NORMAL"):
+	"""Like recvFile, but writes the data to the given (open, binary) file
+	object, and leaves it open. The data is written under the given I/O
+	policy (see iopolicy.IO_POLICIES)."""
+	
+	def recvChunks():
+		numBytesRecvd = 0
+		while numBytesRecvd < fileSize:
+			nextChunkSize = min(tuner.chunkSize if tuner else chunkSize,
+					fileSize - numBytesRecvd)
 			recvBuff = recvAll(sock, nextChunkSize)
-			debugPrint("recvFile: recv {n} bytes of data".format(n=(len(recvBuff),numBytesWritten)))
+			debugPrint("recvFile: recv {n} bytes of data".format(n=(len(recvBuff),numBytesRecvd)))
 			if not recvBuff:
 				break
-			numBytesWritten += outFile.write(recvBuff)
+			numBytesRecvd += len(recvBuff)
+			yield recvBuff
+
+	numBytesWritten = 0
+	if tuner:
+		tuner.attach(sock)
+	with openWriter(outFile, policy) as writer, _chunkSource(recvChunks, queueDepth) as chunks:
+		for recvBuff in chunks:
+			numBytesWritten += writer.write(recvBuff)
+			if limiter:
+				limiter.consume(len(recvBuff))
+			if tuner:
+				tuner.record(len(recvBuff))
 	return numBytesWritten
 			
 
+def setDebugOutput(enabled):
+	"""Turns debugging output (see debugPrint) on or off, for the whole
+	process. The client library turns it off for quiet connections, so that
+	it writes nothing to stdout."""
+	
+	global debugOutput
+	debugOutput = enabled
+
+
+def sendBuffer(sock, data, chunkSize, limiter=None, tuner=None):
+	"""Assuming the given socket is ready for writing, transmits the given
+	bytes-like object (such as file contents from a cache, or an mmap) in
+	chunks, like sendFile. Returns a count of bytes transmitted."""
+
+	if tuner:
+		tuner.attach(sock)
+	view = memoryview(data)
+	numBytesSent = 0
+	try:
+		while numBytesSent < len(view):
+			chunk = view[numBytesSent:numBytesSent + (tuner.chunkSize if tuner else chunkSize)]
+			numBytesSent += sendStr(sock, chunk)
+			if limiter:
+				limiter.consume(len(chunk))
+			if tuner:
+				tuner.record(len(chunk))
+	finally:
+		view.release()
+	return numBytesSent
+
+
 def sendStr(sock, data):
 	"""Assuming the given socket is ready for writing, sends the given data
-	(bytes or string) over that socket and returns a count of bytes transmitted.
-	If the given data is not a string or bytes object, nothing is transmitted
-	and None is returned. """
+	(bytes-like object or string) over that socket and returns a count of bytes
+	transmitted. If the given data is not a string or bytes-like object,
+	nothing is transmitted and None is returned. """
 
 	if isinstance(data, str):
 		data = data.encode()
-	if isinstance(data, bytes):
+	if isinstance(data, (bytes, bytearray, memoryview)):
 		numBytesSent = 0	
 		while len(data) > numBytesSent:
 			numBytesSent += sock.send(data[numBytesSent:])
@@ -162,17 +251,71 @@ def sendStr(sock, data):
 	return None
 		
 
-def sendFile(sock, fileName, chunkSize):
+def sendFile(sock, fileName, chunkSize, limiter=None, tuner=None, queueDepth=0,
+		policy="NORMAL"):
 	"""Assuming the given socket is ready for writing, and the given file name
 	exists and is readable, transmits the contents of the file over the socket.
 	This is copied almost verbatim from the example given as part of the
-	problem statement."""
+	problem statement. If a limiter is given, its consume method is called
+	after each chunk to throttle the transfer. If a tuner is given, it picks
+	the chunk size instead. If queueDepth is positive, the file is read in a
+	background thread while earlier chunks (up to queueDepth of them) are
+	sent. The file is read under the given I/O policy (see
+	iopolicy.IO_POLICIES). On a TLS socket whose records are sent by the
+	kernel (see tls.kernelSendEnabled), the file is sent with sendfile
+	instead (under the NORMAL policy, and without a queue)."""
 
-	with open(fileName, "rb") as dataFile:
+	def readChunks():
 		while True:
-			data = dataFile.read(chunkSize)
-			debugPrint("sendFile: send {n} bytes of data".format(n=len(data)))
+			data = dataFile.read(tuner.chunkSize if tuner else chunkSize)
 			if not data:
 				break
+			yield data
+
+	if tuner:
+		tuner.attach(sock)
+	if policy == "NORMAL" and not queueDepth and kernelSendEnabled(sock):
+		with open(fileName, "rb") as dataFile:
+			offset = 0
+			while True:
+				# (The plain socket's sendfile, since the kernel encrypts
+				# what it sends; SSLSocket's own would copy it through send.)
+				numBytes = socket.socket.sendfile(sock, dataFile, offset,
+						tuner.chunkSize if tuner else chunkSize)
+				if not numBytes:
+					break
+				offset += numBytes
+				if limiter:
+					limiter.consume(numBytes)
+				if tuner:
+					tuner.record(numBytes)
+		return
+	with openReader(fileName, policy) as dataFile, _chunkSource(readChunks, queueDepth) as chunks:
+		for data in chunks:
+			debugPrint("sendFile: send {n} bytes of data".format(n=len(data)))
 			if sendStr(sock, data) < len(data):
 				break
+			if limiter:
+				limiter.consume(len(data))
+			if tuner:
+				tuner.record(len(data))
+
+
+def unixPeerAddress(sock):
+	"""Returns the address to use for the peer of the given connected Unix
+	domain socket: ("unix", <its process ID>), the process ID being 0 where
+	it cannot be found out."""
+	
+	creds = unixPeerCredentials(sock)
+	return ("unix", creds[0] if creds else 0)
+
+
+def unixPeerCredentials(sock):
+	"""Returns the (process ID, user ID, group ID) of the peer of the given
+	connected Unix domain socket, as of when it connected (or listened); or
+	None where they cannot be found out."""
+	
+	if not hasattr(socket, "SO_PEERCRED"):
+		return None
+	creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+	return struct.unpack("3i", creds)
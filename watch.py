@@ -0,0 +1,643 @@
+#!/bin/python3 -tt
+# vim:set ts=4:
+################################################################################
+# Name:			Peter Gordon
+# Email:		peter.gordon@csu.fullerton.edu
+# Course:		CPSC 471, T/Th 11:30-12:45
+# Instructor:	Dr. M. Gofman
+# Assignment:	3 (FTP Server/Client)
+################################################################################
+# Copyright (c) 2014 Peter Gordon <peter.gordon@csu.fullerton.edu>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""This module provides the WatchHub class, which the server uses for WATCH
+and FOLLOW. A WATCH subscriber names a directory and a glob, and is sent a
+line on its data connection whenever a matching file in that directory is
+created, modified or deleted; a FOLLOW subscriber names a file, and is sent
+its contents and then whatever is appended to it. On Linux, changes are
+reported by the kernel through inotify (called through ctypes, since the
+standard library has no binding), using one inotify instance per server
+process and one watch per directory, however many subscribers share it;
+elsewhere, or if inotify is unavailable, each watched directory is listed
+periodically (more often while it is changing) and compared with its last
+listing. Either way, what is acted on is the net change to each file over a
+short delay, so a burst of writes costs the subscribers at most one event."""
+
+# Example usage:
+# >>> hub = WatchHub(method="AUTO", delay=0.2)
+# >>> watchID = hub.subscribe(dataSock, "incoming", "*.csv")
+# (The client then receives lines such as "CREATE incoming/orders.csv".)
+# >>> hub.unsubscribe(watchID)
+# True
+# >>> hub.follow(otherDataSock, "logs/access.log", offset=0)
+# 2
+
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import os
+import select
+import ssl
+import struct
+import sys
+import threading
+import time
+
+from utils import debugPrint
+
+
+# The methods by which changes may be detected; AUTO picks INOTIFY if it is
+# available, and POLL otherwise.
+WATCH_METHODS = ("AUTO", "INOTIFY", "POLL")
+
+# inotify event flags (from <sys/inotify.h>).
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+# The events which may change a directory's entries, or their sizes or
+# modification times.
+IN_WATCHED = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+		| IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+# The header of each event read from an inotify descriptor: the watch
+# descriptor, event mask, cookie and length of the (NUL-padded) name.
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# A subscriber whose client falls this far behind in reading its events is
+# dropped, rather than buffering them without limit.
+MAX_BACKLOG = 2**20
+
+# The most of a followed file which is read (and queued) at once.
+FOLLOW_CHUNK_SIZE = 64 * 1024
+
+
+class _Inotify:
+	"""A non-blocking inotify instance, with just the calls the hub needs."""
+
+	__slots__ = ("_fd", "_libc")
+
+	def __init__(self):
+		"""Raises OSError if inotify is unavailable."""
+		
+		if not sys.platform.startswith("linux"):
+			raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+		try:
+			self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+			self._libc.inotify_init1
+		except (OSError, AttributeError) as err:
+			raise OSError(errno.ENOSYS, "inotify is unavailable: {err}".format(err=err))
+		self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self._fd < 0:
+			raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+
+	def addWatch(self, dirPath):
+		"""Starts watching the named directory; returns the watch descriptor."""
+		
+		wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirPath),
+				IN_WATCHED | IN_ONLYDIR)
+		if wd < 0:
+			raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), dirPath)
+		return wd
+
+
+	def fileno(self):
+		return self._fd
+
+
+	def readEvents(self):
+		"""Returns a list of the (wd, mask, name) tuples of the pending events
+		(name being None for events on the watched directory itself)."""
+		
+		events = []
+		while True:
+			try:
+				buff = os.read(self._fd, 64 * 1024)
+			except BlockingIOError:
+				return events
+			offset = 0
+			while offset < len(buff):
+				(wd, mask, cookie, nameLen) = INOTIFY_EVENT.unpack_from(buff, offset)
+				offset += INOTIFY_EVENT.size
+				name = bytes(buff[offset:offset+nameLen]).rstrip(b"\0")
+				offset += nameLen
+				events.append((wd, mask, os.fsdecode(name) if name else None))
+
+
+	def removeWatch(self, wd):
+		# (This fails harmlessly if the kernel already removed it.)
+		self._libc.inotify_rm_watch(self._fd, wd)
+
+
+class _Directory:
+	"""The state of one watched directory: its last known entries (each
+	name's inode, size and modification time), the names which may have
+	changed since, its subscribers, and (when polling) when to list it next."""
+
+	__slots__ = ("deadline", "dirty", "entries", "name", "nextPoll", "pollInterval", "rescan",
+			"subscribers", "wd")
+
+	def __init__(self, name, pollInterval):
+		self.name = name
+		self.deadline = None
+		self.dirty = set()
+		self.entries = _listDirectory(name)
+		self.nextPoll = time.monotonic() + pollInterval
+		self.pollInterval = pollInterval
+		self.rescan = False
+		self.subscribers = []
+		self.wd = None
+
+
+	def path(self, name):
+		"""Returns the path of the named entry, as given to subscribers."""
+		
+		return name if self.name == "." else os.path.join(self.name, name)
+
+
+class _Subscriber:
+	"""One WATCH: the data connection its events are sent on, the directory
+	(once added to the hub) and glob it is for, and the data not yet sent."""
+
+	__slots__ = ("directory", "outbox", "pattern", "sock", "watchID")
+
+	def __init__(self, sock, pattern):
+		self.sock = sock
+		self.pattern = pattern
+		self.directory = None
+		self.outbox = bytearray()
+		self.watchID = None
+
+
+	def changed(self, events):
+		"""Queues the lines for those of the given (event, name) tuples of its
+		directory which match the glob. As in a shell, hidden names (such as
+		those of uploads in progress) only match a glob starting with a dot."""
+		
+		for (event, name) in events:
+			if name.startswith(".") and not self.pattern.startswith("."):
+				continue
+			if fnmatch.fnmatchcase(name, self.pattern):
+				self.outbox.extend("{event} {path}\n".format(event=event,
+						path=self.directory.path(name)).encode())
+
+
+	def close(self):
+		self.sock.close()
+
+
+	def refill(self):
+		"""Queues more data to be sent, once the outbox is empty. (Events are
+		queued as they happen, so there is nothing more to do.)"""
+		
+		pass
+
+
+class _Follower(_Subscriber):
+	"""One FOLLOW: sends the named file's contents from the given offset, then
+	whatever is appended to it. The file is followed by name: if it is
+	truncated, or replaced by a new file (as when a log is rotated), the rest
+	of the old file is sent, then the new contents from the start. Sent as
+	"DATA <offset> <length>" lines each followed by that many bytes, and
+	"TRUNCATED" or "ROTATED" lines when starting over."""
+
+	__slots__ = ("file", "inode", "name", "offset", "replaced")
+
+	def __init__(self, sock, name, inFile, offset):
+		super().__init__(sock, None)
+		self.name = name
+		self.file = inFile
+		self.inode = os.fstat(inFile.fileno()).st_ino
+		self.offset = offset
+		self.replaced = False
+
+
+	def changed(self, events):
+		"""Checks whether the file was truncated or replaced, if any of the
+		given (event, name) tuples is for it."""
+		
+		if not any(name == self.name for (event, name) in events):
+			return
+		entry = self.directory.entries.get(self.name)
+		if entry is not None and entry[0] != self.inode:
+			self.replaced = True # (Switched to once the old file is finished.)
+		elif os.fstat(self.file.fileno()).st_size < self.offset:
+			self.offset = 0
+			self.outbox.extend(b"TRUNCATED\n")
+
+
+	def close(self):
+		self.file.close()
+		self.sock.close()
+
+
+	def refill(self):
+		"""Queues the next chunk of the file, if there is any more of it; or
+		switches to the file which replaced it, if there is not."""
+		
+		if self.outbox:
+			return
+		data = os.pread(self.file.fileno(), FOLLOW_CHUNK_SIZE, self.offset)
+		if data:
+			self.outbox.extend("DATA {offset} {length}\n".format(offset=self.offset,
+					length=len(data)).encode())
+			self.outbox.extend(data)
+			self.offset += len(data)
+		elif self.replaced:
+			self.replaced = False
+			try:
+				newFile = open(self.directory.path(self.name), "rb")
+			except OSError:
+				return # (Gone again; it is switched to once it is back.)
+			self.file.close()
+			self.file = newFile
+			self.inode = os.fstat(newFile.fileno()).st_ino
+			self.offset = 0
+			self.outbox.extend(b"ROTATED\n")
+
+
+def _listDirectory(dirName):
+	"""Returns a dictionary of the entries in the named directory, mapping
+	each name to its inode, size and modification time. Raises OSError if
+	the directory cannot be listed."""
+	
+	entries = {}
+	with os.scandir(dirName) as dirEntries:
+		for entry in dirEntries:
+			try:
+				fileStat = entry.stat(follow_symlinks=False)
+			except OSError:
+				continue # Removed in the meantime.
+			entries[entry.name] = (fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns)
+	return entries
+
+
+class WatchHub:
+	"""Delivers changes to the subscribers of watched directories, using the
+	given method (see WATCH_METHODS), and acting on the net change to each
+	file over delay seconds. When polling, each directory is listed every
+	delay seconds while it is changing, backing off to every pollInterval
+	seconds while it is not. A hub may be used by several threads; its state
+	(including its inotify instance and delivery thread) is per process,
+	since neither survives a fork."""
+
+	__slots__ = ("_delay", "_directories", "_inotify", "_lock", "_method", "_nextID",
+			"_pollInterval", "_processID", "_setupLock", "_subscribers", "_thread", "_wakeup")
+
+	def __init__(self, method="AUTO", delay=0.2, pollInterval=2.0):
+		self._method = method
+		self._delay = delay
+		self._pollInterval = max(delay, pollInterval)
+		self._processID = None
+		self._setupLock = threading.Lock()
+
+
+	def follow(self, sock, fileName, offset=0):
+		"""Starts sending the named file's contents from the given offset,
+		then whatever is appended to it (see _Follower), on the given
+		(connected) socket, which then belongs to the hub. Returns the ID to
+		stop it with, by unsubscribe. Raises OSError if the file cannot be
+		read, or its directory cannot be watched."""
+		
+		self._checkProcess()
+		(dirName, name) = os.path.split(os.path.normpath(fileName))
+		inFile = open(fileName, "rb")
+		try:
+			return self._add(_Follower(sock, name, inFile, offset), dirName or ".")
+		except OSError:
+			inFile.close()
+			raise
+
+
+	@property
+	def method(self):
+		"""The method actually in use (INOTIFY or POLL)."""
+		
+		self._checkProcess()
+		return "INOTIFY" if self._inotify else "POLL"
+
+
+	def status(self):
+		"""Returns a list of (name, value) pairs describing this process's
+		watches."""
+		
+		method = self.method
+		with self._lock:
+			return [
+					("WATCHMETHOD", method),
+					("WATCHEDDIRECTORIES", len(self._directories)),
+					("WATCHERS", len(self._subscribers))
+					]
+
+
+	def subscribe(self, sock, dirName, pattern):
+		"""Starts sending the events for the names in the named directory
+		which match the glob pattern on the given (connected) socket, which
+		then belongs to the hub. Returns the watch's ID, for unsubscribe.
+		Raises OSError if the directory cannot be watched."""
+		
+		self._checkProcess()
+		return self._add(_Subscriber(sock, pattern), os.path.normpath(dirName))
+
+
+	def unsubscribe(self, watchID):
+		"""Stops the given watch (or follow), closing its socket. Returns False
+		if there is no such watch (any longer)."""
+		
+		self._checkProcess()
+		with self._lock:
+			subscriber = self._subscribers.get(watchID)
+			if subscriber is None:
+				return False
+			self._drop(subscriber)
+		self._wake()
+		return True
+
+
+	def _add(self, subscriber, dirName):
+		"""Adds the given subscriber to the named directory, watching it if it
+		is not already, and returns its new ID."""
+		
+		with self._lock:
+			directory = self._directories.get(dirName)
+			if directory is None:
+				directory = _Directory(dirName, self._delay)
+				if self._inotify:
+					directory.wd = self._inotify.addWatch(dirName)
+				self._directories[dirName] = directory
+			subscriber.watchID = self._nextID
+			self._nextID += 1
+			subscriber.directory = directory
+			if hasattr(subscriber.sock, "fileno"):
+				subscriber.sock.setblocking(False)
+			directory.subscribers.append(subscriber)
+			self._subscribers[subscriber.watchID] = subscriber
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._deliverForever, name="WatchHub",
+						daemon=True)
+				self._thread.start()
+			self._send(subscriber)
+		self._wake()
+		return subscriber.watchID
+
+
+	def _checkProcess(self):
+		"""Sets up the per-process state, if this is a new process (that is,
+		the first use, or the first since a fork)."""
+		
+		if self._processID == os.getpid():
+			return
+		with self._setupLock:
+			if self._processID == os.getpid():
+				return # (Set up by another thread in the meantime.)
+			self._directories = {}
+			self._inotify = None
+			if self._method != "POLL":
+				try:
+					self._inotify = _Inotify()
+				except OSError as err:
+					if self._method == "INOTIFY":
+						raise
+					debugPrint("WatchHub: {err}; polling instead.".format(err=err))
+			self._lock = threading.Lock()
+			self._nextID = 1
+			self._subscribers = {}
+			self._thread = None
+			self._wakeup = os.pipe()
+			os.set_blocking(self._wakeup[0], False)
+			os.set_blocking(self._wakeup[1], False)
+			self._processID = os.getpid()
+
+
+	def _deliverForever(self):
+		"""The body of the delivery thread: Waits for changes to the watched
+		directories (or for the subscribers' sockets to become writable), and
+		once a directory's delay has passed, works out what changed and tells
+		its subscribers. While nothing changes, it uses no CPU (unless
+		polling, which backs off to every pollInterval seconds)."""
+		
+		while True:
+			poller = select.poll()
+			poller.register(self._wakeup[0], select.POLLIN)
+			if self._inotify:
+				poller.register(self._inotify.fileno(), select.POLLIN)
+			with self._lock:
+				sockets = {}
+				for subscriber in self._subscribers.values():
+					if hasattr(subscriber.sock, "fileno"):
+						sockets[subscriber.sock.fileno()] = subscriber
+						poller.register(subscriber.sock.fileno(),
+								select.POLLIN | (select.POLLOUT if subscriber.outbox else 0))
+				deadlines = [directory.deadline for directory in self._directories.values()
+						if directory.deadline is not None]
+				if not self._inotify:
+					deadlines += [directory.nextPoll for directory in self._directories.values()]
+			timeout = None
+			if deadlines:
+				timeout = max(0, min(deadlines) - time.monotonic()) * 1000
+			ready = poller.poll(timeout)
+			
+			with self._lock:
+				for (fd, event) in ready:
+					if fd == self._wakeup[0]:
+						try:
+							os.read(fd, 4096)
+						except BlockingIOError:
+							pass
+					elif self._inotify and fd == self._inotify.fileno():
+						self._readInotify()
+					elif fd in sockets and sockets[fd].watchID in self._subscribers:
+						self._serviceSocket(sockets[fd], event)
+				now = time.monotonic()
+				for directory in list(self._directories.values()):
+					if not self._inotify and directory.nextPoll <= now:
+						directory.rescan = True
+						directory.deadline = now
+					if directory.deadline is not None and directory.deadline <= now:
+						self._examine(directory)
+
+
+	def _drop(self, subscriber):
+		"""Removes the given subscriber and closes its socket; and stops
+		watching its directory if it was the last one. The caller must hold
+		the lock."""
+		
+		del self._subscribers[subscriber.watchID]
+		directory = subscriber.directory
+		directory.subscribers.remove(subscriber)
+		try:
+			subscriber.close()
+		except OSError:
+			pass
+		if not directory.subscribers and self._directories.get(directory.name) is directory:
+			del self._directories[directory.name]
+			if directory.wd is not None:
+				self._inotify.removeWatch(directory.wd)
+
+
+	def _examine(self, directory):
+		"""Works out which of the given directory's entries changed since it
+		was last examined (just its dirty names, unless it must be rescanned),
+		and tells its subscribers. The caller must hold the lock."""
+		
+		if directory.rescan:
+			try:
+				current = _listDirectory(directory.name)
+			except OSError as err:
+				debugPrint("WatchHub: cannot list {name}: {err}".format(name=directory.name,
+						err=err))
+				for subscriber in list(directory.subscribers):
+					self._drop(subscriber)
+				return
+			names = directory.entries.keys() | current.keys()
+		else:
+			current = {}
+			for name in directory.dirty:
+				try:
+					fileStat = os.lstat(directory.path(name))
+				except OSError:
+					continue # Removed.
+				current[name] = (fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns)
+			names = directory.dirty
+		directory.dirty = set()
+		directory.deadline = None
+		directory.rescan = False
+		
+		events = []
+		for name in sorted(names):
+			(old, new) = (directory.entries.get(name), current.get(name))
+			if old == new:
+				continue
+			elif old is None:
+				events.append(("CREATE", name))
+			elif new is None:
+				events.append(("DELETE", name))
+			else:
+				events.append(("MODIFY", name))
+			if new is None:
+				del directory.entries[name]
+			else:
+				directory.entries[name] = new
+		if not self._inotify:
+			# Poll again soon while the directory is changing, and back off
+			# while it is not.
+			directory.pollInterval = (self._delay if events
+					else min(directory.pollInterval * 2, self._pollInterval))
+			directory.nextPoll = time.monotonic() + directory.pollInterval
+		if not events:
+			return
+		for subscriber in list(directory.subscribers):
+			try:
+				subscriber.changed(events)
+			except OSError:
+				self._drop(subscriber)
+			else:
+				self._send(subscriber)
+
+
+	def _readInotify(self):
+		"""Marks the names the pending inotify events are for as dirty, and
+		drops the subscribers of directories which are gone. The caller must
+		hold the lock."""
+		
+		byWD = {directory.wd: directory for directory in self._directories.values()}
+		now = time.monotonic()
+		for (wd, mask, name) in self._inotify.readEvents():
+			if mask & IN_Q_OVERFLOW:
+				# Some events were lost, so every directory must be rescanned.
+				for directory in self._directories.values():
+					directory.rescan = True
+					if directory.deadline is None:
+						directory.deadline = now + self._delay
+				continue
+			directory = byWD.get(wd)
+			if directory is None:
+				continue # (Its last subscriber has gone since.)
+			if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+				# (Its last changes, such as its files being deleted, are sent
+				# first.)
+				if directory.dirty:
+					self._examine(directory)
+				for subscriber in list(directory.subscribers):
+					self._drop(subscriber)
+			elif name is not None:
+				directory.dirty.add(name)
+				if directory.deadline is None:
+					directory.deadline = now + self._delay
+
+
+	def _send(self, subscriber):
+		"""Sends as much of the subscriber's data as its socket will take
+		without blocking, dropping it if it has fallen too far behind (or its
+		connection is gone). The caller must hold the lock."""
+		
+		try:
+			subscriber.refill()
+			while subscriber.outbox:
+				sent = subscriber.sock.send(subscriber.outbox)
+				del subscriber.outbox[:sent]
+				subscriber.refill()
+		except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+			# (The latter two are how a TLS socket would block.)
+			if len(subscriber.outbox) > MAX_BACKLOG:
+				debugPrint("WatchHub: dropping watch {id}, which is not being read.".format(
+						id=subscriber.watchID))
+				self._drop(subscriber)
+		except OSError:
+			self._drop(subscriber)
+
+
+	def _serviceSocket(self, subscriber, event):
+		"""Handles the poll event for a subscriber's socket: sends more of its
+		data, or drops it if the client closed the connection (a client never
+		sends anything on it). The caller must hold the lock."""
+		
+		if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+			try:
+				data = subscriber.sock.recv(4096)
+			except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+				data = None
+			except OSError:
+				data = b""
+			if data == b"":
+				self._drop(subscriber)
+				return
+		if event & select.POLLOUT:
+			self._send(subscriber)
+
+
+	def _wake(self):
+		"""Wakes the delivery thread, so that it notices new or removed
+		subscribers."""
+		
+		try:
+			os.write(self._wakeup[1], b"\0")
+		except BlockingIOError:
+			pass # (It is already due to wake.)